@@ -2,12 +2,12 @@ import logging
 import random
 
 import chat
-from services import aws_service
+from services import aws_service, repository
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-db = aws_service.dynamo_client_factory("activity")
+db = aws_service.lazy_table("activity")
 
 activity_name = ['Helicopter Tour: Ultimate Manhattan Sightseeing',
                  'Statue of Liberty and New York City Skyline Sightseeing Cruise',
@@ -61,19 +61,25 @@ In the DynamoDB table 'activity', every data entity has a 'id' as partition key.
     "user1_accept" : bool，
     "origin_price" : int
 }
+The id is the message history key of the two users (see chat.message_history_key_generator)
+and user1 is the user whose email sorts first, so every activity has a single possible id
+and a fixed slot for each user.
+
+1. def insert_activity is a conditional put: it only succeeds if no activity exists yet.
+2. def accept_activity sets the accept flag of the caller with a conditional update_item,
+    one round trip that cannot overwrite the other user's flag.
 """
 
 
 
-# insert activity info
+# insert activity info, returns None if the users already have an activity
 def insert_activity(user1, user2):
     logger.info('insert_activity')
     act_id = chat.message_history_key_generator(user1, user2)
     act_index = random.randint(0, len(activity_name)-1)
+    user1, user2 = sorted([user1, user2])
 
-    db_user = aws_service.dynamo_client_factory('user')
-    user_1 = db_user.get_item(Key={'email': user1}).get('Item')
-    user_2 = db_user.get_item(Key={'email': user2}).get('Item')
+    user_1, user_2 = repository.get_users([user1, user2], repository.USER_NAME)
 
     activity_entity = {
         "id" : act_id,
@@ -91,27 +97,22 @@ def insert_activity(user1, user2):
         'arrange_time' : arr_time[act_index]
     }
 
-    db.put_item(Item=activity_entity)
+    try:
+        db.put_item(Item=activity_entity, ConditionExpression='attribute_not_exists(id)')
+    except Exception as e:
+        if not aws_service.is_condition_failure(e):
+            raise
+        logger.info('Activity %s already exists', act_id)
+        return None
 
     return act_id
 
-# check activity exist
-def check_activity(user1, user2):
-    logger.info('get_activity')
-    act_id = chat.message_history_key_generator(user1, user2)
-    act_entity = db.get_item(Key={'id': act_id}).get('Item')
-
-    if act_entity is not None:
-        return True
-    else:
-        return False
-
 # get activity info
 def get_activity(event):
     logger.info('get_activity')
 
     act_id = event['path'].split('/')[-1]
-    act_entity = db.get_item(Key={'id': act_id}).get('Item')
+    act_entity = repository.get_activity(act_id)
 
     if act_entity is not None:
         return  {'status': 'success', 'data': act_entity}
@@ -124,23 +125,27 @@ def accept_activity(event):
     logger.info('accept_activity')
     # get act id
     act_id = event['path'].split('/')[-1]
-    # get act info
-    act_entity = db.get_item(Key={'id': act_id}).get('Item')
     # get email
     email = event['email']
 
-    if act_entity is not None:
-        if email == act_entity['user1_email']:
-            act_entity['user1_accept'] = True
-        else:
-            act_entity['user2_accept'] = True
-
-        db.put_item(Item=act_entity)
-
-        return {'status': 'success'}
+    # the slot of the caller follows from the id, activities created before the emails
+    # were ordered may have it the other way round
+    slots = ['user1', 'user2'] if act_id.startswith(email + chat.DELIMITER) else ['user2', 'user1']
+    for slot in slots:
+        try:
+            db.update_item(
+                Key={'id': act_id},
+                UpdateExpression='SET #accept = :true',
+                ConditionExpression='#email = :email',
+                ExpressionAttributeNames={'#accept': f'{slot}_accept', '#email': f'{slot}_email'},
+                ExpressionAttributeValues={':true': True, ':email': email}
+            )
+            return {'status': 'success'}
+        except Exception as e:
+            if not aws_service.is_condition_failure(e):
+                raise
 
-    else:
-        return  {'status': 'fail', 'data': 'no such activity'}
+    return  {'status': 'fail', 'data': 'no such activity'}
 
 
 
@@ -149,7 +154,3 @@ function_register = {
     ('/activity/{activity_id}', 'GET'): get_activity,
     ('/activity/status/{activity_id}', 'PUT'): accept_activity
 }
-
-def request_handler(_event):
-    function = function_register[(_event['resource'], _event['httpMethod'])]
-    return function(_event)
\ No newline at end of file
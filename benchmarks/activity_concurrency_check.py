@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dispatcher
+from services import aws_service, metrics, ratelimit
+from services.authentication_service import TEST_USER_TOKEN
+from services.local_aws import LocalDynamoResource
+
+"""
+Activity Concurrency Check
+Fires parallel requests at the local DynamoDB stand-in, with a random latency on every call
+so that the requests interleave, and checks the invariants:
+1. Both users of a conversation reply at the same time, many times over: exactly one
+    activity exists and exactly one activity message was posted to the conversation.
+2. Both users accept the activity at the same time: both accept flags end up True.
+The accepts are also run through the former read-modify-write implementation, to show the
+lost updates it suffered from. The check exits with status 1 when a request fails or an
+invariant of the current implementation is broken.
+
+    python benchmarks/activity_concurrency_check.py --conversations 50 --threads 16
+"""
+
+
+def event(resource: str, method: str, email: str, path: str, body: dict = None) -> dict:
+    return {
+        'resource': resource,
+        'path': path,
+        'httpMethod': method,
+        'headers': {'Authorization': TEST_USER_TOKEN},
+        'queryStringParameters': {'email': email},
+        'body': json.dumps(body) if body is not None else None
+    }
+
+
+def send(sender: str, receiver: str) -> dict:
+    return event('/chat/message/{target_email}', 'POST', sender, '/chat/message/' + receiver,
+                 {'message': 'hi', 'timestamp': '2023-05-01 12:00:00'})
+
+
+def accept(email: str, act_id: str) -> dict:
+    return event('/activity/status/{activity_id}', 'PUT', email, '/activity/status/' + act_id)
+
+
+def legacy_accept(email: str, act_id: str):
+    # accept_activity before the conditional update: read, flip one flag, write it all back
+    db = aws_service.dynamo_client_factory('activity')
+    act_entity = db.get_item(Key={'id': act_id}).get('Item')
+    if email == act_entity['user1_email']:
+        act_entity['user1_accept'] = True
+    else:
+        act_entity['user2_accept'] = True
+    db.put_item(Item=act_entity)
+
+
+def run_parallel(calls: list, threads: int):
+    calls = list(calls)
+    random.shuffle(calls)
+    barrier = threading.Barrier(threads)
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        barrier.wait()
+        while True:
+            with lock:
+                if not calls:
+                    return
+                call = calls.pop()
+            try:
+                result = call()
+                if isinstance(result, dict) and result.get('statusCode') != 200:
+                    errors.append(result)
+            except Exception as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--replies', type=int, default=4, help='concurrent replies per user')
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    metrics.EMIT_RECORDS = False
+    ratelimit.ENABLED = False
+    resource = LocalDynamoResource(latency=lambda: random.uniform(0, 0.003))
+    aws_service.use_dynamo_resource(resource)
+    user_db = aws_service.dynamo_client_factory('user')
+    pairs = []
+    for i in range(args.conversations):
+        pair = (f'a{i}@mulberry.test', f'b{i}@mulberry.test')
+        for email in pair:
+            user_db.put_item(Item={'email': email, 'name': email.split('@')[0], 'status': 'ACTIVE'})
+        pairs.append(pair)
+
+    calls = [lambda s=sender, r=receiver: dispatcher.request_dispatcher(send(s, r), None)
+             for a, b in pairs for sender, receiver in ((a, b), (b, a)) for _ in range(args.replies)]
+    errors = run_parallel(calls, args.threads)
+    failures = []
+
+    activity_db = aws_service.dynamo_client_factory('activity')
+    message_db = aws_service.dynamo_client_factory('message_item')
+    bad = 0
+    for a, b in pairs:
+        act_id = f'{a}---{b}'
+        posted = [item for item in message_db.query(
+            KeyConditionExpression='#conversation = :key',
+            ExpressionAttributeNames={'#conversation': 'conversation'},
+            ExpressionAttributeValues={':key': act_id})['Items'] if item['sender_email'] == '0']
+        if activity_db.get_item(Key={'id': act_id}).get('Item') is None or len(posted) != 1:
+            bad += 1
+    print(f'concurrent replies: {len(calls)} requests, {len(errors)} errors, '
+          f'{bad} of {len(pairs)} conversations without exactly one activity and activity message')
+    if errors or bad:
+        failures.append('concurrent replies')
+
+    for name, accept_call in (
+            ('accept_activity', lambda e, i: dispatcher.request_dispatcher(accept(e, i), None)),
+            ('legacy read-modify-write', legacy_accept)):
+        for a, b in pairs:
+            activity_db.update_item(Key={'id': f'{a}---{b}'},
+                                    UpdateExpression='SET user1_accept = :false, user2_accept = :false',
+                                    ExpressionAttributeValues={':false': False})
+        calls = [lambda e=email, i=f'{a}---{b}': accept_call(e, i) for a, b in pairs for email in (a, b)]
+        errors = run_parallel(calls, args.threads)
+        lost = sum(1 for a, b in pairs
+                   if not all(activity_db.get_item(Key={'id': f'{a}---{b}'})['Item'][f'user{n}_accept']
+                              for n in (1, 2)))
+        print(f'concurrent accepts ({name}): {len(calls)} requests, {len(errors)} errors, '
+              f'{lost} of {len(pairs)} activities lost an accept')
+        # the lost updates of the legacy implementation are the expected outcome
+        if errors or (lost and name == 'accept_activity'):
+            failures.append(f'concurrent accepts ({name})')
+
+    aws_service.use_dynamo_resource(None)
+    if failures:
+        print('FAILED: ' + ', '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import authentication_service
+
+"""
+Authentication Benchmark
+parseEmail throughput for a client that keeps sending the same tokens, with and without the
+verified token cache, for tokens with the numeric 'exp' claim and for legacy tokens that only
+carry the 'expiredAt' string.
+
+    python benchmarks/auth_benchmark.py --requests 20000 --tokens 100
+"""
+
+
+def legacy_token(email: str) -> str:
+    import jwt
+    expired_date_time = authentication_service.datetime.now() + authentication_service.TOKEN_LIFETIME
+    return jwt.encode({
+        'email': email,
+        'expiredAt': expired_date_time.strftime(authentication_service.DATETIME_FORMAT)
+    }, authentication_service.SECRET, authentication_service.ALGORITHM)
+
+
+def throughput(tokens: list, requests: int, cache_size: int) -> float:
+    authentication_service.TOKEN_CACHE_SIZE = cache_size
+    authentication_service.clear_token_cache()
+    events = [{'resource': '/chat/message', 'headers': {'Authorization': token}} for token in tokens]
+
+    start = time.perf_counter()
+    for i in range(requests):
+        authentication_service.parseEmail(events[i % len(events)])
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--tokens', type=int, default=100, help='distinct clients polling')
+    args = parser.parse_args()
+
+    emails = [f'user{i}@mulberry.test' for i in range(args.tokens)]
+    token_sets = {
+        'exp claim': [authentication_service.generateJWTToken(email) for email in emails],
+        'legacy expiredAt': [legacy_token(email) for email in emails]
+    }
+
+    print(f'{"token":<18} {"no cache req/s":>15} {"cache req/s":>13} {"speedup":>8}')
+    for name, tokens in token_sets.items():
+        uncached = throughput(tokens, args.requests, 0)
+        cached = throughput(tokens, args.requests, authentication_service.TOKEN_CACHE_SIZE or 1024)
+        print(f'{name:<18} {uncached:>15,.0f} {cached:>13,.0f} {cached / uncached:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+"""
+Cold Start Benchmark
+Every route is measured in fresh interpreters, the way a new Lambda container sees it:
+    import      - importing dispatcher (the Lambda entry module)
+    handler     - resolving the route, i.e. importing the handler module
+    aws_init    - importing boto3 and building the first DynamoDB table handle
+    jwt_init    - importing jwt, paid by the first authenticated request
+    first/warm  - latency of the first and of the second request of the container
+                  (only with --requests, it sends real requests to the configured backend)
+
+    python benchmarks/cold_start_benchmark.py --runs 5
+"""
+
+
+def child(resource: str, method: str, send_requests: bool) -> dict:
+    timings = {}
+    start = time.perf_counter()
+    import dispatcher
+    timings['import'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dispatcher.resolve_handler(resource, method)
+    timings['handler'] = time.perf_counter() - start
+
+    if send_requests:
+        event = {
+            'resource': resource,
+            'path': resource.replace('{', '').replace('}', ''),
+            'httpMethod': method,
+            'headers': {'Authorization': dispatcher.TEST_USER_TOKEN},
+            'queryStringParameters': {'email': 'benchmark@mulberry.test',
+                                      'target_user_email': 'benchmark@mulberry.test'},
+            'body': '{}'
+        }
+        for name in ('first', 'warm'):
+            start = time.perf_counter()
+            dispatcher.request_dispatcher(dict(event), None)
+            timings[name] = time.perf_counter() - start
+    else:
+        from services import aws_service
+        start = time.perf_counter()
+        aws_service.dynamo_client_factory('user')
+        timings['aws_init'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        import jwt  # noqa: F401
+        timings['jwt_init'] = time.perf_counter() - start
+    return timings
+
+
+def measure(route: tuple, runs: int, send_requests: bool) -> dict:
+    samples = {}
+    for _ in range(runs):
+        command = [sys.executable, __file__, '--child', route[0], route[1]]
+        if send_requests:
+            command.append('--requests')
+        output = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, check=True,
+                                env=dict(os.environ, AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION',
+                                                                                        'us-east-1')))
+        for name, value in json.loads(output.stdout.strip().splitlines()[-1]).items():
+            samples.setdefault(name, []).append(value * 1000)
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--requests', action='store_true', help='also time the first two requests')
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.child[0], args.child[1], args.requests)))
+        return
+
+    import dispatcher
+    columns = ['import', 'handler'] + (['first', 'warm'] if args.requests else ['aws_init', 'jwt_init'])
+    print(f'{"route":<42}' + ''.join(f'{c + " ms":>12}' for c in columns))
+    for route in dispatcher.ROUTES:
+        result = measure(route, args.runs, args.requests)
+        print(f'{route[1] + " " + route[0]:<42}' + ''.join(f'{result[c]:>12.1f}' for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import importlib
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dispatcher
+from services import aws_service, matchhelper, metrics, ratelimit, userhelper
+from services.authentication_service import TEST_USER_TOKEN
+from services.local_aws import LocalDynamoResource, LocalSES
+
+"""
+Endpoint Benchmark
+Seeds the local AWS stand-in with synthetic users, chats and activities, then drives every
+route of every handler module's function_register through dispatcher.request_dispatcher.
+
+For each route it reports the latency percentiles, the DynamoDB round trips, the item bytes
+read and written per request and the response size, so a regression shows up as a number.
+Use --latency to add a per-call delay emulating the network round trip to DynamoDB.
+
+    python benchmarks/endpoint_benchmark.py --scales 100 1000 --requests 200 --latency 2
+"""
+
+HANDLER_MODULES = ['user', 'match', 'chat', 'activity']
+LOCATIONS = ['New York', 'Brooklyn', 'Queens', 'Jersey City', 'Hoboken']
+INTERESTS = ['hiking', 'movies', 'music', 'cooking', 'travel', 'reading', 'gaming', 'yoga']
+CONVERSATIONS_PER_USER = 4
+MESSAGES_PER_CONVERSATION = 20
+PASSWORD = 'password'
+
+
+def profile(i: int, rng: random.Random) -> dict:
+    return {
+        'email': f'user{i}@mulberry.test',
+        'name': f'User {i}',
+        'gender': 'male' if i % 2 == 0 else 'female',
+        'location': rng.choice(LOCATIONS),
+        'interest1': rng.choice(INTERESTS),
+        'interest2': rng.choice(INTERESTS),
+        'interest3': rng.choice(INTERESTS),
+        'photo': f'https://photos.mulberry.test/{i}.jpg'
+    }
+
+
+def seed(users: int, seed_value: int = 6998) -> dict:
+    import chat
+    import activity
+
+    rng = random.Random(seed_value)
+    user_db = aws_service.dynamo_client_factory('user')
+    context = {'users': [], 'pending': [], 'codes': [], 'pairs': []}
+
+    for i in range(users):
+        user = dict(profile(i, rng), status='ACTIVE', password=PASSWORD,
+                    created_ts='2023-05-01 12:00:00', email_verified=True)
+        user_db.put_item(Item=user)
+        matchhelper.update_candidate_index(None, user)
+        context['users'].append(user)
+
+    for i in range(max(1, users // 10)):
+        email = f'pending{i}@mulberry.test'
+        user_db.put_item(Item={'email': email, 'status': 'PENDING', 'password': PASSWORD,
+                               'created_ts': '2023-05-01 12:00:00', 'email_verified': False})
+        context['pending'].append(email)
+        context['codes'].append(userhelper.verification_link_generator(email).split('/')[-1])
+
+    # every user talks to the next users of the opposite gender
+    for i in range(users):
+        for step in range(1, 2 * CONVERSATIONS_PER_USER, 2):
+            if i + step >= users:
+                break
+            pair = (context['users'][i]['email'], context['users'][i + step]['email'])
+            key = chat.message_history_key_generator(*pair)
+            for m in range(MESSAGES_PER_CONVERSATION):
+                sender, receiver = pair if m % 2 == 0 else pair[::-1]
+                message = chat.put_message(key, {'sender_email': sender, 'message': f'message {m}',
+                                                 'timestamp': '2023-05-01 12:00:00'})
+                chat.record_message_sent(key, sender, receiver)
+                chat.update_conversation_summaries(sender, receiver, message)
+            chat.claim_activity(key)
+            activity.insert_activity(*pair)
+            context['pairs'].append(pair)
+    return context
+
+
+def _event(resource: str, method: str, email: str, path: str = None, query: dict = None,
+           body: dict = None) -> dict:
+    return {
+        'resource': resource,
+        'path': path or resource,
+        'httpMethod': method,
+        'headers': {'Authorization': TEST_USER_TOKEN},
+        'queryStringParameters': dict(query or {}, email=email),
+        'body': json.dumps(body) if body is not None else None
+    }
+
+
+def _user(context: dict, i: int) -> dict:
+    return context['users'][i % len(context['users'])]
+
+
+def _pair(context: dict, i: int) -> tuple:
+    return context['pairs'][i % len(context['pairs'])]
+
+
+ROUTE_EVENTS = {
+    ('/user/signup', 'POST'): lambda c, i: dict(
+        _event('/user/signup', 'POST', None, body={'email': f'new{i}-{time.time_ns()}@mulberry.test',
+                                                    'password': PASSWORD}), headers={}),
+    ('/user/login', 'POST'): lambda c, i: _event(
+        '/user/login', 'POST', _user(c, i)['email'], body={'email': _user(c, i)['email'], 'password': PASSWORD}),
+    ('/user/password', 'PUT'): lambda c, i: _event(
+        '/user/password', 'PUT', _user(c, i)['email'], body={'password': PASSWORD}),
+    ('/user/verify/resend/{email}', 'POST'): lambda c, i: _event(
+        '/user/verify/resend/{email}', 'POST', None,
+        path='/user/verify/resend/' + c['pending'][i % len(c['pending'])]),
+    ('/user/verify/{token}', 'POST'): lambda c, i: _event(
+        '/user/verify/{token}', 'POST', None, path='/user/verify/' + c['codes'][i % len(c['codes'])]),
+    ('/user', 'GET'): lambda c, i: _event('/user', 'GET', _user(c, i)['email']),
+    ('/user', 'PUT'): lambda c, i: _event(
+        '/user', 'PUT', _user(c, i)['email'],
+        body={k: v for k, v in _user(c, i).items() if k not in ('password', 'status')}),
+    ('/user/batch', 'POST'): lambda c, i: _event(
+        '/user/batch', 'POST', _user(c, i)['email'],
+        body={'emails': [_user(c, i + step)['email'] for step in range(10)]}),
+    ('/user/photo', 'GET'): lambda c, i: _event('/user/photo', 'GET', _user(c, i)['email']),
+    ('/match', 'GET'): lambda c, i: _event('/match', 'GET', _user(c, i)['email'], query={'hydrate': 'true'}),
+    ('/chat', 'GET'): lambda c, i: _event('/chat', 'GET', _pair(c, i)[0]),
+    ('/chat/unread', 'GET'): lambda c, i: _event('/chat/unread', 'GET', _pair(c, i)[1]),
+    ('/chat/message', 'GET'): lambda c, i: _event(
+        '/chat/message', 'GET', _pair(c, i)[0], query={'target_user_email': _pair(c, i)[1]}),
+    ('/chat/message/{target_email}', 'POST'): lambda c, i: _event(
+        '/chat/message/{target_email}', 'POST', _pair(c, i)[0], path='/chat/message/' + _pair(c, i)[1],
+        body={'message': 'hello', 'timestamp': '2023-05-02 12:00:00'}),
+    ('/activity/{activity_id}', 'GET'): lambda c, i: _event(
+        '/activity/{activity_id}', 'GET', _pair(c, i)[0], path='/activity/' + '---'.join(sorted(_pair(c, i)))),
+    ('/activity/status/{activity_id}', 'PUT'): lambda c, i: _event(
+        '/activity/status/{activity_id}', 'PUT', _pair(c, i)[1],
+        path='/activity/status/' + '---'.join(sorted(_pair(c, i))))
+}
+
+
+def all_routes() -> list:
+    routes = []
+    for module_name in HANDLER_MODULES:
+        routes.extend(importlib.import_module(module_name).function_register)
+    missing = [route for route in routes if route not in ROUTE_EVENTS]
+    if missing:
+        raise RuntimeError(f'No benchmark event for the routes {missing}')
+    return routes
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_route(resource: LocalDynamoResource, context: dict, route: tuple, requests: int) -> dict:
+    samples = {'latency': [], 'round_trips': [], 'bytes_read': [], 'bytes_written': [], 'response': []}
+    errors = 0
+    for i in range(requests):
+        event = ROUTE_EVENTS[route](context, i)
+        resource.reset_stats()
+        start = time.perf_counter()
+        response = dispatcher.request_dispatcher(event, None)
+        samples['latency'].append((time.perf_counter() - start) * 1000)
+        samples['round_trips'].append(resource.stats['round_trips'])
+        samples['bytes_read'].append(resource.stats['bytes_read'])
+        samples['bytes_written'].append(resource.stats['bytes_written'])
+        samples['response'].append(len(response['body'] or ''))
+        errors += response['statusCode'] != 200
+    return {
+        'p50': percentile(samples['latency'], 0.50),
+        'p95': percentile(samples['latency'], 0.95),
+        'p99': percentile(samples['latency'], 0.99),
+        'round_trips': statistics.mean(samples['round_trips']),
+        'bytes_read': statistics.mean(samples['bytes_read']),
+        'bytes_written': statistics.mean(samples['bytes_written']),
+        'response': statistics.mean(samples['response']),
+        'errors': errors
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000], help='number of users')
+    parser.add_argument('--requests', type=int, default=100, help='requests per route')
+    parser.add_argument('--latency', type=float, default=0.0, help='injected ms per DynamoDB call')
+    args = parser.parse_args()
+
+    metrics.EMIT_RECORDS = False
+    ratelimit.ENABLED = False
+    for scale in args.scales:
+        resource = LocalDynamoResource()
+        aws_service.use_dynamo_resource(resource)
+        aws_service.use_client('ses', LocalSES())
+        context = seed(scale)
+        resource.latency = args.latency / 1000
+
+        print(f'\n{scale} users, {len(context["pairs"])} conversations, '
+              f'{args.latency} ms injected per DynamoDB call')
+        print(f'{"route":<38} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"calls":>6} '
+              f'{"read B":>9} {"write B":>8} {"resp B":>8} {"errors":>6}')
+        for route in all_routes():
+            result = run_route(resource, context, route, args.requests)
+            print(f'{route[1] + " " + route[0]:<38} {result["p50"]:>8.2f} {result["p95"]:>8.2f} '
+                  f'{result["p99"]:>8.2f} {result["round_trips"]:>6.1f} {result["bytes_read"]:>9.0f} '
+                  f'{result["bytes_written"]:>8.0f} {result["response"]:>8.0f} {result["errors"]:>6}')
+
+    aws_service.use_dynamo_resource(None)
+    aws_service.use_client('ses', None)
+
+
+if __name__ == '__main__':
+    main()
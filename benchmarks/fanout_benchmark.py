@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dispatcher
+from services import aws_service, dataloader, fanout, metrics, ratelimit
+from services.local_aws import LocalDynamoResource, LocalSES
+from benchmarks.endpoint_benchmark import ROUTE_EVENTS, _pair, seed
+
+"""
+Fan-out Benchmark
+Wall-clock time of independent DynamoDB calls run one after another and through
+services.fanout, with --latency ms injected into every call of the local AWS stand-in:
+1. N independent get_item calls.
+2. The chat routes that fan out: sending a message, and reading an unread conversation
+    (the read flags are written while the page is read). Each request also reports the
+    DynamoDB calls in its metrics record, which must not change with the fan-out.
+3. The get_item fan-out through boto3 instead of the stand-in, against a local HTTP endpoint
+    answering every call after --latency ms: the first fan-out of a cold registry, which
+    creates the client and the resources of the workers, then the warm ones, with the
+    resources and connections the registry created.
+
+    python benchmarks/fanout_benchmark.py --latency 5 --repeat 30
+"""
+
+
+def timed(function, repeat: int) -> float:
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def read_user(email: str) -> dict:
+    return aws_service.dynamo_client_factory('user').get_item(Key={'email': email})
+
+
+def request(event: dict) -> dict:
+    # the body of request_dispatcher, keeping the metrics record
+    metrics.start_request()
+    response = dispatcher.dispatch(event)
+    dataloader.clear()
+    record = metrics.finish_request(event, response)
+    assert response['statusCode'] == 200, response
+    return record
+
+
+class DynamoEndpoint(BaseHTTPRequestHandler):
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.latency)
+        body = json.dumps({'Item': {'email': {'S': 'user@mulberry.test'}}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(ThreadingHTTPServer):
+    # a cold fan-out connects all at once, a short backlog would drop connections
+    request_queue_size = 64
+    daemon_threads = True
+
+
+def boto3_fanout(count: int, latency: float, repeat: int):
+    DynamoEndpoint.latency = latency
+    server = LocalServer(('127.0.0.1', 0), DynamoEndpoint)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for name, value in (('AWS_ENDPOINT_URL_DYNAMODB', f'http://127.0.0.1:{server.server_port}'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1'), ('AWS_ACCESS_KEY_ID', 'local'),
+                        ('AWS_SECRET_ACCESS_KEY', 'local')):
+        os.environ.setdefault(name, value)
+    aws_service.use_dynamo_resource(None)
+    aws_service.reset_registry()
+    # the import is paid once per container whatever the registry does
+    import boto3
+
+    calls = [(read_user, f'user{n}@mulberry.test') for n in range(count)]
+    start = time.perf_counter()
+    fanout.run(*calls)
+    cold = (time.perf_counter() - start) * 1000
+    warm = timed(lambda i: fanout.run(*calls), repeat)
+    stats = aws_service.registry_stats()
+    print(f'\n{count} x get_item through boto3, fan-out: cold {cold:.2f} ms, warm {warm:.2f} ms, '
+          f'{stats.get("resources_created", 0)} client(s) and {stats.get("thread_resources_created", 0)} '
+          f'thread resources created, {stats["connections_created"]} connections for '
+          f'{stats["requests_sent"]} requests')
+    server.shutdown()
+    aws_service.reset_registry()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=5.0, help='injected ms per DynamoDB call')
+    parser.add_argument('--repeat', type=int, default=30)
+    args = parser.parse_args()
+
+    metrics.EMIT_RECORDS = False
+    ratelimit.ENABLED = False
+    resource = LocalDynamoResource()
+    aws_service.use_dynamo_resource(resource)
+    aws_service.use_client('ses', LocalSES())
+    context = seed(args.users)
+    resource.latency = args.latency / 1000
+    emails = [user['email'] for user in context['users']]
+
+    print(f'{"calls":<34} {"sequential ms":>14} {"fan-out ms":>11} {"dynamo calls":>13}')
+    for count in (2, 4, 8):
+        results = {}
+        for enabled in (False, True):
+            fanout.ENABLED = enabled
+            results[enabled] = timed(lambda i: fanout.run(
+                *[(read_user, emails[(i * count + n) % len(emails)]) for n in range(count)]), args.repeat)
+        print(f'{f"{count} x get_item":<34} {results[False]:>14.2f} {results[True]:>11.2f} {count:>13}')
+
+    def send(i):
+        return request(ROUTE_EVENTS[('/chat/message/{target_email}', 'POST')](context, i))
+
+    def read_unread(i):
+        # the partner writes first, so the conversation is unread when it is read
+        sender, receiver = _pair(context, i)
+        request(dict(ROUTE_EVENTS[('/chat/message/{target_email}', 'POST')](context, i),
+                     queryStringParameters={'email': receiver}, path='/chat/message/' + sender))
+        start = time.perf_counter()
+        record = request(ROUTE_EVENTS[('/chat/message', 'GET')](context, i))
+        return (time.perf_counter() - start) * 1000, record
+
+    for name, route in (('POST /chat/message/{target_email}', send), ('GET /chat/message (unread)', read_unread)):
+        results, dynamo_calls = {}, {}
+        for enabled in (False, True):
+            fanout.ENABLED = enabled
+            if route is send:
+                results[enabled] = timed(send, args.repeat)
+                dynamo_calls[enabled] = send(0)['dynamo_calls']
+            else:
+                samples = [read_unread(i) for i in range(args.repeat)]
+                results[enabled] = statistics.median(elapsed for elapsed, _ in samples)
+                dynamo_calls[enabled] = samples[-1][1]['dynamo_calls']
+        print(f'{name:<34} {results[False]:>14.2f} {results[True]:>11.2f} '
+              f'{dynamo_calls[False]:>6} / {dynamo_calls[True]:<6}')
+    fanout.ENABLED = True
+
+    aws_service.use_client('ses', None)
+    boto3_fanout(8, args.latency / 1000, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
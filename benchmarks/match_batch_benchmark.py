@@ -0,0 +1,115 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import match_batch
+
+"""
+Batch Matching Benchmark
+Compares match_batch.score_matches with the per-user loop of match.make_new_match that
+scanned the whole user table for every user.
+
+The per-user loop is O(N) per user, so running it for every user is O(N^2): it is timed on
+a sample of users and extrapolated to the whole population. Both sides run on in-memory
+users, so the numbers exclude DynamoDB round trips (the loop additionally needs one full
+table scan per user, the batch engine one scan in total).
+
+    python benchmarks/match_batch_benchmark.py --sizes 10000 100000
+"""
+
+LOCATIONS = ['New York', 'Brooklyn', 'Queens', 'Jersey City', 'Boston', 'Philadelphia',
+             'Chicago', 'Seattle', 'San Francisco', 'Los Angeles']
+INTERESTS = ['hiking', 'movies', 'music', 'cooking', 'travel', 'reading', 'gaming', 'yoga',
+             'photography', 'art', 'dancing', 'running', 'coffee', 'wine', 'tennis', 'swimming']
+
+
+def synthetic_users(count: int, seed: int = 6998) -> list:
+    rng = random.Random(seed)
+    return [{
+        'email': f'user{i}@mulberry.test',
+        'status': 'ACTIVE' if rng.random() < 0.95 else 'PENDING',
+        'gender': rng.choice(['male', 'female']),
+        'location': rng.choice(LOCATIONS),
+        'interest1': rng.choice(INTERESTS),
+        'interest2': rng.choice(INTERESTS),
+        'interest3': rng.choice(INTERESTS)
+    } for i in range(count)]
+
+
+def loop_match(user: dict, users: list) -> list:
+    # the matching loop of make_new_match before the candidate index and the batch engine
+    expected_gender = 'female' if user['gender'] == 'male' else 'male'
+    expected_location = user['location']
+    expected_interest = [user['interest1'], user['interest2'], user['interest3']]
+
+    potential_match = []
+    for candidate in users:
+        if candidate['status'] != 'ACTIVE' or candidate['gender'] != expected_gender:
+            continue
+        score = 0
+        if candidate['location'] == expected_location:
+            score += 3
+        if candidate['interest1'] in expected_interest:
+            score += 1
+        if candidate['interest2'] in expected_interest:
+            score += 1
+        if candidate['interest3'] in expected_interest:
+            score += 1
+        if score == 0:
+            continue
+        potential_match.append({'score': score, 'email': candidate['email']})
+
+    potential_match = sorted(potential_match, key=lambda x: x['score'], reverse=True)
+    return [item['email'] for item in potential_match[:10]]
+
+
+def benchmark(count: int, sample: int) -> dict:
+    users = synthetic_users(count)
+    active = [u for u in users if u['status'] == 'ACTIVE']
+
+    start = time.perf_counter()
+    for user in active[:sample]:
+        loop_match(user, users)
+    loop_per_user = (time.perf_counter() - start) / sample
+
+    start = time.perf_counter()
+    encoded = match_batch.encode_users(users)
+    encoded_at = time.perf_counter()
+    matches = match_batch.score_matches(encoded)
+    scored_at = time.perf_counter()
+
+    return {
+        'users': count,
+        'loop_ms_per_user': loop_per_user * 1000,
+        'loop_total_s': loop_per_user * len(active),
+        'loop_table_reads': len(active),
+        'batch_encode_s': encoded_at - start,
+        'batch_score_s': scored_at - encoded_at,
+        'batch_table_reads': 1,
+        'matched_users': len(matches)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--sample', type=int, default=20, help='users timed for the loop')
+    args = parser.parse_args()
+
+    print(f'{"users":>8} {"loop/user":>10} {"loop total":>11} {"batch encode":>13} '
+          f'{"batch score":>12} {"speedup":>8} {"scans loop/batch":>17}')
+    for count in args.sizes:
+        result = benchmark(count, args.sample)
+        batch_total = result['batch_encode_s'] + result['batch_score_s']
+        print(f'{result["users"]:>8} {result["loop_ms_per_user"]:>8.2f}ms '
+              f'{result["loop_total_s"]:>10.1f}s {result["batch_encode_s"]:>12.2f}s '
+              f'{result["batch_score_s"]:>11.2f}s {result["loop_total_s"] / batch_total:>7.0f}x '
+              f'{result["loop_table_reads"]:>10}/{result["batch_table_reads"]}')
+
+
+if __name__ == '__main__':
+    main()
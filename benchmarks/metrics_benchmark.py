@@ -0,0 +1,77 @@
+import argparse
+import io
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dispatcher
+from services import aws_service, metrics, ratelimit
+from services.local_aws import LocalDynamoResource, LocalSES
+from benchmarks.endpoint_benchmark import ROUTE_EVENTS, all_routes, seed
+
+"""
+Metrics Benchmark
+Cost of the request instrumentation (services.metrics). Every route is driven through
+request_dispatcher with the metrics switched off and on, in ABBA order so that neither mode
+is favoured by warm caches, and the EMF records are written to an in-memory stream.
+
+The cost is measured without injected latency, where it is not hidden by sleep jitter, and
+put in relation to the handler time with --latency ms per DynamoDB call, as on Lambda.
+
+    python benchmarks/metrics_benchmark.py --users 200 --requests 300 --latency 2
+"""
+
+
+def measure(context: dict, route: tuple, requests: int) -> dict:
+    samples = {False: [], True: []}
+    stdout, records = sys.stdout, io.StringIO()
+    for i in range(requests * 2):
+        enabled = (i + i // 2) % 2 == 1
+        metrics.ENABLED = enabled
+        event = ROUTE_EVENTS[route](context, i)
+        sys.stdout = records
+        start = time.perf_counter()
+        dispatcher.request_dispatcher(event, None)
+        elapsed = time.perf_counter() - start
+        sys.stdout = stdout
+        samples[enabled].append(elapsed * 1000)
+    metrics.ENABLED = True
+    return {enabled: statistics.median(values) for enabled, values in samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=300, help='requests per route and mode')
+    parser.add_argument('--latency', type=float, default=2.0, help='injected ms per DynamoDB call')
+    args = parser.parse_args()
+
+    ratelimit.ENABLED = False
+    resource = LocalDynamoResource()
+    aws_service.use_dynamo_resource(resource)
+    aws_service.use_client('ses', LocalSES())
+    context = seed(args.users)
+
+    print(f'{"route":<38} {"cost us":>8} {"handler ms":>11} {"overhead":>9}')
+    total_cost, total_handler = 0.0, 0.0
+    for route in all_routes():
+        resource.latency = 0
+        local = measure(context, route, args.requests)
+        resource.latency = args.latency / 1000
+        handler = measure(context, route, max(1, args.requests // 10))[False]
+        cost = max(0.0, local[True] - local[False])
+        total_cost += cost
+        total_handler += handler
+        print(f'{route[1] + " " + route[0]:<38} {cost * 1000:>8.1f} {handler:>11.3f} {cost / handler:>9.2%}')
+    print(f'{"all routes":<38} {total_cost * 1000:>8.1f} {total_handler:>11.3f} '
+          f'{total_cost / total_handler:>9.2%}')
+
+    aws_service.use_dynamo_resource(None)
+    aws_service.use_client('ses', None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+import argparse
+import os
+import random
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import aws_service, metrics, outbox
+from services.local_aws import LocalDynamoResource, LocalSES
+
+"""
+Outbox Check
+Drains services/outbox.py against the local AWS stand-in, with LocalSES(failures=N) failing
+the first N sends and a clock the check moves forward instead of waiting for the backoff:
+1. A failed send is retried after a backoff between half and all of BACKOFF_BASE_MS, and not
+    before.
+2. A job failing MAX_ATTEMPTS times becomes DEAD with its 'last_error', the backoff doubling
+    on every attempt, and is never sent again.
+3. requeue gives a DEAD job a fresh set of attempts, and only a DEAD job.
+4. A claimed job is skipped by every other drainer until its lease runs out, and --drainers
+    concurrent drains send each of --jobs jobs exactly once.
+The check exits with status 1 when one of them fails.
+
+    python benchmarks/outbox_check.py --jobs 200 --drainers 4
+"""
+
+clock = [1683000000000]
+failures = []
+
+
+def check(name: str, ok: bool, detail: str = ''):
+    print(f'{"ok  " if ok else "FAIL"} {name}{" - " + detail if detail else ""}')
+    if not ok:
+        failures.append(name)
+
+
+def job(job_id: str) -> dict:
+    return aws_service.dynamo_client_factory(outbox.OUTBOX_DYNAMO_NAME).get_item(Key={'id': job_id})['Item']
+
+
+def use_ses(failing: int, latency: float = 0.0) -> LocalSES:
+    ses = LocalSES(latency=latency, failures=failing)
+    aws_service.use_client('ses', ses)
+    return ses
+
+
+def retry_with_backoff():
+    ses = use_ses(1)
+    job_id = outbox.enqueue_email('retry@mulberry.test', 'subject', 'body')
+    stats = outbox.drain()
+    delay = int(job(job_id)['next_attempt_at']) - clock[0]
+    check('a failed send is retried', stats['RETRY'] == 1 and job(job_id)['state'] == outbox.STATE_PENDING,
+          str(stats))
+    check('the first backoff is between half and all of BACKOFF_BASE_MS',
+          outbox.BACKOFF_BASE_MS / 2 <= delay <= outbox.BACKOFF_BASE_MS, f'{delay} ms')
+    check('the job is not sent before its backoff', outbox.drain()[outbox.STATE_SENT] == 0)
+    clock[0] += delay
+    outbox.drain()
+    sent = job(job_id)
+    check('the job is sent after its backoff', sent['state'] == outbox.STATE_SENT and len(ses.sent) == 1
+          and int(sent['attempts']) == 2 and 'expires_at' in sent, str(sent['state']))
+
+
+def dead_after_max_attempts():
+    ses = use_ses(outbox.MAX_ATTEMPTS + 1)
+    job_id = outbox.enqueue_email('dead@mulberry.test', 'subject', 'body')
+    delays = []
+    for _ in range(outbox.MAX_ATTEMPTS):
+        outbox.drain()
+        delays.append(int(job(job_id)['next_attempt_at']) - clock[0])
+        clock[0] += outbox.BACKOFF_MAX_MS
+    dead = job(job_id)
+    check(f'the job is DEAD after {outbox.MAX_ATTEMPTS} attempts',
+          dead['state'] == outbox.STATE_DEAD and int(dead['attempts']) == outbox.MAX_ATTEMPTS
+          and bool(dead.get('last_error')), f"{dead['state']} after {dead['attempts']} attempts")
+    bounds = [min(outbox.BACKOFF_MAX_MS, outbox.BACKOFF_BASE_MS * 2 ** attempt)
+              for attempt in range(outbox.MAX_ATTEMPTS)]
+    check('the backoff doubles on every attempt',
+          all(bound / 2 <= delay <= bound for delay, bound in zip(delays[:-1], bounds)),
+          ', '.join(f'{delay / 1000:.0f}s' for delay in delays[:-1]))
+    stats = outbox.drain()
+    check('a DEAD job is never sent again', stats['SENT'] + stats['RETRY'] + stats['DEAD'] == 0 and not ses.sent,
+          str(stats))
+    return job_id
+
+
+def requeue_dead(job_id: str):
+    ses = use_ses(0)
+    outbox.requeue(job_id)
+    requeued = job(job_id)
+    check('requeue makes the job PENDING with no attempts',
+          requeued['state'] == outbox.STATE_PENDING and int(requeued['attempts']) == 0)
+    outbox.drain()
+    check('the requeued job is sent', job(job_id)['state'] == outbox.STATE_SENT and len(ses.sent) == 1)
+    try:
+        outbox.requeue(job_id)
+        check('requeue refuses a job that is not DEAD', False)
+    except Exception as e:
+        check('requeue refuses a job that is not DEAD', aws_service.is_condition_failure(e), repr(e))
+
+
+def lease_and_claim():
+    ses = use_ses(0)
+    job_id = outbox.enqueue_email('lease@mulberry.test', 'subject', 'body')
+    seen = outbox.due_jobs()
+    check('the first drainer claims the job', outbox.claim(seen[0]))
+    check('a drainer holding the same view skips it', not outbox.claim(seen[0]))
+    check('the leased job is not due', outbox.drain()['SENT'] == 0 and not ses.sent)
+    clock[0] += outbox.LEASE_MS
+    outbox.drain()
+    check('the job is due again once the lease runs out', job(job_id)['state'] == outbox.STATE_SENT)
+
+
+def concurrent_drains(jobs: int, drainers: int):
+    ses = use_ses(0, latency=0.002)
+    targets = [f'user{i}@mulberry.test' for i in range(jobs)]
+    for target in targets:
+        outbox.enqueue_email(target, 'subject', 'body')
+    stats = []
+    barrier = threading.Barrier(drainers)
+
+    def drainer():
+        barrier.wait()
+        stats.append(outbox.drain())
+
+    threads = [threading.Thread(target=drainer) for _ in range(drainers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sent = sorted(email['Destination']['ToAddresses'][0] for email in ses.sent)
+    check(f'{drainers} concurrent drains send each job exactly once', sent == sorted(targets),
+          f'{len(sent)} sent, {len(set(sent))} distinct, {sum(s["skipped"] for s in stats)} claims skipped')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--drainers', type=int, default=4)
+    args = parser.parse_args()
+
+    metrics.EMIT_RECORDS = False
+    aws_service.use_dynamo_resource(LocalDynamoResource(latency=lambda: random.uniform(0, 0.001)))
+    now_ms = outbox._now_ms
+    outbox._now_ms = lambda: clock[0]
+
+    retry_with_backoff()
+    requeue_dead(dead_after_max_attempts())
+    lease_and_claim()
+    concurrent_drains(args.jobs, args.drainers)
+
+    outbox._now_ms = now_ms
+    aws_service.use_client('ses', None)
+    aws_service.use_dynamo_resource(None)
+    if failures:
+        print('FAILED: ' + ', '.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import aws_service, local_aws, metrics
+from services.local_aws import LocalDynamoResource
+from benchmarks.match_batch_benchmark import synthetic_users
+
+"""
+Pagination Check
+Drives aws_service.scan against the local AWS stand-in, with pages cut at --page-kb and
+--latency ms injected into every call:
+1. A sequential and a segmented scan read every user exactly once, the DynamoDB calls of the
+    segments are counted in the metrics of the calling thread.
+2. Stopping early (breaking out of the loop, or limit) reads no further page.
+3. Peak Python memory while counting the users by streaming the scan, and when the whole
+    table is collected into a list first.
+
+    python benchmarks/pagination_check.py --users 20000 --latency 5 --segments 4
+"""
+
+
+def timed_scan(segments: int) -> tuple:
+    start = time.perf_counter()
+    metrics.start_request()
+    emails = [user['email'] for user in aws_service.scan('user', projection=['gender'], segments=segments)]
+    calls = sum(calls for calls, _, _ in metrics.take_dynamo_calls().values())
+    return emails, (time.perf_counter() - start) * 1000, calls
+
+
+def peak_kb(function) -> float:
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--page-kb', type=int, default=64, help='page size limit of the stand-in')
+    parser.add_argument('--latency', type=float, default=5.0, help='injected ms per DynamoDB call')
+    parser.add_argument('--segments', type=int, default=4)
+    args = parser.parse_args()
+
+    metrics.EMIT_RECORDS = False
+    local_aws.PAGE_SIZE_LIMIT = args.page_kb * 1024
+    resource = LocalDynamoResource()
+    aws_service.use_dynamo_resource(resource)
+    with aws_service.dynamo_client_factory('user').batch_writer() as batch:
+        for user in synthetic_users(args.users):
+            batch.put_item(Item=user)
+    resource.latency = args.latency / 1000
+
+    for segments in (1, args.segments):
+        emails, elapsed, calls = timed_scan(segments)
+        print(f'scan, {segments} segment(s): {len(emails)} items, {len(set(emails))} distinct, '
+              f'{calls} DynamoDB calls in the metrics, {elapsed:.0f} ms')
+
+    for name, items in (('break after 15 items, page_size 10', aws_service.scan('user', page_size=10)),
+                        ('limit 25', aws_service.scan('user', limit=25))):
+        before = resource.stats['round_trips']
+        for count, _ in enumerate(items, 1):
+            if count == 15 and 'break' in name:
+                break
+        items.close()
+        print(f'{name}: {resource.stats["round_trips"] - before} DynamoDB calls')
+
+    resource.latency = 0
+    streamed = peak_kb(lambda: sum(1 for _ in aws_service.scan('user')))
+    collected = peak_kb(lambda: len(list(aws_service.scan('user'))))
+    print(f'peak memory counting {args.users} users: streamed {streamed:.0f} KB, collected {collected:.0f} KB')
+
+    aws_service.use_dynamo_resource(None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dispatcher
+from services import aws_service, metrics, ratelimit
+from services.local_aws import LocalDynamoResource, LocalSES
+from benchmarks.endpoint_benchmark import ROUTE_EVENTS, seed
+
+"""
+Rate Limit Check
+Drives request_dispatcher against the local AWS stand-in and checks services.ratelimit:
+1. One client hammering GET /match gets its burst, then 429 with Retry-After, and the
+    rejected requests make no DynamoDB call. Another client is not affected.
+2. The same client spread over --containers containers (the local buckets are reset between
+    them): without the shared table it gets the burst of every container, with
+    RATE_LIMIT_SHARED it gets the budget of one window in total.
+3. The cost of def admit.
+
+    python benchmarks/ratelimit_check.py --requests 100 --containers 4
+"""
+
+
+def hammer(event: dict, requests: int, resource: LocalDynamoResource) -> dict:
+    counts = {'admitted': 0, 'rejected': 0, 'rejected_round_trips': 0, 'retry_after': None}
+    for _ in range(requests):
+        before = resource.stats['round_trips']
+        response = dispatcher.request_dispatcher(dict(event), None)
+        if response['statusCode'] == 429:
+            counts['rejected'] += 1
+            counts['rejected_round_trips'] += resource.stats['round_trips'] - before
+            counts['retry_after'] = response['headers']['Retry-After']
+        else:
+            assert response['statusCode'] == 200, response
+            counts['admitted'] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--containers', type=int, default=4)
+    args = parser.parse_args()
+
+    metrics.EMIT_RECORDS = False
+    resource = LocalDynamoResource()
+    aws_service.use_dynamo_resource(resource)
+    aws_service.use_client('ses', LocalSES())
+    context = seed(50)
+    route = ('/match', 'GET')
+    burst, rate, _ = ratelimit.ROUTE_BUDGETS[route]
+
+    ratelimit.reset()
+    counts = hammer(ROUTE_EVENTS[route](context, 0), args.requests, resource)
+    print(f'one client, {args.requests} x GET /match: {counts["admitted"]} admitted (burst {burst}), '
+          f'{counts["rejected"]} rejected with Retry-After {counts["retry_after"]}s, '
+          f'{counts["rejected_round_trips"]} DynamoDB calls for the rejected requests')
+    other = hammer(ROUTE_EVENTS[route](context, 1), 1, resource)
+    print(f'another client: {other["admitted"]} of 1 admitted')
+
+    for shared in (False, True):
+        ratelimit.SHARED_ENABLED = shared
+        event = ROUTE_EVENTS[route](context, 2 if shared else 3)
+        admitted = 0
+        for _ in range(args.containers):
+            ratelimit.reset()
+            admitted += hammer(event, args.requests // args.containers, resource)['admitted']
+        print(f'one client over {args.containers} containers, shared table {"on" if shared else "off"}: '
+              f'{admitted} admitted (window budget {int(burst + rate * ratelimit.SHARED_WINDOW)})')
+    ratelimit.SHARED_ENABLED = False
+
+    ratelimit.reset()
+    start = time.perf_counter()
+    for i in range(100000):
+        ratelimit.admit(f'user{i % 1000}@mulberry.test', ('/chat', 'GET'))
+    print(f'admit: {(time.perf_counter() - start) * 10:.2f} us per call')
+
+    aws_service.use_dynamo_resource(None)
+    aws_service.use_client('ses', None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import serializer
+
+"""
+Serializer Benchmark
+Encode time and wire size of realistic response bodies: a page of chat messages, a full
+legacy message history and a list of match profiles with Decimal numbers as read from
+DynamoDB. Compared are json.dumps as request_dispatcher used it (plus a Decimal default,
+without which these bodies fail), the json fallback of services.serializer, and orjson.
+
+    python benchmarks/serializer_benchmark.py --repeat 2000
+"""
+
+WORDS = ('hey how are you doing today want to grab coffee this weekend maybe the park '
+         'sounds great see you there haha sure thing').split()
+
+
+def chat_response(messages: int, rng: random.Random) -> dict:
+    return {'status': 'success', 'data': {
+        'messages': [{
+            'sender_email': f'user{i % 2}@mulberry.test',
+            'message': ' '.join(rng.choices(WORDS, k=rng.randint(3, 25))),
+            'timestamp': f'2023-05-{1 + i // 500:02d} {i // 60 % 24:02d}:{i % 60:02d}:00',
+            'seq': f'{1683000000000000000 + i * 1000000:020d}-{rng.getrandbits(32):08x}'
+        } for i in range(messages)],
+        'cursor': {'before': None, 'after': None, 'has_more': messages >= 50}
+    }}
+
+
+def match_response(profiles: int, rng: random.Random) -> dict:
+    return {'status': 'success', 'data': [{
+        'email': f'user{i}@mulberry.test',
+        'name': f'User {i}',
+        'gender': 'female',
+        'location': 'New York',
+        'interest1': rng.choice(WORDS), 'interest2': rng.choice(WORDS), 'interest3': rng.choice(WORDS),
+        'photo': f'https://photos.mulberry.test/{i}.jpg',
+        'age': Decimal(rng.randint(20, 40)),
+        'score': Decimal(rng.randint(1, 6)),
+        'distance_km': Decimal(str(round(rng.random() * 20, 2)))
+    } for i in range(profiles)]}
+
+
+def legacy_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(type(value).__name__)
+
+
+def timed(encode, value, repeat: int) -> tuple:
+    body = encode(value)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encode(value)
+    return (time.perf_counter() - start) / repeat * 1e6, body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(6998)
+    bodies = {
+        'chat page (50)': chat_response(50, rng),
+        'chat history (2000)': chat_response(2000, rng),
+        'match (10 profiles)': match_response(10, rng)
+    }
+    orjson = serializer.orjson
+    encoders = {
+        'json.dumps': lambda value: json.dumps(value, default=legacy_default),
+        'serializer/json': lambda value: json.dumps(value, default=serializer._default, separators=(',', ':'))
+    }
+    if orjson is not None:
+        encoders['serializer/orjson'] = serializer.dumps
+
+    print(f'{"body":<22} {"encoder":<18} {"encode us":>10} {"bytes":>9} {"gzip":>8} {"deflate":>8} '
+          f'{"gzip us":>8}')
+    for name, value in bodies.items():
+        repeat = max(10, args.repeat // (len(json.dumps(value, default=legacy_default)) // 5000 + 1))
+        for encoder_name, encode in encoders.items():
+            micros, body = timed(encode, value, repeat)
+            raw = body.encode()
+            gzip_micros, gzipped = timed(lambda data: serializer.compress(data, 'gzip'), raw, max(10, repeat // 10))
+            deflated = serializer.compress(raw, 'deflate')
+            print(f'{name:<22} {encoder_name:<18} {micros:>10.1f} {len(raw):>9,} {len(gzipped):>8,} '
+                  f'{len(deflated):>8,} {gzip_micros:>8.1f}')
+    print(f'\nbodies under {serializer.COMPRESSION_THRESHOLD:,} bytes are sent uncompressed')
+
+
+if __name__ == '__main__':
+    main()
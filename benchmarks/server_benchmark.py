@@ -0,0 +1,137 @@
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+from services import aws_service, metrics, ratelimit
+from services.local_aws import LocalDynamoResource, LocalSES
+from benchmarks.endpoint_benchmark import ROUTE_EVENTS, percentile, seed
+
+"""
+Server Benchmark
+Starts server.py on a free port against the local AWS stand-in and drives the read routes
+with concurrent HTTP clients, once with keep-alive connections and once with a new connection
+per request. Then it stops the server while requests are in flight, to check that the
+graceful shutdown answers every accepted request.
+
+    python benchmarks/server_benchmark.py --users 200 --clients 16 --requests 200 --latency 2
+"""
+
+READ_ROUTES = [('/user', 'GET'), ('/match', 'GET'), ('/chat', 'GET'), ('/chat/message', 'GET'),
+               ('/activity/{activity_id}', 'GET')]
+
+
+def http_request(event: dict) -> tuple:
+    """(method, target, body, headers) of the HTTP request API Gateway turns into the event"""
+    target = event['path']
+    if event.get('queryStringParameters'):
+        target += '?' + urlencode(event['queryStringParameters'])
+    body = event.get('body')
+    return event['httpMethod'], target, body.encode() if body else None, event.get('headers') or {}
+
+
+def client(port: int, requests: list, keep_alive: bool, latencies: list, failures: list):
+    connection = None
+    for method, target, body, headers in requests:
+        if connection is None:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        start = time.perf_counter()
+        try:
+            connection.request(method, target, body=body, headers=headers)
+            response = connection.getresponse()
+            payload = response.read()
+            if response.status != 200 or json.loads(payload).get('status') != 'success':
+                failures.append((response.status, payload[:200]))
+        except Exception as e:
+            failures.append(e)
+            connection.close()
+            if isinstance(e, ConnectionRefusedError):
+                # the server has stopped
+                break
+            connection = None
+            continue
+        latencies.append((time.perf_counter() - start) * 1000)
+        if not keep_alive or response.getheader('Connection') == 'close':
+            connection.close()
+            connection = None
+    if connection is not None:
+        connection.close()
+
+
+def drive(port: int, context: dict, clients: int, requests: int, keep_alive: bool) -> dict:
+    latencies, failures = [], []
+    threads = []
+    for c in range(clients):
+        calls = [http_request(ROUTE_EVENTS[READ_ROUTES[i % len(READ_ROUTES)]](context, c * requests + i))
+                 for i in range(requests)]
+        threads.append(threading.Thread(target=client, args=(port, calls, keep_alive, latencies, failures)))
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'rps': len(latencies) / elapsed, 'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99), 'failures': failures}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200, help='requests per client')
+    parser.add_argument('--workers', type=int, default=server.WORKERS)
+    parser.add_argument('--latency', type=float, default=2.0, help='injected ms per DynamoDB call')
+    args = parser.parse_args()
+
+    metrics.EMIT_RECORDS = False
+    ratelimit.ENABLED = False
+    resource = LocalDynamoResource()
+    aws_service.use_dynamo_resource(resource)
+    aws_service.use_client('ses', LocalSES())
+    context = seed(args.users)
+    resource.latency = args.latency / 1000
+
+    http_server = server.make_server('127.0.0.1', 0, args.workers)
+    port = http_server.server_address[1]
+    serving = threading.Thread(target=http_server.serve_forever)
+    serving.start()
+
+    print(f'{"connections":<12} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"failures":>9}')
+    for keep_alive in (True, False):
+        result = drive(port, context, args.clients, args.requests, keep_alive)
+        print(f'{"keep-alive" if keep_alive else "new":<12} {result["rps"]:>8.0f} {result["p50"]:>8.2f} '
+              f'{result["p99"]:>8.2f} {len(result["failures"]):>9}')
+
+    # stop while every client has requests in flight
+    latencies, failures = [], []
+    threads = [threading.Thread(target=client, args=(
+        port, [http_request(ROUTE_EVENTS[('/match', 'GET')](context, c * 1000 + i)) for i in range(1000)],
+        True, latencies, failures)) for c in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    start = time.perf_counter()
+    http_server.stop()
+    serving.join()
+    http_server.server_close()
+    stopped = (time.perf_counter() - start) * 1000
+    for thread in threads:
+        thread.join()
+    refused = [failure for failure in failures if isinstance(failure, ConnectionError)]
+    print(f'\nshutdown with {args.clients} busy clients: {stopped:.0f} ms, {len(latencies)} answered, '
+          f'{len(failures) - len(refused)} failed in flight, {len(refused)} clients refused after the stop')
+
+    aws_service.use_dynamo_resource(None)
+    aws_service.use_client('ses', None)
+
+
+if __name__ == '__main__':
+    main()
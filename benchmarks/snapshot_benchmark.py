@@ -0,0 +1,131 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import match
+from services import aws_service, matchhelper, metrics, snapshot
+from services.local_aws import LocalDynamoResource, LocalS3
+from benchmarks.match_batch_benchmark import synthetic_users
+
+"""
+User Snapshot Benchmark
+1. Size of the user snapshot file (see services/snapshot.py) per 100k users, the time to
+    encode it and to map it, and the latency of scoring one user against it.
+2. match.make_new_match against the local AWS stand-in with --latency ms injected into every
+    DynamoDB call, scored from the candidate index and from the snapshot: both must give the
+    same records, the DynamoDB calls and the latency per call are reported.
+3. The refresh from S3: the snapshot is downloaded again only when its ETag changed.
+
+    python benchmarks/snapshot_benchmark.py --sizes 100000 1000000 --users 5000 --latency 5
+"""
+
+
+def percentile(samples: list, share: float) -> float:
+    return sorted(samples)[min(len(samples) - 1, int(len(samples) * share))]
+
+
+def size_and_scoring(count: int, samples: int, directory: str) -> dict:
+    users = synthetic_users(count)
+    start = time.perf_counter()
+    path = snapshot.write(users, os.path.join(directory, f'users-{count}.bin'))
+    encoded = time.perf_counter()
+    users_snapshot = snapshot.Snapshot(path)
+    mapped = time.perf_counter()
+
+    seekers = [u for u in users if u['status'] == 'ACTIVE'][:samples]
+    latencies = []
+    for user in seekers:
+        start_score = time.perf_counter()
+        users_snapshot.match_record(user)
+        latencies.append((time.perf_counter() - start_score) * 1000)
+    size = os.path.getsize(path)
+    return {
+        'users': count,
+        'bytes': size,
+        'bytes_per_100k': size * 100000 / count,
+        'encode_s': encoded - start,
+        'map_ms': (mapped - encoded) * 1000,
+        'score_p50_ms': statistics.median(latencies),
+        'score_p99_ms': percentile(latencies, 0.99)
+    }
+
+
+def make_new_match(email: str, resource: LocalDynamoResource) -> tuple:
+    before = resource.stats['round_trips']
+    start = time.perf_counter()
+    record = match.make_new_match(email)
+    return record, (time.perf_counter() - start) * 1000, resource.stats['round_trips'] - before
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000])
+    parser.add_argument('--samples', type=int, default=200, help='users scored per size')
+    parser.add_argument('--users', type=int, default=5000, help='users in the local table')
+    parser.add_argument('--latency', type=float, default=5.0, help='injected ms per DynamoDB call')
+    args = parser.parse_args()
+
+    metrics.EMIT_RECORDS = False
+    directory = tempfile.mkdtemp(prefix='mulberry-snapshot-')
+    snapshot.SNAPSHOT_DIR = directory
+
+    print(f'{"users":>9} {"file MB":>8} {"MB/100k":>8} {"encode s":>9} {"map ms":>7} '
+          f'{"score p50 ms":>13} {"score p99 ms":>13}')
+    for count in args.sizes:
+        result = size_and_scoring(count, args.samples, directory)
+        print(f'{result["users"]:>9} {result["bytes"] / 2 ** 20:>8.2f} {result["bytes_per_100k"] / 2 ** 20:>8.2f} '
+              f'{result["encode_s"]:>9.2f} {result["map_ms"]:>7.2f} {result["score_p50_ms"]:>13.2f} '
+              f'{result["score_p99_ms"]:>13.2f}')
+
+    resource = LocalDynamoResource()
+    aws_service.use_dynamo_resource(resource)
+    s3 = LocalS3()
+    aws_service.use_client('s3', s3)
+    snapshot.SNAPSHOT_BUCKET = 'mulberry-snapshots'
+    users = synthetic_users(args.users)
+    with aws_service.dynamo_client_factory('user').batch_writer() as batch:
+        for user in users:
+            batch.put_item(Item=user)
+    matchhelper.rebuild_candidate_index()
+    resource.latency = args.latency / 1000
+    seekers = [u['email'] for u in users if u['status'] == 'ACTIVE'][:min(args.samples, 50)]
+
+    results = {}
+    for enabled in (False, True):
+        snapshot.ENABLED = enabled
+        snapshot.reset()
+        if enabled:
+            snapshot.publish(users)
+            snapshot.refresh()
+        results[enabled] = [make_new_match(email, resource) for email in seekers]
+    mismatches = sum(index[0] != snapped[0] for index, snapped in zip(results[False], results[True]))
+    print(f'\nmake_new_match over {args.users} users, {args.latency:g} ms per DynamoDB call, '
+          f'{len(seekers)} users, {mismatches} records differ')
+    for enabled, name in ((False, 'candidate index'), (True, 'snapshot')):
+        print(f'  {name:<16} {statistics.median(r[1] for r in results[enabled]):>8.2f} ms '
+              f'{statistics.mean(r[2] for r in results[enabled]):>6.1f} DynamoDB calls')
+
+    snapshot.reset()
+    downloads = s3.downloads
+    first = snapshot.refresh()
+    unchanged = snapshot.refresh()
+    users[0]['location'] = 'Somewhere Else'
+    snapshot.publish(users)
+    changed = snapshot.refresh()
+    print(f'\nS3 refresh: {s3.downloads - downloads} downloads for 3 checks, unchanged kept: {first is unchanged}, '
+          f'changed reloaded: {changed is not first}')
+    snapshot.SNAPSHOT_BUCKET = None
+    snapshot.ENABLED = False
+    snapshot.reset()
+
+    aws_service.use_dynamo_resource(None)
+    aws_service.use_client('s3', None)
+
+
+if __name__ == '__main__':
+    main()
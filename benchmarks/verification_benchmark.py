@@ -0,0 +1,88 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import aws_service, userhelper
+from services.local_aws import LocalDynamoResource
+
+"""
+Verification Benchmark
+verification_code_verifier against cache tables of growing size, compared with the former
+scan based cleanup (here reading every page, which the original did not). Reported per
+verification: latency with the injected per-call latency, DynamoDB calls, and the items
+DynamoDB had to evaluate, which is what a scan is billed and throttled on.
+
+    python benchmarks/verification_benchmark.py --sizes 1000 10000 100000 --latency 2
+"""
+
+
+def legacy_verifier(code: str) -> str or None:
+    cache = aws_service.dynamo_client_factory(userhelper.CACHE_DYNAMO_NAME)
+    res = cache.get_item(Key={'key': code}).get('Item')
+    if res is not None:
+        res = res.get('email')
+        scan = {
+            'FilterExpression': '#email = :email AND #purpose = :purpose',
+            'ExpressionAttributeNames': {'#email': 'email', '#purpose': 'purpose'},
+            'ExpressionAttributeValues': {':email': res, ':purpose': 'email_verification'}
+        }
+        with cache.batch_writer() as batch:
+            while True:
+                response = cache.scan(**scan)
+                for item in response['Items']:
+                    batch.delete_item(Key={'key': item['key']})
+                if 'LastEvaluatedKey' not in response:
+                    break
+                scan['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return res
+
+
+def fill(size: int):
+    # a handful of codes per user, as left behind by signups and resends
+    cache = aws_service.dynamo_client_factory(userhelper.CACHE_DYNAMO_NAME)
+    for i in range(size):
+        cache.put_item(Item={'key': f'FILLER{i:010d}', 'email': f'user{i // 3}@mulberry.test',
+                             'purpose': userhelper.VERIFICATION_PURPOSE,
+                             'expires_at': int(time.time()) + userhelper.VERIFICATION_CODE_LIFETIME})
+
+
+def measure(resource: LocalDynamoResource, verifier, verifications: int) -> dict:
+    samples = {'latency': [], 'calls': [], 'evaluated': []}
+    for i in range(verifications):
+        email = f'verify{i}-{time.time_ns()}@mulberry.test'
+        codes = [userhelper.verification_link_generator(email).split('/')[-1] for _ in range(3)]
+        resource.reset_stats()
+        start = time.perf_counter()
+        assert verifier(codes[-1]) == email
+        samples['latency'].append((time.perf_counter() - start) * 1000)
+        samples['calls'].append(resource.stats['round_trips'])
+        samples['evaluated'].append(resource.stats['items_evaluated'])
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--verifications', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=2.0, help='injected ms per DynamoDB call')
+    args = parser.parse_args()
+
+    print(f'{"cache items":>12} {"":>8} {"ms":>9} {"calls":>6} {"evaluated":>10}')
+    for size in args.sizes:
+        resource = LocalDynamoResource()
+        aws_service.use_dynamo_resource(resource)
+        fill(size)
+        resource.latency = args.latency / 1000
+        for name, verifier in (('scan', legacy_verifier), ('query', userhelper.verification_code_verifier)):
+            result = measure(resource, verifier, args.verifications)
+            print(f'{size:>12,} {name:>8} {result["latency"]:>9.1f} {result["calls"]:>6.0f} '
+                  f'{result["evaluated"]:>10,.0f}')
+    aws_service.use_dynamo_resource(None)
+
+
+if __name__ == '__main__':
+    main()
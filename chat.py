@@ -1,14 +1,25 @@
+import base64
 import json
+import math
 import logging
+import time
+import uuid
 
 import activity
-from services import aws_service
+from services import aws_service, fanout, repository
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 DELIMITER = '---'
-db = aws_service.dynamo_client_factory("message")
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+ACTIVITY_SENDER = '0'
+db = aws_service.lazy_table("message")
+message_db = aws_service.lazy_table("message_item")
+summary_db = aws_service.lazy_table("chat_summary")
+SUMMARY_INDEX = 'email-last_seq-index'
+UNREAD_TOTAL = '#unread'
 
 """
 Message Architecture
@@ -16,37 +27,92 @@ In the DynamoDB table 'message', every data entity has a 'key' as partition key.
 
 The key is a string but will have two formats:
 1. '{email}'
-    We name it message_user_key.
-    This entity will contain all the message_keys for this user.
+    We name it message_user_key. This entity is legacy: it lists all the message_keys of
+    this user as they were before the conversation summaries existed, nothing maintains it
+    any more and only def migrate_conversation_summaries reads it.
     For example,
     { 'key': '1@1.1', 'message_history_keys': [
-        '1@1.1---2@2.2', 
+        '1@1.1---2@2.2',
         '1@1.1---14@14.14'
     ] }
-    Each value in 'message_history_keys' will map to a message history between two users.
-    Thus, if we want to find all the message history that has 1@1.1 involved, we need to
-    iterate the 'keys' list.
+    Each value in 'message_history_keys' maps to a message history between two users.
 
 2. '{email-1}---{email-2}'
     We name it message_history_key.
-    This key is used to locate the entire message history between email-1 and email-2.
+    This key is used to locate the message history entity between email-1 and email-2.
     For example,
-    { 
-        'key': '1@1.1---2@2.2', 
+    {
+        'key': '1@1.1---2@2.2',
         '1@1.1': True,
         '2@2.2': False,
-        'messages': [
-            {'sender_email':'1@1.1', 'message': 'Hi', 'timestamp': '2023-05-01 12:00:00},
-            {'sender_email':'2@2.2', 'message': 'Hello!', 'timestamp': '2023-05-01 12:30:00}
-    ]}
-    This entity also contains the is_read value for either email.
+        'speakers': {'1@1.1', '2@2.2'},
+        'activity_created': True
+    }
+    This entity contains the is_read value for either email, the set of users who have
+    sent a message in this conversation and whether an activity was offered to them.
+    send_message changes it with a single update_item, so concurrent senders never
+    overwrite each other.
+
+The messages themselves are stored one item per message in the DynamoDB table 'message_item',
+with the message_history_key as partition key 'conversation' and a time ordered sort key 'seq'.
+    For example,
+    { 'conversation': '1@1.1---2@2.2', 'seq': '01683000000000000000-1a2b3c4d',
+      'sender_email': '1@1.1', 'message': 'Hi', 'timestamp': '2023-05-01 12:00:00' }
+    Sending a message is a single put whatever the history length, and a page of the
+    history is a single query on 'seq'.
+
+Legacy history entities keep all their messages in a 'messages' list. The list is moved to
+'message_item' by def migrate_message_history the first time the entity is read, and
+def migrate_message_histories migrates every remaining entity at once (the
+'message_histories' migration, see migrate.py).
+
+Conversation Summary Architecture
+In the DynamoDB table 'chat_summary', every data entity has an 'email' as partition key and a
+'partner_email' as sort key. It holds everything GET /chat shows for one conversation of a user.
+    For example,
+    { 'email': '1@1.1', 'partner_email': '2@2.2', 'partner_name': 'Bob',
+      'last_message': 'Hello!', 'last_timestamp': '2023-05-01 12:30:00',
+      'last_seq': '01683000000000000000-1a2b3c4d', 'read': False,
+      'unread': 2, 'last_read_seq': '01682000000000000000-9f8e7d6c' }
+    The global secondary index 'email-last_seq-index' ('email' as partition key, 'last_seq' as
+    sort key) returns the conversations of a user ordered by recency in a single query.
+    send_message updates the summaries of both users and get_messages marks the reader's
+    summary as read. def migrate_conversation_summaries backfills the summaries of the
+    conversations listed in the message_user entities, GET /chat misses the older
+    conversations until it ran (the 'conversation_summaries' migration, see migrate.py).
+
+Read State
+The read state of a user lives in small records, changed with update_item only, so reading
+a conversation never writes its history:
+1. 'unread' of a summary counts the messages received since the user last read the
+    conversation, 'last_read_seq' is the 'last_seq' at that time.
+2. The summary with partner_email '#unread' (UNREAD_TOTAL) holds the user's totals:
+    { 'email': '1@1.1', 'partner_email': '#unread', 'unread': 5, 'conversations': 2 }
+    Every change of a conversation's counter is added to it (def update_unread_total), so
+    GET /chat/unread is a single get_item. It has no 'last_seq', so the recency index never
+    shows it. def recount_unread rebuilds it from the summaries, GET /chat/unread does so
+    when it is missing and def migrate_unread_totals for every user (the 'unread_totals'
+    migration).
+
+Delta Sync
+Clients poll GET /chat and GET /chat/message, and most polls find nothing new.
+1. Both responses carry an 'etag': the newest 'last_seq' of the user's conversations for
+    GET /chat, and the 'last_seq' of the conversation for GET /chat/message. A request
+    sending it back, as If-None-Match header or 'etag' query parameter, gets
+    { 'status': 'success', 'not_modified': True, 'etag': ... } after a single read of the
+    summaries, without reading any message.
+2. A 'since' query parameter, a 'seq' or a Unix timestamp in seconds, restricts the
+    response to newer messages (GET /chat/message) or to the conversations with newer
+    messages (GET /chat). The read flag of a conversation only changes when its user reads
+    it, so it does not need a version of its own.
 
 Note:
 0. We use DELIMITER const var for the connection of two emails. In this case, it's '---'.
 1. Use def message_history_key_generator to get the valid message_history_key. Enforcing use this
     function to get the key will ensure we can locate the right message history.
-2. Use def get_by_user_key(message_user_key) to get the list of message_history_key.
-3. Use def get_by_history_key(message_history_key) to get the list of messages between users.
+2. Use def get_by_history_key(message_history_key) to get the message history entity.
+3. Use def get_message_page(message_history_key) to get a page of messages between users.
+4. Use def update_conversation_summaries whenever a message is added to a conversation.
 """
 
 
@@ -57,11 +123,9 @@ def message_history_key_generator(email1: str, email2: str) -> str:
         return f'{email2}{DELIMITER}{email1}'
 
 
-def get_by_user_key(message_user_key: str) -> dict:
-    entity = db.get_item(Key={'key': message_user_key}).get('Item')
-    if entity is None:
-        entity = {'key': message_user_key, 'message_history_keys': []}
-    return entity
+def message_sequence_generator() -> str:
+    # nanosecond timestamp first, so the sort key orders the messages by time
+    return f'{time.time_ns():020d}-{uuid.uuid4().hex[:8]}'
 
 
 def get_by_history_key(message_history_key: str) -> dict:
@@ -70,16 +134,294 @@ def get_by_history_key(message_history_key: str) -> dict:
         entity = {
             'key': message_history_key,
             message_history_key.split(DELIMITER)[0]: False,
-            message_history_key.split(DELIMITER)[1]: False,
-            'messages': []}
+            message_history_key.split(DELIMITER)[1]: False}
+    elif 'messages' in entity:
+        entity = migrate_message_history(entity)
     return entity
 
 
-def update_message_user_entity(email: str, message_history_key: str):
-    user_msg_entity = get_by_user_key(email)
-    if message_history_key not in user_msg_entity['message_history_keys']:
-        user_msg_entity['message_history_keys'].append(message_history_key)
-        db.put_item(Item=user_msg_entity)
+def put_message(message_history_key: str, message: dict) -> dict:
+    item = dict(message, conversation=message_history_key, seq=message_sequence_generator())
+    message_db.put_item(Item=item)
+    return item
+
+
+def get_message_page(message_history_key: str, limit: int = DEFAULT_PAGE_SIZE,
+                     before: str = None, after: str = None) -> tuple:
+    """
+    Return (messages, has_more) for one page of the history, ordered from old to new.
+    With 'after', the page holds the oldest messages newer than that cursor. Otherwise it
+    holds the newest messages older than 'before', or the newest messages overall.
+    has_more tells whether more messages exist in the direction of the page.
+    """
+    query = {
+        'KeyConditionExpression': '#conversation = :conversation',
+        'ExpressionAttributeNames': {'#conversation': 'conversation'},
+        'ExpressionAttributeValues': {':conversation': message_history_key},
+        'ScanIndexForward': after is not None,
+        'Limit': limit
+    }
+    cursor = after if after is not None else before
+    if cursor is not None:
+        query['KeyConditionExpression'] += ' AND #seq > :seq' if after is not None else ' AND #seq < :seq'
+        query['ExpressionAttributeNames']['#seq'] = 'seq'
+        query['ExpressionAttributeValues'][':seq'] = cursor
+
+    response = repository.query('message_item', **query)
+    messages = response['Items']
+    if after is None:
+        messages.reverse()
+    for message in messages:
+        message.pop('conversation', None)
+    return messages, 'LastEvaluatedKey' in response
+
+
+def migrate_message_history(entity: dict) -> dict:
+    """Move the legacy 'messages' list of a history entity into per-message items"""
+    messages = entity.pop('messages')
+    speakers = set()
+    with message_db.batch_writer() as batch:
+        for index, message in enumerate(messages):
+            # legacy messages are older than any new message, keep their original order
+            batch.put_item(Item=dict(message, conversation=entity['key'], seq=f'{0:020d}-{index:08d}'))
+            if message['sender_email'] != ACTIVITY_SENDER:
+                speakers.add(message['sender_email'])
+    if speakers:
+        entity['speakers'] = speakers
+    db.put_item(Item=entity)
+    logger.info('Migrated %s messages of %s', len(messages), entity['key'])
+    return entity
+
+
+def migrate_message_histories():
+    for entity in aws_service.scan('message', FilterExpression='attribute_exists(#messages)',
+                                   ExpressionAttributeNames={'#messages': 'messages'}):
+        migrate_message_history(entity)
+
+
+def record_message_sent(message_history_key: str, sender_email: str, receiver_email: str) -> dict:
+    """Set the read flags and add the sender to the speakers in one round trip"""
+    update = {
+        'Key': {'key': message_history_key},
+        'UpdateExpression': 'SET #sender = :true, #receiver = :false ADD #speakers :speaker',
+        'ConditionExpression': 'attribute_not_exists(#messages)',
+        'ExpressionAttributeNames': {'#sender': sender_email, '#receiver': receiver_email,
+                                     '#speakers': 'speakers', '#messages': 'messages'},
+        'ExpressionAttributeValues': {':true': True, ':false': False, ':speaker': {sender_email}},
+        'ReturnValues': 'ALL_NEW'
+    }
+    try:
+        return db.update_item(**update)['Attributes']
+    except Exception as e:
+        if not aws_service.is_condition_failure(e):
+            raise
+
+    # a legacy entity still holding the messages list is migrated first
+    get_by_history_key(message_history_key)
+    return db.update_item(**update)['Attributes']
+
+
+def claim_activity(message_history_key: str) -> bool:
+    """Only the first caller for a conversation gets True"""
+    try:
+        db.update_item(
+            Key={'key': message_history_key},
+            UpdateExpression='SET #activity_created = :true',
+            ConditionExpression='attribute_not_exists(#activity_created)',
+            ExpressionAttributeNames={'#activity_created': 'activity_created'},
+            ExpressionAttributeValues={':true': True}
+        )
+        return True
+    except Exception as e:
+        if not aws_service.is_condition_failure(e):
+            raise
+        return False
+
+
+def release_activity(message_history_key: str):
+    """Undo claim_activity, so the next message offers the activity again"""
+    try:
+        db.update_item(
+            Key={'key': message_history_key},
+            UpdateExpression='REMOVE #activity_created',
+            ConditionExpression='attribute_exists(#activity_created)',
+            ExpressionAttributeNames={'#activity_created': 'activity_created'}
+        )
+    except Exception as e:
+        if not aws_service.is_condition_failure(e):
+            raise
+
+
+def summary_unread(summary: dict) -> int:
+    # summaries written before the counter count as one unread message when unread
+    return int(summary.get('unread', 0 if summary.get('read', True) else 1))
+
+
+def update_unread_total(email: str, unread_before: int, unread_after: int):
+    """Add the change of one conversation's unread counter to the user's totals"""
+    messages = unread_after - unread_before
+    conversations = (unread_after > 0) - (unread_before > 0)
+    if messages == 0 and conversations == 0:
+        return
+    summary_db.update_item(
+        Key={'email': email, 'partner_email': UNREAD_TOTAL},
+        UpdateExpression='ADD #unread :messages, #conversations :conversations',
+        ExpressionAttributeNames={'#unread': 'unread', '#conversations': 'conversations'},
+        ExpressionAttributeValues={':messages': messages, ':conversations': conversations}
+    )
+
+
+def update_conversation_summary(email: str, partner_email: str, message: dict, read: bool) -> dict or None:
+    """
+    Show the message in the summary of email, as read by its sender and unread by its receiver.
+    Return the summary as it was before, or None if it already shows a newer message.
+    """
+    update = {
+        'Key': {'email': email, 'partner_email': partner_email},
+        'UpdateExpression': 'SET #last_message = :message, #last_timestamp = :timestamp, '
+                            '#last_seq = :seq, #read = :read',
+        # never let a delayed update overwrite a newer message
+        'ConditionExpression': 'attribute_not_exists(#last_seq) OR #last_seq < :seq',
+        'ExpressionAttributeNames': {'#last_message': 'last_message', '#last_timestamp': 'last_timestamp',
+                                     '#last_seq': 'last_seq', '#read': 'read', '#unread': 'unread'},
+        'ExpressionAttributeValues': {':message': message['message'], ':timestamp': message.get('timestamp'),
+                                      ':seq': message['seq'], ':read': read},
+        'ReturnValues': 'ALL_OLD'
+    }
+    if read:
+        # sending a message reads the conversation up to it
+        update['UpdateExpression'] += ', #unread = :zero, #last_read_seq = :seq'
+        update['ExpressionAttributeNames']['#last_read_seq'] = 'last_read_seq'
+        update['ExpressionAttributeValues'][':zero'] = 0
+    else:
+        update['UpdateExpression'] += ' ADD #unread :one'
+        update['ExpressionAttributeValues'][':one'] = 1
+
+    try:
+        summary = summary_db.update_item(**update).get('Attributes', {})
+        update_unread_total(email, summary_unread(summary), 0 if read else int(summary.get('unread', 0)) + 1)
+        return dict(summary, email=email, partner_email=partner_email)
+    except Exception as e:
+        if not aws_service.is_condition_failure(e):
+            raise
+    if not read:
+        # a newer message is shown already, this one still has to be counted
+        unread = summary_db.update_item(
+            Key=update['Key'],
+            UpdateExpression='ADD #unread :one',
+            ExpressionAttributeNames={'#unread': 'unread'},
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_OLD'
+        ).get('Attributes', {}).get('unread', 0)
+        update_unread_total(email, int(unread), int(unread) + 1)
+    return None
+
+
+def set_partner_name(summary: dict, name: str or None):
+    summary_db.update_item(
+        Key={'email': summary['email'], 'partner_email': summary['partner_email']},
+        UpdateExpression='SET #partner_name = :name',
+        ExpressionAttributeNames={'#partner_name': 'partner_name'},
+        ExpressionAttributeValues={':name': name}
+    )
+
+
+def update_conversation_summaries(sender_email: str, receiver_email: str, message: dict):
+    # the summaries of both users are independent, they are updated concurrently
+    summaries = fanout.run((update_conversation_summary, sender_email, receiver_email, message, True),
+                           (update_conversation_summary, receiver_email, sender_email, message, False))
+
+    # The partner names are only looked up once, when the conversation starts
+    unnamed = [summary for summary in summaries if summary is not None and 'partner_name' not in summary]
+    partners = repository.get_users([summary['partner_email'] for summary in unnamed], repository.USER_NAME)
+    fanout.run(*[(set_partner_name, summary, (partner or {}).get('name'))
+                 for summary, partner in zip(unnamed, partners)])
+
+
+def mark_conversation_read(email: str, partner_email: str):
+    try:
+        summary = summary_db.update_item(
+            Key={'email': email, 'partner_email': partner_email},
+            UpdateExpression='SET #read = :read, #unread = :zero, #last_read_seq = #last_seq',
+            ConditionExpression='attribute_exists(#email)',
+            ExpressionAttributeNames={'#read': 'read', '#email': 'email', '#unread': 'unread',
+                                      '#last_read_seq': 'last_read_seq', '#last_seq': 'last_seq'},
+            ExpressionAttributeValues={':read': True, ':zero': 0},
+            ReturnValues='UPDATED_OLD'
+        ).get('Attributes', {})
+    except Exception as e:
+        if not aws_service.is_condition_failure(e):
+            raise
+        return
+    update_unread_total(email, summary_unread(summary), 0)
+
+
+def recount_unread(email: str) -> dict:
+    """Rebuild the unread totals of the user from the summaries"""
+    summaries = repository.query_items('chat_summary', ['read', 'unread'],
+                                       KeyConditionExpression='#email = :email',
+                                       ExpressionAttributeNames={'#email': 'email'},
+                                       ExpressionAttributeValues={':email': email})
+    counters = [summary_unread(summary) for summary in summaries if summary['partner_email'] != UNREAD_TOTAL]
+
+    total = {'email': email, 'partner_email': UNREAD_TOTAL, 'unread': sum(counters),
+             'conversations': sum(1 for unread in counters if unread > 0)}
+    summary_db.put_item(Item=total)
+    return total
+
+
+def migrate_unread_totals():
+    emails = {summary['email'] for summary in aws_service.scan('chat_summary', projection=['email'])}
+    for email in emails:
+        recount_unread(email)
+    logger.info('Recounted the unread messages of %s users', len(emails))
+
+
+def migrate_conversation_summaries():
+    user_msg_entities = aws_service.scan('message', FilterExpression='attribute_exists(#message_history_keys)',
+                                         ExpressionAttributeNames={'#message_history_keys': 'message_history_keys'})
+    for user_msg_entity in user_msg_entities:
+        email = user_msg_entity['key']
+        for history_key in user_msg_entity['message_history_keys']:
+            message_history_entity = get_by_history_key(history_key)
+            messages = get_message_page(history_key, limit=1)[0]
+            if not messages:
+                continue
+            another_email = get_another_user_by_history_key(history_key, email)
+            summary = {
+                'email': email,
+                'partner_email': another_email,
+                'partner_name': (repository.get_user(another_email, repository.USER_NAME) or {}).get('name'),
+                'last_message': messages[-1]['message'],
+                'last_timestamp': messages[-1].get('timestamp'),
+                'last_seq': messages[-1]['seq'],
+                'read': message_history_entity.get(email, False)
+            }
+            try:
+                # a summary written since the deployment is newer than the backfill
+                summary_db.put_item(Item=summary, ConditionExpression='attribute_not_exists(#email)',
+                                    ExpressionAttributeNames={'#email': 'email'})
+            except Exception as e:
+                if not aws_service.is_condition_failure(e):
+                    raise
+
+
+def encode_cursor(key: dict or None) -> str or None:
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str, email: str) -> dict:
+    """The summary key in the cursor, raises ValueError unless it is a key of the user's list"""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f'Malformed cursor - {cursor}') from e
+    if not isinstance(key, dict) or set(key) != {'email', 'partner_email', 'last_seq'} \
+            or not all(isinstance(value, str) for value in key.values()) or key['email'] != email:
+        raise ValueError(f'Invalid cursor - {cursor}')
+    return key
 
 
 def get_another_user_by_history_key(message_history_key: str, current_email: str) -> str:
@@ -88,115 +430,231 @@ def get_another_user_by_history_key(message_history_key: str, current_email: str
     return emails[0]
 
 
+def request_etag(event: dict) -> str or None:
+    """The etag the client already holds, from If-None-Match or the 'etag' query parameter"""
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'if-none-match' and value:
+            value = value.strip()
+            return (value[2:] if value.startswith('W/') else value).strip('"')
+    return (event.get('queryStringParameters') or {}).get('etag')
+
+
+def since_cursor(since: str or None) -> str or None:
+    """Turn a 'since' parameter into a 'seq' cursor, a timestamp becomes a 'seq' prefix.
+    Raises ValueError when it is neither."""
+    if since is None or '-' in since:
+        return since
+    seconds = float(since)
+    if not math.isfinite(seconds) or seconds < 0:
+        raise ValueError(f'Invalid timestamp - {since}')
+    return f'{int(seconds * 1_000_000_000):020d}'
+
+
+def page_limit(limit: str or None) -> int:
+    """The page size of a 'limit' parameter, at most MAX_PAGE_SIZE.
+    Raises ValueError unless it is a positive integer."""
+    if limit is None or limit == '':
+        return DEFAULT_PAGE_SIZE
+    if int(limit) < 1:
+        raise ValueError(f'Invalid limit - {limit}')
+    return min(int(limit), MAX_PAGE_SIZE)
+
+
+def not_modified(etag: str) -> dict:
+    return {'status': 'success', 'not_modified': True, 'etag': etag}
+
+
 def get_chat_list(event):
     logger.info('get_chat_list')
-    user_db = aws_service.dynamo_client_factory('user')
     email = event['email']
-    data = []
-
-    message_history_keys = get_by_user_key(email)['message_history_keys']
-
-    # Iterate all message history of this user and collect the last message info
-    for history_key in message_history_keys:
-        message_history_entity = get_by_history_key(history_key)
-        another_email = get_another_user_by_history_key(history_key, email)
-        data.append({
-            'email': another_email,
-            'name': user_db.get_item(Key={'email': another_email}).get('Item', {}).get('name'),
-            'message': message_history_entity['messages'][-1]['message'],
-            'read': message_history_entity[email],
-            'timestamp': message_history_entity['messages'][-1]['timestamp']
-        })
+    params = event.get('queryStringParameters') or {}
+
+    # The conversation summaries are read from the recency index, newest first
+    query = {
+        'IndexName': SUMMARY_INDEX,
+        'KeyConditionExpression': '#email = :email',
+        'ExpressionAttributeNames': {'#email': 'email'},
+        'ExpressionAttributeValues': {':email': email},
+        'ScanIndexForward': False
+    }
+
+    # the newest conversation tells whether anything changed since the client's etag
+    etag, client_etag = None, request_etag(event)
+    if client_etag is not None:
+        newest = repository.query('chat_summary', ['last_seq'], **query, Limit=1)['Items']
+        etag = newest[0]['last_seq'] if newest else None
+        if etag == client_etag:
+            return not_modified(etag)
+
+    try:
+        since = since_cursor(params.get('since'))
+    except ValueError:
+        return {'status': 'fail', 'message': 'since must be a seq or a Unix timestamp'}
+    if since is not None:
+        query['KeyConditionExpression'] += ' AND #last_seq > :since'
+        query['ExpressionAttributeNames']['#last_seq'] = 'last_seq'
+        query['ExpressionAttributeValues'][':since'] = since
+    paginated = params.get('limit') is not None
+    if paginated:
+        try:
+            query['Limit'] = page_limit(params['limit'])
+        except ValueError:
+            return {'status': 'fail', 'message': 'limit must be a positive integer'}
+    if params.get('cursor') is not None:
+        try:
+            query['ExclusiveStartKey'] = decode_cursor(params['cursor'], email)
+        except ValueError:
+            return {'status': 'fail', 'message': 'invalid cursor'}
 
-    return {'status': 'success', 'data': data}
+    if paginated:
+        response = repository.query('chat_summary', **query)
+        summaries = response['Items']
+    else:
+        summaries = list(repository.query_items('chat_summary', **query))
+
+    data = [{
+        'email': summary['partner_email'],
+        'name': summary.get('partner_name'),
+        'message': summary['last_message'],
+        'read': summary['read'],
+        'unread': summary_unread(summary),
+        'timestamp': summary.get('last_timestamp'),
+        'seq': summary['last_seq']
+    } for summary in summaries]
+
+    # the first page of the full list starts at the newest conversation
+    if client_etag is None and summaries and since is None and params.get('cursor') is None:
+        etag = summaries[0]['last_seq']
+
+    if paginated:
+        return {'status': 'success', 'data': data, 'cursor': encode_cursor(response.get('LastEvaluatedKey')),
+                'etag': etag}
+    return {'status': 'success', 'data': data, 'etag': etag}
+
+
+def mark_history_read(message_history_key: str, email: str):
+    """Set the read flag of email alone, instead of writing the whole history entity back"""
+    try:
+        db.update_item(
+            Key={'key': message_history_key},
+            UpdateExpression='SET #email = :true',
+            ConditionExpression='attribute_exists(#key)',
+            ExpressionAttributeNames={'#email': email, '#key': 'key'},
+            ExpressionAttributeValues={':true': True}
+        )
+    except Exception as e:
+        if not aws_service.is_condition_failure(e):
+            raise
 
 
 def get_messages(event):
     logger.info('get_messages')
     email1 = event['email']
-    email2 = event['queryStringParameters']['target_user_email']
-
-    # Get the message history entity
+    params = event['queryStringParameters']
+    email2 = params['target_user_email']
+    try:
+        limit = page_limit(params.get('limit'))
+    except ValueError:
+        return {'status': 'fail', 'message': 'limit must be a positive integer'}
     message_history_key = message_history_key_generator(email1, email2)
-    message_history_entity = get_by_history_key(message_history_key)
-
-    # Update is_read for email1
-    if message_history_entity[email1] is False:
-        message_history_entity[email1] = True
-        db.put_item(Item=message_history_entity)
 
-    return {'status': 'success', 'data': message_history_entity['messages']}
+    # The summary holds the read flag and the version of the conversation
+    summary = repository.get_summary(email1, email2, ['last_seq', 'read', 'last_read_seq'])
+    if summary is None:
+        # conversations without a summary may still hold a legacy messages list
+        message_history_entity = get_by_history_key(message_history_key)
+        etag, read, last_read = None, message_history_entity[email1], None
+    else:
+        etag, read, last_read = summary['last_seq'], summary['read'], summary.get('last_read_seq')
+
+    # Update is_read for email1, concurrently with reading the page
+    mark_read = []
+    if read is False:
+        mark_read = [(mark_history_read, message_history_key, email1), (mark_conversation_read, email1, email2)]
+
+    if etag is not None and etag == request_etag(event):
+        fanout.run(*mark_read)
+        return not_modified(etag)
+
+    # Only one page of the history is read, use the cursor to read older or newer pages
+    try:
+        since = since_cursor(params.get('since'))
+    except ValueError:
+        return {'status': 'fail', 'message': 'since must be a seq or a Unix timestamp'}
+    after = since if since is not None else params.get('after')
+    (messages, has_more), *_ = fanout.run(
+        (get_message_page, message_history_key, limit, params.get('before'), after), *mark_read)
+    cursor = {
+        'before': messages[0]['seq'] if messages else params.get('before'),
+        'after': messages[-1]['seq'] if messages else after,
+        'has_more': has_more
+    }
+    # 'last_read' is where the user stopped reading before this request
+    return {'status': 'success', 'data': messages, 'cursor': cursor, 'etag': etag, 'last_read': last_read}
+
+
+def get_unread_count(event):
+    logger.info('get_unread_count')
+    email = event['email']
+    total = repository.get_summary(email, UNREAD_TOTAL, ['unread', 'conversations'])
+    if total is None:
+        total = recount_unread(email)
+    # concurrent updates may briefly take a total below zero
+    return {'status': 'success', 'data': {'unread': max(0, int(total.get('unread', 0))),
+                                          'conversations': max(0, int(total.get('conversations', 0)))}}
 
 
 def send_message(event):
     logger.info('send_message')
     sender_email = event['email']
     receiver_email = event['path'].split('/')[-1]
+    # the history entity keeps one read flag per user, it cannot hold a conversation with oneself
+    if receiver_email == sender_email:
+        return {'status': 'fail', 'message': 'Cannot send a message to yourself'}
 
     message = json.loads(event['body'])
     message['sender_email'] = sender_email
 
-    # Insert new message
+    # Insert new message, the history flags are updated at the same time
     message_history_key = message_history_key_generator(sender_email, receiver_email)
-    message_history = get_by_history_key(message_history_key)
-    message_history['messages'].append(message)
-    message_history[sender_email] = True
-    message_history[receiver_email] = False
-    db.put_item(Item=message_history)
-
-    # Update message user key: add message_history_key if not in user entity
-    update_message_user_entity(sender_email, message_history_key)
-    update_message_user_entity(receiver_email, message_history_key)
-
-    # check whether already have activity
-    if activity.check_activity(sender_email, receiver_email):
-        return {'status': 'success'}
+    message, message_history = fanout.run(
+        (put_message, message_history_key, message),
+        (record_message_sent, message_history_key, sender_email, receiver_email))
 
-    # whether both talk to each other
-    flag = 0
-    email_t = message_history['messages'][0]['sender_email']
-    for data in message_history['messages']:
-        if data['sender_email'] != email_t:
-            flag = 1
-            break
-
-    # both people send message
-    if flag == 1:
-        # create an activity
-        act_id = 'error'
-        try:
-            act_id = activity.insert_activity(sender_email, receiver_email)
-        except Exception:
-            logger.error('insert message fail for' + sender_email + 'and' + receiver_email)
+    # Update the conversation summary of both users
+    update_conversation_summaries(sender_email, receiver_email, message)
 
-        # store this activity to message db
-        # Insert new message
-        message = json.loads(event['body'])
-        message['sender_email'] = '0'
-        message['message'] = act_id
+    # An activity is offered once, after both people have sent a message
+    if len(message_history['speakers']) < 2 or message_history.get('activity_created'):
+        return {'status': 'success'}
 
-        message_history_key = message_history_key_generator(sender_email, receiver_email)
-        message_history = get_by_history_key(message_history_key)
-        message_history['messages'].append(message)
-        message_history[sender_email] = True
-        message_history[receiver_email] = False
-        db.put_item(Item=message_history)
+    if not claim_activity(message_history_key):
+        return {'status': 'success'}
 
-        # Update message user key: add message_history_key if not in user entity
-        update_message_user_entity(sender_email, message_history_key)
-        update_message_user_entity(receiver_email, message_history_key)
+    # create an activity, conversations created before the flag may already have one
+    try:
+        act_id = activity.insert_activity(sender_email, receiver_email)
+    except Exception as e:
+        logger.error('Creating the activity of %s and %s failed - %r', sender_email, receiver_email, e)
+        release_activity(message_history_key)
+        return {'status': 'success'}
+    if act_id is None:
+        return {'status': 'success'}
 
+    # store this activity to message db
+    message = json.loads(event['body'])
+    message['sender_email'] = ACTIVITY_SENDER
+    message['message'] = act_id
+    message = put_message(message_history_key, message)
+    update_conversation_summaries(sender_email, receiver_email, message)
 
     return {'status': 'success'}
 
 
 function_register = {
     ('/chat', 'GET'): get_chat_list,
+    ('/chat/unread', 'GET'): get_unread_count,
     ('/chat/message', 'GET'): get_messages,
     ('/chat/message/{target_email}', 'POST'): send_message
 }
 
-
-def request_handler(_event):
-    function = function_register[(_event['resource'], _event['httpMethod'])]
-    return function(_event)
@@ -1,90 +1,124 @@
 from services.authentication_service import *
 
-import json
 import logging
 import importlib
 
+from services import dataloader, metrics, ratelimit, serializer
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+"""
+Route Table
+Every (resource, httpMethod) served by API Gateway is mapped to the module holding its handler.
+A module is imported by the first request of one of its routes, and the handler found in its
+function_register is kept in resolved_handlers, so a warm request costs a single dict lookup.
+Handler modules must not create AWS clients at import time (see aws_service.lazy_table).
+"""
+
+ROUTES = {
+    ('/user/signup', 'POST'): 'user',
+    ('/user/login', 'POST'): 'user',
+    ('/user/password', 'PUT'): 'user',
+    ('/user/verify/resend/{email}', 'POST'): 'user',
+    ('/user/verify/{token}', 'POST'): 'user',
+    ('/user', 'GET'): 'user',
+    ('/user/batch', 'POST'): 'user',
+    ('/user', 'PUT'): 'user',
+    ('/user/photo', 'GET'): 'user',
+    ('/match', 'GET'): 'match',
+    ('/chat', 'GET'): 'chat',
+    ('/chat/unread', 'GET'): 'chat',
+    ('/chat/message', 'GET'): 'chat',
+    ('/chat/message/{target_email}', 'POST'): 'chat',
+    ('/activity/{activity_id}', 'GET'): 'activity',
+    ('/activity/status/{activity_id}', 'PUT'): 'activity'
+}
+resolved_handlers = {}
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': '*'
+}
+
+
+def resolve_handler(resource: str, method: str):
+    route = (resource, method)
+    handler = resolved_handlers.get(route)
+    if handler is None:
+        module_name = ROUTES.get(route)
+        if module_name is None:
+            return None
+        handler = importlib.import_module(module_name).function_register[route]
+        resolved_handlers[route] = handler
+    return handler
+
 
 def request_dispatcher(event, context):
-    logger.info('-------------------------')
-    logger.info(event)
+    metrics.start_request()
+    response = None
+    try:
+        response = dispatch(event)
+        return response
+    finally:
+        # items read during this request must not leak into the next one
+        dataloader.clear()
+        metrics.finish_request(event, response)
+
+
+def error_response(status_code: int, body: str, headers: dict = None) -> dict:
+    return {'statusCode': status_code, 'headers': dict(CORS_HEADERS, **(headers or {})),
+            'body': body}
+
+
+def dispatch(event):
+    # full payloads are only logged for a sample of the requests, see services.metrics
+    metrics.log_payload('Request', event)
 
     try:
+        # binary media types (see services.serializer) and server.py send the body base64 encoded
+        if event.get('isBase64Encoded') and event.get('body') is not None:
+            try:
+                event['body'] = serializer.decode_body(event['body'])
+            except ValueError:
+                return error_response(400, '{"status": "fail", "message":"Request body is not valid base64"}')
+            event['isBase64Encoded'] = False
+
         # validate the input token and parse the user email
         event['email'] = parseEmail(event)
 
-        # find the proper module and pass the request to the request handler
-        module_name = None
-        try:
-            # parse the module_name based on resource
-            module_name = event['resource'].split("/")[1]
-            if module_name is None:
-                raise ModuleNotFoundError
-            module = importlib.import_module(module_name)
-        except ModuleNotFoundError:
-            logger.error("Can't find proper request handler: resource - %s, module - %s",
-                         event['resource'], module_name)
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Access-Control-Allow-Headers': 'Content-Type',
-                    'Access-Control-Allow-Origin': '*',
-                    'Access-Control-Allow-Methods': '*'
-                },
-                'body': '{"status": "fail", "message":"No proper handler found for the endpoint"}'
-            }
-
-        handler = module.request_handler
+        # find the proper request handler in the route table
+        handler = resolve_handler(event.get('resource'), event.get('httpMethod'))
+        if handler is None:
+            logger.error("Can't find proper request handler: resource - %s, method - %s",
+                         event.get('resource'), event.get('httpMethod'))
+            return error_response(400, '{"status": "fail", "message":"No proper handler found for the endpoint"}')
+
+        # every client has a budget per route, see services.ratelimit
+        retry_after = ratelimit.admit(ratelimit.client_identity(event), (event['resource'], event['httpMethod']))
+        if retry_after is not None:
+            return error_response(429, '{"status": "fail", "message":"Too many requests"}',
+                                  {'Retry-After': str(retry_after)})
+
         resp = handler(event)
 
-        logger.info('Complete request')
-        logger.info(resp)
-        logger.info('-------------------------')
+        body = serializer.dumps(resp)
+        metrics.log_payload('Response', body)
+        body, headers, is_base64 = serializer.encode_body(body, event.get('headers'))
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': '*'
-            },
-            'body': json.dumps(resp)
+            'headers': dict(CORS_HEADERS, **(headers or {})),
+            'body': body,
+            'isBase64Encoded': is_base64
         }
     except Authentication401Exception:
         logger.error("No token is present")
-        return {
-            'statusCode': 401,
-            'headers': {
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': '*'
-            },
-            'body': '{"status": "fail", "message":"No token is present"}'
-        }
+        return error_response(401, '{"status": "fail", "message":"No token is present"}')
     except Authentication403Exception:
         logger.error("Token is invalid or expires")
-        return {
-            'statusCode': 403,
-            'headers': {
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': '*'
-            },
-            'body': '{"status": "fail", "message":"Token is invalid or expires"}'
-        }
+        return error_response(403, '{"status": "fail", "message":"Token is invalid or expires"}')
     except Exception as e:
         logger.error("Unhandled Exception occurs!")
         logger.exception(e)
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': '*'
-            },
-            'body': '{"status": "fail", "message":"Unhandled Exception occurs"}'
-        }
-    finally:
-        logger.info('-------------------------')
+        return error_response(500, '{"status": "fail", "message":"Unhandled Exception occurs"}')
@@ -1,24 +1,29 @@
 import json
 import logging
 
-from services import aws_service
+from services import aws_service, matchhelper, repository, snapshot, userhelper
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-match_db = aws_service.dynamo_client_factory("match")
+match_db = aws_service.lazy_table("match")
 
 """
 Match Database Architecture
 {
     'email': '1@1.1', 
-    'today': ['2@2.2', '3@3.3']
+    'today': ['2@2.2', '3@3.3'],
+    'scores': {'2@2.2': 4, '3@3.3': 1},
+    'complete': True
 }
-'today' contains all the matching user emails for today.
+'today' contains all the matching user emails for today. 'scores' and 'complete' describe
+the best candidates, see matchhelper for the incremental maintenance.
+Records are kept up to date by matchhelper.update_matches when profiles change; a record
+with an empty 'today' is recomputed on the next read.
 """
 
 
-def make_new_match(email: str) -> list:
+def make_new_match(email: str) -> dict:
     """
     Matching Algorithm:
     1. opposite gender
@@ -29,65 +34,40 @@ def make_new_match(email: str) -> list:
         The same location will gain 3 points;
         The same interest will gain 1 point;
 
-    Only the top-10 potential matched users will be returned.
-    """
-    user_db = aws_service.dynamo_client_factory("user")
-    user = user_db.get_item(Key={'email': email}).get('Item')
-    expected_gender = 'female' if user['gender'] == 'male' else 'male'
-    expected_location = user['location']
-    expected_interest = [user['interest1'], user['interest2'], user['interest3']]
-
-    potential_match = []
-    users = user_db.scan()['Items']
-    for user in users:
-        if user['status'] != 'ACTIVE':
-            continue
-
-        # Filter out not matching gender
-        if user['gender'] != expected_gender:
-            continue
-
-        score = 0
-        if user['location'] == expected_location:
-            score += 3
-        if user['interest1'] in expected_interest:
-            score += 1
-        if user['interest2'] in expected_interest:
-            score += 1
-        if user['interest3'] in expected_interest:
-            score += 1
+    The top-10 potential matched users are kept in 'today' of the returned match record.
 
-        if score == 0:
-            continue
-
-        potential_match.append({'score': score, 'email': user['email']})
+    Candidates are scored against the user snapshot of the container, see
+    services/snapshot.py, or read from the candidate index maintained by matchhelper while
+    the container has no snapshot, see services/matchhelper.py for the index architecture.
+    """
+    # read fresh, new users are not in the snapshot yet and their profile may have just changed
+    user = repository.get_user(email, repository.USER_MATCHING)
 
-    potential_match = sorted(potential_match, key=lambda x: x['score'], reverse=True)
-    return [item['email'] for item in potential_match[:10]]
+    users = snapshot.current()
+    if users is not None:
+        return users.match_record(user)
+    # Only the index partitions of the user's location and interests are read
+    return matchhelper.match_record(email, matchhelper.find_candidates(user))
 
 
 def get_match(event: dict):
     logger.info("get_match")
     email = event['email']
 
-    match_record = match_db.get_item(Key={'email': email}).get('Item')
+    # the scores kept for the incremental maintenance are not needed here
+    match_record = repository.get_match_record(email, ['today'])
 
     # This user has no previous match results
     if match_record is None or len(match_record['today']) == 0:
-        match_record = {
-            'email': email,
-            'today': make_new_match(email)
-        }
+        match_record = make_new_match(email)
         match_db.put_item(Item=match_record)
 
+    # ?hydrate=true returns the public profiles instead of the emails
+    if (event.get('queryStringParameters') or {}).get('hydrate') == 'true':
+        return {'status': 'success', 'data': userhelper.get_public_profiles(match_record['today'])}
     return {'status': 'success', 'data': match_record['today']}
 
 
 function_register = {
     ('/match', 'GET'): get_match
 }
-
-
-def request_handler(_event):
-    function = function_register[(_event['resource'], _event['httpMethod'])]
-    return function(_event)
@@ -0,0 +1,160 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from services import aws_service, matchhelper, repository, snapshot
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+TOP_K = 10
+BLOCK_SIZE = 256
+USER_FIELDS = ['email', 'status', 'gender', 'location', 'interest1', 'interest2', 'interest3']
+SCAN_SEGMENTS = int(os.environ.get('MATCH_BATCH_SCAN_SEGMENTS', 4))
+
+"""
+Batch Matching
+Computes the 'today' list of every ACTIVE user in one pass and writes it to the 'match'
+table, so GET /match is served from the stored record instead of matching lazily.
+
+It should be triggered once a day (e.g. by an EventBridge schedule) with
+    match_batch.batch_match_handler
+
+Scoring follows match.make_new_match: opposite gender only, the same location gains
+3 points and every interest of the candidate found in the user's interests gains 1 point.
+1. The user table is scanned once, reading only the fields needed for scoring, in
+    SCAN_SEGMENTS parallel segments.
+2. gender, location and interest1-3 are dictionary encoded into integer arrays.
+3. Each user is described by a weighted one-hot row [3 * location | interests] and every
+    candidate by [location | interest counts], so the scores of a block of users against
+    all candidates of the expected gender are a single matrix product.
+4. The best matchhelper.MATCH_DEPTH of every row are selected with a partial sort
+    (argpartition) and stored with their scores, 'today' being the top-10 of them.
+5. All records are written through batch_writer.
+6. With snapshot.SNAPSHOT_BUCKET set, the loaded users are published as the user snapshot the
+    containers score make_new_match against, see services/snapshot.py.
+"""
+
+
+def load_users() -> list:
+    return repository.scan_users(USER_FIELDS, SCAN_SEGMENTS)
+
+
+def _codes(values: list, vocabulary: dict) -> np.ndarray:
+    # Missing values are encoded as -1 and never match anything
+    return np.array([-1 if v is None else vocabulary.setdefault(v, len(vocabulary)) for v in values],
+                    dtype=np.int32)
+
+
+def encode_users(users: list) -> dict:
+    users = sorted((u for u in users if u.get('status') == 'ACTIVE' and u.get('gender') is not None),
+                   key=lambda u: u['email'])
+    genders, locations, interests = {}, {}, {}
+    return {
+        'emails': np.array([u['email'] for u in users], dtype=object),
+        'gender': _codes([u['gender'] for u in users], genders),
+        'expected_gender': _codes([matchhelper.expected_gender(u['gender']) for u in users], genders),
+        'location': _codes([u.get('location') for u in users], locations),
+        'interests': np.stack([_codes([u.get(f'interest{i}') for u in users], interests)
+                               for i in (1, 2, 3)], axis=1),
+        'location_count': len(locations),
+        'interest_count': len(interests)
+    }
+
+
+def _one_hot(codes: np.ndarray, size: int) -> np.ndarray:
+    matrix = np.zeros((len(codes), size), dtype=np.float32)
+    present = codes >= 0
+    matrix[np.nonzero(present)[0], codes[present]] = 1
+    return matrix
+
+
+def _features(encoded: dict) -> tuple:
+    location = _one_hot(encoded['location'], encoded['location_count'])
+    counts = sum(_one_hot(encoded['interests'][:, i], encoded['interest_count']) for i in range(3))
+    # seekers only care whether an interest is present, candidates count every field holding it
+    seeker = np.hstack([matchhelper.LOCATION_SCORE * location,
+                        matchhelper.INTEREST_SCORE * np.minimum(counts, 1)])
+    candidate = np.hstack([location, counts])
+    return seeker, candidate
+
+
+def score_matches(encoded: dict, top_k: int = TOP_K, block_size: int = BLOCK_SIZE,
+                  with_scores: bool = False) -> dict:
+    """Return the top-k matched emails of every encoded user, as (email, score) pairs
+    if with_scores"""
+    emails = encoded['emails']
+    seeker, candidate = _features(encoded)
+    matches = {email: [] for email in emails}
+
+    for gender in np.unique(encoded['expected_gender']):
+        seekers = np.nonzero(encoded['expected_gender'] == gender)[0]
+        candidates = np.nonzero(encoded['gender'] == gender)[0]
+        if len(candidates) == 0:
+            continue
+        candidate_t = np.ascontiguousarray(candidate[candidates].T)
+        size = len(candidates)
+        k = min(top_k, size)
+        # rank = score * size + reversed position, so ties are broken by email (candidates are
+        # email sorted). It is kept negated in float32, exact while (7 * size) < 2 ** 24.
+        tie_break = np.arange(size - 1, -1, -1, dtype=np.float32)
+
+        for start in range(0, len(seekers), block_size):
+            rows = seekers[start:start + block_size]
+            rank = seeker[rows] @ candidate_t
+            rank *= -size
+            rank -= tie_break
+
+            top = np.argpartition(rank, k - 1, axis=1)[:, :k] if k < size \
+                else np.tile(np.arange(size), (len(rows), 1))
+            top_rank = np.take_along_axis(rank, top, axis=1)
+            order = np.argsort(top_rank, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = (-np.take_along_axis(top_rank, order, axis=1) // size).astype(np.int32)
+
+            for row, picked, picked_scores in zip(rows, top, top_scores):
+                matches[emails[row]] = [(str(emails[candidates[c]]), int(s)) if with_scores
+                                        else str(emails[candidates[c]])
+                                        for c, s in zip(picked, picked_scores) if s > 0]
+    return matches
+
+
+def write_matches(matches: dict):
+    match_db = aws_service.dynamo_client_factory('match')
+    with match_db.batch_writer() as batch:
+        for email, ranked in matches.items():
+            # a shorter list than asked for holds every candidate with a positive score
+            complete = len(ranked) < matchhelper.MATCH_DEPTH
+            batch.put_item(Item=matchhelper.ranked_record(email, ranked, complete))
+
+
+def run() -> dict:
+    start = time.perf_counter()
+    users = load_users()
+    loaded = time.perf_counter()
+    matches = score_matches(encode_users(users), top_k=matchhelper.MATCH_DEPTH, with_scores=True)
+    scored = time.perf_counter()
+    write_matches(matches)
+    written = time.perf_counter()
+    snapshot.publish(users)
+
+    stats = {
+        'users': len(users),
+        'matched_users': len(matches),
+        'load_seconds': round(loaded - start, 3),
+        'score_seconds': round(scored - loaded, 3),
+        'write_seconds': round(written - scored, 3)
+    }
+    logger.info('Batch matching complete: %s', stats)
+    return stats
+
+
+def batch_match_handler(event, context):
+    return run()
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    run()
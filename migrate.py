@@ -0,0 +1,66 @@
+import argparse
+import logging
+import time
+
+import chat
+from services import matchhelper
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# in the order they have to run
+MIGRATIONS = {
+    'candidate_index': matchhelper.rebuild_candidate_index,
+    'message_histories': chat.migrate_message_histories,
+    'conversation_summaries': chat.migrate_conversation_summaries,
+    'unread_totals': chat.migrate_unread_totals
+}
+
+"""
+Migrations
+One-off backfills of the tables and indexes the handlers read, but that only the new code
+writes. Until they ran, the handlers see an empty table: GET /match recomputes empty lists
+from an empty candidate index, and GET /chat, which only reads the conversation summaries,
+misses every conversation started before the deploy.
+
+Run them with
+    python migrate.py [name ...]
+from a checkout of the release, with the AWS credentials of the stage, or invoke
+    migrate.migrate_handler
+with { 'migrations': [name, ...] }. Without names every migration runs, in MIGRATIONS order.
+Every migration is idempotent and can be run again.
+
+Deploy order:
+1. Create the tables and global secondary indexes:
+    'match_index'   partition key 'partition', sort key 'email'
+    'message_item'  partition key 'conversation', sort key 'seq'
+    'chat_summary'  partition key 'email', sort key 'partner_email', with the index
+                    'email-last_seq-index' (partition key 'email', sort key 'last_seq')
+2. Run the migrations against them.
+3. Switch the traffic to the release (deploy the Lambda function code).
+4. Run the migrations once more, they pick up the profiles and conversations that the
+    previous release changed between 2. and 3. A summary that exists is never overwritten.
+"""
+
+
+def run(names: list = None) -> dict:
+    stats = {}
+    for name in names or list(MIGRATIONS):
+        if name not in MIGRATIONS:
+            raise ValueError(f'Unknown migration - {name}')
+        start = time.perf_counter()
+        MIGRATIONS[name]()
+        stats[name] = round(time.perf_counter() - start, 3)
+        logger.info('Migration %s complete in %.3fs', name, stats[name])
+    return stats
+
+
+def migrate_handler(event, context):
+    return run((event or {}).get('migrations'))
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('migrations', nargs='*', help=', '.join(MIGRATIONS))
+    print(run(parser.parse_args().migrations))
@@ -0,0 +1,33 @@
+import logging
+import time
+
+from services import outbox
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEADLINE_MARGIN_MS = 10 * 1000
+
+"""
+Outbox Worker
+Sends the emails queued by services.outbox.enqueue_email. It should be triggered with
+    outbox_worker.drain_handler
+by a schedule (e.g. an EventBridge rule every minute) and, for a short signup to inbox delay,
+by the DynamoDB stream of the 'outbox' table. Several concurrent invocations are safe, every
+job is claimed before it is sent.
+
+The drain stops DEADLINE_MARGIN_MS before the Lambda times out; whatever is left is picked
+up by the next invocation.
+"""
+
+
+def drain_handler(event, context):
+    deadline = None
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        deadline = time.time() + (context.get_remaining_time_in_millis() - DEADLINE_MARGIN_MS) / 1000
+    return outbox.drain(deadline=deadline)
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    print(outbox.drain())
@@ -0,0 +1,225 @@
+import argparse
+import base64
+import importlib
+import logging
+import os
+import re
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import dispatcher
+from services import aws_service
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+WORKERS = int(os.environ.get('SERVER_WORKERS', 16))
+KEEP_ALIVE_TIMEOUT = float(os.environ.get('SERVER_KEEP_ALIVE_TIMEOUT', 5))
+MAX_BODY_BYTES = int(os.environ.get('SERVER_MAX_BODY_BYTES', 1024 * 1024))
+
+"""
+HTTP Server
+Serves dispatcher.request_dispatcher as a long-running process, e.g. in a container, next to
+the Lambda deployment. Every HTTP request is translated into the API Gateway proxy event the
+dispatcher expects: the route template of dispatcher.ROUTES matching the path becomes the
+'resource', with the values of its placeholders as 'pathParameters'.
+
+1. Connections are served by one thread each and kept alive (HTTP/1.1) until they are idle
+    for KEEP_ALIVE_TIMEOUT seconds.
+2. The handlers run on a pool of WORKERS threads, however many connections are open. The
+    workers live as long as the server, so their DynamoDB resources (see aws_service) and the
+    imported handler modules stay warm.
+3. SIGTERM or SIGINT stops accepting connections, answers the requests in flight with
+    'Connection: close' and waits for them to finish before the process exits.
+
+    python server.py --port 8080 --workers 16
+    python server.py --local    (serves from the in-memory stand-in of services.local_aws)
+"""
+
+
+def route_patterns() -> tuple:
+    """(regex, resource) for every route template, the templates with more literal segments first"""
+    resources = sorted({resource for resource, _ in dispatcher.ROUTES},
+                       key=lambda resource: -sum(not part.startswith('{') for part in resource.split('/')))
+    patterns = []
+    for resource in resources:
+        pattern = re.sub(r'\\{(\w+)\\}', r'(?P<\1>[^/]+)', re.escape(resource))
+        patterns.append((re.compile(pattern + '$'), resource))
+    return tuple(patterns)
+
+
+ROUTE_PATTERNS = route_patterns()
+
+
+def match_resource(path: str) -> tuple:
+    """Return (resource, pathParameters) of the route template matching the path"""
+    for pattern, resource in ROUTE_PATTERNS:
+        match = pattern.match(path)
+        if match is not None:
+            return resource, match.groupdict() or None
+    return path, None
+
+
+def canonical_header(name: str) -> str:
+    # HTTP header names are case-insensitive, the handlers look them up as e.g. 'Authorization'
+    return '-'.join(part.capitalize() for part in name.split('-'))
+
+
+def to_event(method: str, target: str, headers: dict, body: bytes) -> dict:
+    url = urlsplit(target)
+    path = unquote(url.path)
+    resource, path_parameters = match_resource(path)
+    query = parse_qsl(url.query, keep_blank_values=True)
+    multi_query = {}
+    for name, value in query:
+        multi_query.setdefault(name, []).append(value)
+
+    is_base64 = False
+    if not body:
+        body = None
+    else:
+        try:
+            body = body.decode()
+        except UnicodeDecodeError:
+            body, is_base64 = base64.b64encode(body).decode(), True
+    return {
+        'resource': resource,
+        'path': path,
+        'httpMethod': method,
+        'headers': headers,
+        'queryStringParameters': dict(query) or None,
+        'multiValueQueryStringParameters': multi_query or None,
+        'pathParameters': path_parameters,
+        'body': body,
+        'isBase64Encoded': is_base64
+    }
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'mulberry'
+    # idle keep-alive connections are closed after this many seconds
+    timeout = KEEP_ALIVE_TIMEOUT
+    # headers and body are separate writes, Nagle would hold the body back for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.proxy()
+
+    def do_POST(self):
+        self.proxy()
+
+    def do_PUT(self):
+        self.proxy()
+
+    def do_DELETE(self):
+        self.proxy()
+
+    def do_OPTIONS(self):
+        # CORS preflight, answered by API Gateway in the Lambda deployment
+        self.respond(204, dispatcher.CORS_HEADERS, b'')
+
+    def proxy(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self.respond(413, dispatcher.CORS_HEADERS, b'{"status": "fail", "message":"Request body is too large"}')
+            return
+        body = self.rfile.read(length) if length else b''
+        headers = {canonical_header(name): value for name, value in self.headers.items()}
+        event = to_event(self.command, self.path, headers, body)
+        event['requestContext'] = {'identity': {'sourceIp': self.client_address[0]}}
+
+        try:
+            response = self.server.executor.submit(dispatcher.request_dispatcher, event, None).result()
+        except Exception as e:
+            # request_dispatcher only raises when the server is shutting down its workers
+            logger.exception(e)
+            self.close_connection = True
+            self.respond(503, dispatcher.CORS_HEADERS, b'{"status": "fail", "message":"Server is shutting down"}')
+            return
+
+        body = response.get('body') or ''
+        body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode()
+        self.respond(response['statusCode'], response.get('headers') or {}, body)
+
+    def respond(self, status_code: int, headers: dict, body: bytes):
+        if self.server.draining:
+            self.close_connection = True
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Type' not in headers:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # every request is already recorded by services.metrics
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, address: tuple, workers: int = WORKERS):
+        # a failing bind calls server_close, which needs the executor
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self.draining = False
+        super().__init__(address, ProxyHandler)
+
+    def stop(self):
+        """Stop accepting connections and wait for the requests in flight, call from another thread"""
+        self.draining = True
+        self.shutdown()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def make_server(host: str = '0.0.0.0', port: int = 8080, workers: int = WORKERS) -> Server:
+    # import every handler module now, instead of on the first request of one of its routes
+    for module_name in sorted(set(dispatcher.ROUTES.values())):
+        importlib.import_module(module_name)
+    return Server((host, port), workers)
+
+
+def serve(server: Server):
+    def stop(signum, frame):
+        logger.info('Received signal %s, shutting down', signum)
+        threading.Thread(target=server.stop).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    host, port = server.server_address[:2]
+    logger.info('Serving on %s:%s with %s workers', host, port, server.workers)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        logger.info('Server stopped')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--local', action='store_true', help='serve from the in-memory AWS stand-in')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    if args.local:
+        from services.local_aws import LocalDynamoResource, LocalSES
+        aws_service.use_dynamo_resource(LocalDynamoResource())
+        aws_service.use_client('ses', LocalSES())
+    serve(make_server(args.host, args.port, args.workers))
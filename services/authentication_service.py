@@ -1,12 +1,15 @@
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
-import jwt
-
 SECRET = 'secret'
 TEST_USER_EMAIL = 'test-user-email'
 TEST_USER_TOKEN = 'testusertoken'
 ALGORITHM = 'HS256'
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+TOKEN_LIFETIME = timedelta(minutes=30)
+TOKEN_CACHE_SIZE = 1024
 AUTHENTICATION_DISABLED_RESOURCES = [
     '/user/signup',
     '/user/login',
@@ -14,6 +17,58 @@ AUTHENTICATION_DISABLED_RESOURCES = [
     '/user/verify/{token}'
 ]
 
+"""
+Verified Token Cache
+A client polling the backend sends the same token many times per minute. Once a token has
+been verified, its email and expiry are kept in an LRU cache of at most TOKEN_CACHE_SIZE
+entries, so the following requests skip the signature check and the date parsing.
+An entry is dropped as soon as its token expires; when the cache is full, expired entries
+are evicted first and then the least recently used ones.
+
+Tokens carry a numeric 'exp' claim, which jwt.decode validates itself. Tokens issued before
+only carry the 'expiredAt' string and are still accepted.
+"""
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+def _get_cached_email(token: str, now: float) -> str or None:
+    with _token_cache_lock:
+        entry = _token_cache.get(token)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            del _token_cache[token]
+            return None
+        _token_cache.move_to_end(token)
+        return entry[0]
+
+
+def _cache_token(token: str, email: str, expires_at: float, now: float):
+    if TOKEN_CACHE_SIZE <= 0:
+        return
+    with _token_cache_lock:
+        _token_cache[token] = (email, expires_at)
+        _token_cache.move_to_end(token)
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            for expired in [t for t, entry in _token_cache.items() if entry[1] <= now]:
+                del _token_cache[expired]
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+
+def clear_token_cache():
+    with _token_cache_lock:
+        _token_cache.clear()
+
+
+def _token_expiry(decoded_token: dict) -> float:
+    if decoded_token.get('exp') is not None:
+        return float(decoded_token['exp'])
+    # tokens issued before the 'exp' claim was introduced
+    return datetime.strptime(decoded_token.get('expiredAt'), DATETIME_FORMAT).timestamp()
+
 
 def parseEmail(_event: dict) -> str:
     try:
@@ -33,26 +88,36 @@ def parseEmail(_event: dict) -> str:
             except (KeyError, TypeError):
                 return TEST_USER_EMAIL
 
-        # Decode the token
+        # Tokens verified by a previous request skip the decoding
+        now = time.time()
+        email = _get_cached_email(token, now)
+        if email is not None:
+            return email
+
+        # Decode the token, jwt is only imported by the first authenticated request
+        import jwt
         try:
             decoded_token = jwt.decode(token, SECRET, algorithms=[ALGORITHM])
-            expired_date_time = datetime.strptime(
-                decoded_token.get('expiredAt'),
-                DATETIME_FORMAT)
+            expires_at = _token_expiry(decoded_token)
         except Exception:
             raise Authentication403Exception
 
         # Check if token is expired
-        if expired_date_time is None or expired_date_time < datetime.now():
+        if expires_at < now:
             raise Authentication403Exception
 
+        _cache_token(token, decoded_token.get('email'), expires_at, now)
         return decoded_token.get('email')
 
 
 def generateJWTToken(email: str) -> str:
+    import jwt
+    expired_date_time = datetime.now() + TOKEN_LIFETIME
     return jwt.encode({
         'email': email,
-        'expiredAt': (datetime.now() + timedelta(minutes=30)).strftime(DATETIME_FORMAT)
+        'exp': int(expired_date_time.timestamp()),
+        # kept for the clients and validators reading the string claim
+        'expiredAt': expired_date_time.strftime(DATETIME_FORMAT)
     }, SECRET, ALGORITHM)
 
 
@@ -1,5 +1,11 @@
-import boto3
 import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from services import metrics
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -9,23 +15,415 @@ dynamo_tables = {
     "activity": "mulberry-activity",
     "coupon": "mulberry-coupon",
     "match": "mulberry-match",
+    "match_index": "mulberry-match-index",
     "message": "mulberry-message",
-    "cache": "mulberry-cache"
+    "message_item": "mulberry-message-item",
+    "chat_summary": "mulberry-chat-summary",
+    "cache": "mulberry-cache",
+    "outbox": "mulberry-outbox",
+    "ratelimit": "mulberry-ratelimit"
+}
+
+# Key attributes and global secondary indexes of every table, by table name
+dynamo_schemas = {
+    "mulberry-user": {'key': ['email'], 'indexes': {}},
+    "mulberry-activity": {'key': ['id'], 'indexes': {}},
+    "mulberry-coupon": {'key': ['id'], 'indexes': {}},
+    "mulberry-match": {'key': ['email'], 'indexes': {}},
+    "mulberry-match-index": {'key': ['partition', 'email'], 'indexes': {}},
+    "mulberry-message": {'key': ['key'], 'indexes': {}},
+    "mulberry-message-item": {'key': ['conversation', 'seq'], 'indexes': {}},
+    "mulberry-chat-summary": {'key': ['email', 'partner_email'],
+                              'indexes': {'email-last_seq-index': ['email', 'last_seq']}},
+    "mulberry-cache": {'key': ['key'], 'indexes': {'email-purpose-index': ['email', 'purpose']}},
+    "mulberry-outbox": {'key': ['id'], 'indexes': {'state-next_attempt_at-index': ['state', 'next_attempt_at']}},
+    "mulberry-ratelimit": {'key': ['key'], 'indexes': {}}
 }
 
+BATCH_GET_SIZE = 100
+BATCH_GET_ATTEMPTS = 5
+BATCH_GET_BACKOFF = 0.05
+# threads of the segmented scans, they keep their DynamoDB resources from one scan to the next
+SCAN_WORKERS = int(os.environ.get('AWS_SCAN_WORKERS', 4))
+
+"""
+AWS Resource Registry
+Sessions, clients, DynamoDB resources and table handles are created once per Lambda
+container and reused by every following invocation, so a warm request pays neither the
+session setup nor the endpoint resolution nor a new TLS handshake.
+
+1. One boto3 Session is shared by the whole process.
+2. Low level clients (e.g. 'ses') are thread safe and shared by all threads.
+3. boto3 resources are not thread safe, so every thread gets its own DynamoDB resource and
+    table handles. The resources of all threads wrap one shared low level client, so a
+    worker thread (fan-out, scan, server) adds neither a client setup nor a connection pool
+    of its own, and its first call reuses the connections the others opened.
+
+All clients use the botocore settings in client_config, which can be changed by the
+environment variables below or by def configure before the first client is created.
+Use def registry_stats to see how many objects and connections were created or reused.
+
+boto3 itself is only imported when the first client is needed, and handler modules should
+hold table handles through def lazy_table, so importing a module never touches AWS.
+
+Scans and queries that may return more than one page go through def scan and def query,
+generators that follow LastEvaluatedKey lazily:
+    for user in aws_service.scan('user', projection=['gender'], segments=4):
+"""
+
+client_config = {
+    'max_pool_connections': int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50)),
+    'connect_timeout': float(os.environ.get('AWS_CONNECT_TIMEOUT', 2)),
+    'read_timeout': float(os.environ.get('AWS_READ_TIMEOUT', 5)),
+    'tcp_keepalive': os.environ.get('AWS_TCP_KEEPALIVE', 'true').lower() == 'true',
+    'retry_mode': os.environ.get('AWS_RETRY_MODE', 'standard'),
+    'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', 3))
+}
+
+_lock = threading.RLock()
+_thread_local = threading.local()
+_session = None
+_clients = {}
+_resources = []
+_counters = {}
+# bumped by reset_registry, a thread holding resources of an older generation drops them
+_generation = 0
+_dynamo_override = None
+_scan_pool = None
+
+
+def _count(name: str):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + 1
+
+
+def configure(**options):
+    """Change client_config, only clients created afterwards are affected"""
+    unknown = set(options) - set(client_config)
+    if unknown:
+        raise ValueError(f'Unknown client options: {unknown}')
+    client_config.update(options)
+
+
+def _botocore_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=client_config['max_pool_connections'],
+        connect_timeout=client_config['connect_timeout'],
+        read_timeout=client_config['read_timeout'],
+        tcp_keepalive=client_config['tcp_keepalive'],
+        retries={'mode': client_config['retry_mode'], 'max_attempts': client_config['max_attempts']}
+    )
+
+
+def session():
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3
+            _session = boto3.session.Session()
+            _count('sessions_created')
+        return _session
+
+
+def client_factory(service: str):
+    with _lock:
+        client = _clients.get(service)
+        if client is None:
+            client = session().client(service, config=_botocore_config())
+            _clients[service] = client
+            _count('clients_created')
+        else:
+            _count('clients_reused')
+        return client
+
+
+def use_dynamo_resource(resource):
+    """Serve every table from the given resource, e.g. services.local_aws.LocalDynamoResource.
+    None switches back to DynamoDB."""
+    global _dynamo_override
+    if resource is not None and hasattr(resource, 'listeners'):
+        metrics.instrument_local(resource)
+    with _lock:
+        _dynamo_override = resource
+
+
+def use_client(service: str, client):
+    """Register the client returned by client_factory(service), None removes it"""
+    with _lock:
+        if client is None:
+            _clients.pop(service, None)
+        else:
+            _clients[service] = client
+
+
+def dynamo_resource():
+    if _dynamo_override is not None:
+        return _dynamo_override
+    resource = getattr(_thread_local, 'dynamodb', None)
+    if resource is None or _thread_local.generation != _generation:
+        with _lock:
+            if not _resources:
+                shared = session().resource('dynamodb', config=_botocore_config())
+                metrics.instrument_client(shared.meta.client)
+                _resources.append(shared)
+                _count('resources_created')
+            shared = _resources[0]
+            _thread_local.generation = _generation
+        # a new resource object around the shared client costs a fraction of a millisecond
+        resource = shared.__class__(client=shared.meta.client)
+        _count('thread_resources_created')
+        _thread_local.dynamodb = resource
+        _thread_local.tables = {}
+    return resource
+
 
 def dynamo_client_factory(table: str):
-    db = boto3.resource('dynamodb')
+    db = dynamo_resource()
     db_table = dynamo_tables.get(table)
     if db_table is None:
         logger.error("No DynamoDB Table - %s", table)
         raise RuntimeError("Can't create dynamo db client")
-    return db.Table(db_table)
+    if _dynamo_override is not None:
+        return db.Table(db_table)
+
+    handle = _thread_local.tables.get(db_table)
+    if handle is None:
+        handle = db.Table(db_table)
+        _thread_local.tables[db_table] = handle
+        _count('tables_created')
+    else:
+        _count('tables_reused')
+    return handle
+
+
+def table_key(table: str) -> list:
+    return dynamo_schemas[dynamo_tables[table]]['key']
+
+
+def projection_expression(table: str, attributes: list or None) -> dict:
+    """ProjectionExpression and its names for the attributes and the key of the table"""
+    if attributes is None:
+        return {}
+    attributes = list(dict.fromkeys(table_key(table) + list(attributes)))
+    return {
+        'ProjectionExpression': ', '.join(f'#a{i}' for i in range(len(attributes))),
+        'ExpressionAttributeNames': {f'#a{i}': a for i, a in enumerate(attributes)}
+    }
+
+
+def batch_get(table: str, keys: list, projection: list = None) -> list:
+    """
+    Read many items of one table with batch_get_item, 100 keys per call.
+    Unprocessed keys are retried with exponential backoff, giving up after
+    BATCH_GET_ATTEMPTS calls in a row that made no progress. When a projection is given,
+    the key attributes are always part of it.
+    """
+    db_table = dynamo_tables[table]
+    key_attributes = table_key(table)
+    unique_keys = list({tuple(key[k] for k in key_attributes): key for key in keys}.values())
+
+    request_options = projection_expression(table, projection)
+
+    items = []
+    for start in range(0, len(unique_keys), BATCH_GET_SIZE):
+        request = {db_table: dict(request_options, Keys=unique_keys[start:start + BATCH_GET_SIZE])}
+        attempt = 0
+        while request:
+            pending = len(request[db_table]['Keys'])
+            response = dynamo_resource().batch_get_item(RequestItems=request)
+            items.extend(response['Responses'].get(db_table, []))
+            request = response.get('UnprocessedKeys') or {}
+            if request:
+                attempt = 0 if len(request[db_table]['Keys']) < pending else attempt + 1
+                if attempt >= BATCH_GET_ATTEMPTS:
+                    logger.error("batch_get_item gave up on %s unprocessed keys - %s",
+                                 len(request[db_table]['Keys']), table)
+                    raise RuntimeError("Can't read all the requested items")
+                time.sleep(BATCH_GET_BACKOFF * 2 ** attempt)
+    return items
+
+
+def _request(table: str, projection: list or None, page_size: int or None, limit: int or None,
+             request: dict) -> dict:
+    request = dict(request)
+    names = projection_expression(table, projection)
+    if names:
+        request['ProjectionExpression'] = names['ProjectionExpression']
+        request['ExpressionAttributeNames'] = dict(request.get('ExpressionAttributeNames') or {},
+                                                   **names['ExpressionAttributeNames'])
+    # Limit counts the items evaluated, a page never needs more than the items still wanted
+    sizes = [size for size in (page_size, limit) if size]
+    if sizes:
+        request['Limit'] = min(sizes)
+    return request
+
+
+def _pages(table: str, operation: str, request: dict):
+    request = dict(request)
+    while True:
+        response = getattr(dynamo_client_factory(table), operation)(**request)
+        yield response
+        if 'LastEvaluatedKey' not in response:
+            return
+        request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def _scan_workers() -> ThreadPoolExecutor:
+    global _scan_pool
+    with _lock:
+        if _scan_pool is None:
+            _scan_pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS, thread_name_prefix='scan')
+        return _scan_pool
+
+
+def _segment_pages(table: str, request: dict, segments: int):
+    """The pages of a parallel scan, the segments run on the SCAN_WORKERS threads, the pages
+    come in the order they arrive"""
+    pages = queue.Queue(maxsize=segments)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry) -> bool:
+        # gives up once the consumer stopped reading
+        while not stop.is_set():
+            try:
+                pages.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def scan_segment(segment: int):
+        # the worker may hold calls of a scan that was abandoned
+        metrics.take_dynamo_calls()
+        if stop.is_set():
+            return
+        try:
+            for response in _pages(table, 'scan', dict(request, Segment=segment, TotalSegments=segments)):
+                if not put((response, metrics.take_dynamo_calls())):
+                    return
+        except Exception as e:
+            put((e, metrics.take_dynamo_calls()))
+        finally:
+            put((done, {}))
+
+    for segment in range(segments):
+        _scan_workers().submit(scan_segment, segment)
+    try:
+        finished = 0
+        while finished < segments:
+            response, dynamo = pages.get()
+            metrics.merge_dynamo_calls(dynamo)
+            if response is done:
+                finished += 1
+            elif isinstance(response, Exception):
+                raise response
+            else:
+                yield response
+    finally:
+        stop.set()
+
+
+def _items(table: str, pages, limit: int or None, on_page):
+    count = 0
+    try:
+        if limit is not None and limit <= 0:
+            return
+        for response in pages:
+            logger.debug('Read a page of %s: %s items of %s scanned', table, response.get('Count'),
+                         response.get('ScannedCount'))
+            if on_page is not None:
+                on_page(response)
+            for item in response['Items']:
+                yield item
+                count += 1
+                # returns before the next page is read
+                if limit is not None and count >= limit:
+                    return
+    finally:
+        pages.close()
+
+
+def scan(table: str, projection: list = None, page_size: int = None, limit: int = None,
+         segments: int = 1, on_page=None, **request):
+    """
+    Yield the items of a scan, following LastEvaluatedKey page by page. A page is only read
+    when the items of the previous one are consumed, so the memory held is one page per
+    segment and breaking out of the loop stops the scan.
+    projection: the attributes to read, the key attributes are always included.
+    page_size: the Limit of every call. limit: the most items yielded.
+    segments: more than 1 scans the segments in parallel on a pool of SCAN_WORKERS threads,
+        the pages come in the order they arrive. Meant for batch jobs, a request should query.
+    on_page: called with every response before its items are yielded, e.g. for metrics.
+    request: the other parameters of the scan, e.g. FilterExpression.
+    The DynamoDB calls are counted in the metrics of the calling thread, segments included.
+    """
+    request = _request(table, projection, page_size, limit, request)
+    pages = _segment_pages(table, request, segments) if segments > 1 else _pages(table, 'scan', request)
+    return _items(table, pages, limit, on_page)
+
+
+def query(table: str, projection: list = None, page_size: int = None, limit: int = None,
+          on_page=None, **request):
+    """Yield the items of a query page by page, see def scan for the options"""
+    request = _request(table, projection, page_size, limit, request)
+    return _items(table, _pages(table, 'query', request), limit, on_page)
+
+
+class _LazyTable:
+    """Resolves the table handle of the calling thread on every use"""
+
+    def __init__(self, table: str):
+        self.table = table
+
+    def __getattr__(self, attribute):
+        return getattr(dynamo_client_factory(self.table), attribute)
+
+
+def lazy_table(table: str) -> _LazyTable:
+    if table not in dynamo_tables:
+        logger.error("No DynamoDB Table - %s", table)
+        raise RuntimeError("Can't create dynamo db client")
+    return _LazyTable(table)
+
+
+def _connection_pools(client) -> list:
+    # botocore keeps one urllib3 pool per endpoint; these are private attributes
+    try:
+        return list(client._endpoint.http_session._manager.pools._container.values())
+    except AttributeError:
+        return []
+
+
+def registry_stats() -> dict:
+    with _lock:
+        stats = dict(_counters)
+        clients = list(_clients.values()) + [resource.meta.client for resource in _resources]
+    clients = [client for client in clients if hasattr(client, '_endpoint')]
+    pools = [pool for client in clients for pool in _connection_pools(client)]
+    stats['connections_created'] = sum(pool.num_connections for pool in pools)
+    stats['requests_sent'] = sum(pool.num_requests for pool in pools)
+    stats['connections_reused'] = max(0, stats['requests_sent'] - stats['connections_created'])
+    return stats
+
+
+def reset_registry():
+    """Drop every cached session, client and resource, e.g. after configure. The other
+    threads (fan-out, scan and server workers) create theirs again on their next call."""
+    global _session, _generation
+    with _lock:
+        _session = None
+        _generation += 1
+        _clients.clear()
+        _resources.clear()
+        _counters.clear()
+        _thread_local.__dict__.clear()
 
 
 def ses_send_email(target_email_address: str,
                    subject: str, body: str) -> bool:
-    ses_client = boto3.client('ses')
+    ses_client = client_factory('ses')
     message = {
         'Subject': {'Data': subject},
         'Body': {'Html': {'Data': body}}
@@ -44,3 +442,9 @@ def ses_send_email(target_email_address: str,
                      target_email_address, body)
         logger.exception(e)
         return False
+
+
+def is_condition_failure(error: Exception) -> bool:
+    """Whether a DynamoDB call failed because its ConditionExpression was not met"""
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    return code == 'ConditionalCheckFailedException'
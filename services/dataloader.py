@@ -0,0 +1,106 @@
+import logging
+import threading
+
+from services import aws_service, repository
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+"""
+Request Scoped Data Loader
+Handlers often need the same item more than once in a request, or several independent items
+one after another. The data loader keeps every item read during the request in an identity
+map, keyed by (table, key attributes), so each item is fetched at most once.
+
+1. def get(table, key) returns the item from the identity map, or reads it. If other keys are
+    pending, they are read together with it in one batch_get_item call.
+2. def prefetch(table, keys) registers keys that will be needed soon; they are read by the
+    next get / load_many / flush, all in batch_get_item calls.
+3. def load_many(table, keys) returns all the items at once, reading the missing ones in
+    batch_get_item calls.
+4. def put(table, item) writes the item and keeps the identity map up to date.
+5. def clear() drops everything. request_dispatcher calls it at the end of every invocation.
+
+Items missing from the table are remembered as None. The identity map belongs to the
+calling thread, so concurrent requests on a worker pool never share items.
+"""
+
+_local = threading.local()
+
+
+def _state():
+    if not hasattr(_local, 'items'):
+        _local.items = {}
+        _local.pending = {}
+        _local.stats = {'hits': 0, 'misses': 0, 'batches': 0}
+    return _local
+
+
+def _identity(table: str, key: dict) -> tuple:
+    return table, tuple(key[k] for k in aws_service.table_key(table))
+
+
+def prefetch(table: str, keys: list):
+    state = _state()
+    for key in keys:
+        identity = _identity(table, key)
+        if identity not in state.items:
+            state.pending.setdefault(table, {})[identity] = key
+
+
+def flush():
+    state = _state()
+    pending, state.pending = state.pending, {}
+    for table, keys in pending.items():
+        for identity in keys:
+            state.items.setdefault(identity, None)
+        for item in repository.batch_get(table, list(keys.values())):
+            state.items[_identity(table, item)] = item
+        state.stats['batches'] += 1
+        state.stats['misses'] += len(keys)
+
+
+def get(table: str, key: dict) -> dict or None:
+    state = _state()
+    identity = _identity(table, key)
+    if identity in state.items:
+        state.stats['hits'] += 1
+        return state.items[identity]
+
+    if state.pending:
+        # read the pending keys in the same round trip
+        prefetch(table, [key])
+        flush()
+        return state.items[identity]
+
+    state.stats['misses'] += 1
+    item = repository.get_item(table, key)
+    state.items[identity] = item
+    return item
+
+
+def load_many(table: str, keys: list) -> list:
+    prefetch(table, keys)
+    flush()
+    state = _state()
+    return [state.items[_identity(table, key)] for key in keys]
+
+
+def put(table: str, item: dict):
+    aws_service.dynamo_client_factory(table).put_item(Item=item)
+    _state().items[_identity(table, item)] = item
+
+
+def forget(table: str, key: dict):
+    _state().items.pop(_identity(table, key), None)
+
+
+def stats() -> dict:
+    return dict(_state().stats)
+
+
+def clear():
+    state = _state()
+    state.items.clear()
+    state.pending.clear()
+    state.stats = {'hits': 0, 'misses': 0, 'batches': 0}
@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from services import metrics
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ENABLED = os.environ.get('FANOUT_ENABLED', '1') == '1'
+MAX_WORKERS = int(os.environ.get('FANOUT_WORKERS', 8))
+CALL_TIMEOUT = float(os.environ.get('FANOUT_CALL_TIMEOUT', 10))
+
+"""
+Concurrent Fan-out
+def run executes independent calls, typically DynamoDB round trips, on a shared pool of
+MAX_WORKERS threads, so a handler waits for the slowest call instead of the sum of all of them:
+    message, history = fanout.run((put_message, key, message),
+                                  (record_message_sent, key, sender_email, receiver_email))
+
+1. The results are returned in the order of the calls. If any call raises, or does not finish
+    within CALL_TIMEOUT seconds of the fan-out, FanoutException is raised once every call is
+    done, holding all the errors and the results of the calls that succeeded. A call that
+    timed out is not interrupted, it keeps its worker until it returns.
+2. The calls run on other threads: they get their own DynamoDB resource around the shared
+    client (see aws_service) and their DynamoDB calls are added to the metrics of the calling
+    request. They must not use services.dataloader, whose identity map belongs to the
+    request thread.
+3. A fan-out started by a call already running on the pool, a single call, or any call while
+    ENABLED is False, runs on the calling thread one call after another, so nested fan-outs
+    never wait for workers held by their parents.
+"""
+
+_lock = threading.Lock()
+_local = threading.local()
+_executor = None
+
+
+class FanoutException(Exception):
+    """One or more calls of a fan-out failed, errors holds (call index, exception) pairs"""
+
+    def __init__(self, errors: list, results: list):
+        super().__init__(f'{len(errors)} of {len(results)} calls failed, first: {errors[0][1]!r}')
+        self.errors = errors
+        self.results = results
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='fanout')
+        return _executor
+
+
+def _call(function, args: tuple) -> tuple:
+    """Run one call on a worker, return (result, error, DynamoDB calls it made)"""
+    _local.worker = True
+    metrics.take_dynamo_calls()
+    try:
+        return function(*args), None, metrics.take_dynamo_calls()
+    except Exception as e:
+        return None, e, metrics.take_dynamo_calls()
+
+
+def run(*calls, timeout: float = CALL_TIMEOUT) -> list:
+    """Run the calls, each a (function, arg, ...) tuple, concurrently and return their results"""
+    results, errors = [], []
+    if not ENABLED or len(calls) < 2 or getattr(_local, 'worker', False):
+        for index, (function, *args) in enumerate(calls):
+            try:
+                results.append(function(*args))
+            except Exception as e:
+                results.append(None)
+                errors.append((index, e))
+    else:
+        futures = [_pool().submit(_call, function, tuple(args)) for function, *args in calls]
+        deadline = time.monotonic() + timeout
+        for index, future in enumerate(futures):
+            try:
+                result, error, dynamo = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                result, error, dynamo = None, TimeoutError(f'Call {index} took longer than {timeout}s'), {}
+            metrics.merge_dynamo_calls(dynamo)
+            results.append(result)
+            if error is not None:
+                errors.append((index, error))
+
+    if errors:
+        for index, error in errors:
+            logger.error('Fan-out call %s failed - %r', index, error)
+        raise FanoutException(errors, results) from errors[0][1]
+    return results
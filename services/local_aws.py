@@ -0,0 +1,699 @@
+import copy
+import hashlib
+import re
+import threading
+import time
+from decimal import Decimal
+
+from services.repository import item_size
+
+"""
+Local AWS stand-in
+An in-memory replacement for the subset of the boto3 DynamoDB resource API used by this
+code base, so that handlers can be exercised and measured without AWS.
+
+Supported on a table: get_item, put_item, delete_item, update_item, query, scan and
+batch_writer. Supported on the resource: Table and batch_get_item.
+Expressions are the string forms used in this repo (KeyConditionExpression,
+FilterExpression, ConditionExpression, UpdateExpression, ProjectionExpression) together
+with ExpressionAttributeNames / ExpressionAttributeValues.
+
+Every call is counted in LocalDynamoResource.stats and can be slowed down with an injected
+latency to emulate the network round trip:
+    resource = LocalDynamoResource(latency=0.005)
+    aws_service.use_dynamo_resource(resource)
+
+LocalSES and LocalS3 replace the SES and S3 clients the same way:
+    aws_service.use_client('ses', LocalSES())
+"""
+
+PAGE_SIZE_LIMIT = 1024 * 1024
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+
+
+class LocalClientError(Exception):
+    """Mirrors the shape of botocore's ClientError: the code lives in response['Error']"""
+
+    def __init__(self, code: str, message: str = ''):
+        super().__init__(f'{code}: {message}')
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+def _to_dynamo(value):
+    # Emulate boto3's TypeSerializer: ints become Decimal, floats are rejected
+    if isinstance(value, bool) or value is None or isinstance(value, (str, Decimal, bytes)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, dict):
+        return {k: _to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_dynamo(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        if len(value) == 0:
+            raise LocalClientError('ValidationException', 'An string set may not be empty')
+        return {_to_dynamo(v) for v in value}
+    raise TypeError(f'Unsupported type "{type(value)}" for value "{value}"')
+
+
+# ------------------------------------------------------------------ expressions
+
+_TOKEN = re.compile(r'\s*(#\w+|:\w+|<>|<=|>=|[=<>(),.\[\]+-]|\d+|[A-Za-z_][\w-]*)')
+
+
+def _tokenize(expression: str) -> list:
+    tokens, pos = [], 0
+    expression = expression.strip()
+    while pos < len(expression):
+        m = _TOKEN.match(expression, pos)
+        if m is None:
+            raise LocalClientError('ValidationException', f'Invalid expression: {expression}')
+        tokens.append(m.group(1))
+        pos = m.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, expression: str, names: dict, values: dict):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self, offset=0):
+        i = self.pos + offset
+        return self.tokens[i] if i < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise LocalClientError('ValidationException', f'Expected {expected}, got {token}')
+        self.pos += 1
+        return token
+
+    def done(self):
+        return self.pos >= len(self.tokens)
+
+    # paths and operands
+    def path(self) -> tuple:
+        parts = [self._name(self.take())]
+        while self.peek() in ('.', '['):
+            if self.take() == '.':
+                parts.append(self._name(self.take()))
+            else:
+                parts.append(int(self.take()))
+                self.take(']')
+        return tuple(parts)
+
+    def _name(self, token):
+        if token.startswith('#'):
+            return self.names[token]
+        return token
+
+    def operand(self):
+        token = self.peek()
+        if token.startswith(':'):
+            self.take()
+            value = _to_dynamo(self.values[token])
+            return lambda item: value
+        if token.lower() == 'size' and self.peek(1) == '(':
+            self.take()
+            self.take('(')
+            path = self.path()
+            self.take(')')
+            return lambda item: _size(_resolve(item, path))
+        path = self.path()
+        return lambda item: _resolve(item, path)
+
+    # conditions
+    def condition(self):
+        left = self.conjunction()
+        while self.peek() is not None and self.peek().upper() == 'OR':
+            self.take()
+            right = self.conjunction()
+            left = (lambda a, b: lambda item: a(item) or b(item))(left, right)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.peek() is not None and self.peek().upper() == 'AND':
+            self.take()
+            right = self.negation()
+            left = (lambda a, b: lambda item: a(item) and b(item))(left, right)
+        return left
+
+    def negation(self):
+        if self.peek() is not None and self.peek().upper() == 'NOT':
+            self.take()
+            inner = self.negation()
+            return lambda item: not inner(item)
+        return self.comparison()
+
+    def comparison(self):
+        token = self.peek()
+        if token == '(':
+            self.take()
+            inner = self.condition()
+            self.take(')')
+            return inner
+        function = token.lower()
+        if function in ('attribute_exists', 'attribute_not_exists') and self.peek(1) == '(':
+            self.take()
+            self.take('(')
+            path = self.path()
+            self.take(')')
+            exists = function == 'attribute_exists'
+            return lambda item: (_resolve(item, path) is not None) == exists
+        if function in ('begins_with', 'contains') and self.peek(1) == '(':
+            self.take()
+            self.take('(')
+            target = self.operand()
+            self.take(',')
+            probe = self.operand()
+            self.take(')')
+            if function == 'begins_with':
+                return lambda item: isinstance(target(item), str) and target(item).startswith(probe(item))
+            return lambda item: target(item) is not None and probe(item) in target(item)
+
+        left = self.operand()
+        operator = self.take().upper()
+        if operator == 'BETWEEN':
+            low = self.operand()
+            self.take('AND')
+            high = self.operand()
+            return lambda item: _compare(left(item), '>=', low(item)) and _compare(left(item), '<=', high(item))
+        if operator == 'IN':
+            self.take('(')
+            options = [self.operand()]
+            while self.peek() == ',':
+                self.take()
+                options.append(self.operand())
+            self.take(')')
+            return lambda item: any(left(item) == option(item) for option in options)
+        right = self.operand()
+        return lambda item: _compare(left(item), operator, right(item))
+
+    # update expressions
+    def update(self) -> list:
+        actions = []
+        while not self.done():
+            clause = self.take().upper()
+            while True:
+                if clause == 'SET':
+                    path = self.path()
+                    self.take('=')
+                    actions.append(('SET', path, self.set_value()))
+                elif clause == 'REMOVE':
+                    actions.append(('REMOVE', self.path(), None))
+                elif clause in ('ADD', 'DELETE'):
+                    path = self.path()
+                    actions.append((clause, path, self.operand()))
+                else:
+                    raise LocalClientError('ValidationException', f'Unknown update clause {clause}')
+                if self.peek() != ',':
+                    break
+                self.take()
+        return actions
+
+    def set_value(self):
+        left = self.set_term()
+        if self.peek() in ('+', '-'):
+            operator = self.take()
+            right = self.set_term()
+            if operator == '+':
+                return lambda item: left(item) + right(item)
+            return lambda item: left(item) - right(item)
+        return left
+
+    def set_term(self):
+        function = self.peek().lower()
+        if function == 'if_not_exists' and self.peek(1) == '(':
+            self.take()
+            self.take('(')
+            path = self.path()
+            self.take(',')
+            default = self.operand()
+            self.take(')')
+            return lambda item: _first_not_none(_resolve(item, path), default(item))
+        if function == 'list_append' and self.peek(1) == '(':
+            self.take()
+            self.take('(')
+            first = self.operand()
+            self.take(',')
+            second = self.operand()
+            self.take(')')
+            return lambda item: list(first(item)) + list(second(item))
+        return self.operand()
+
+
+def _first_not_none(value, default):
+    return default if value is None else value
+
+
+def _size(value):
+    if value is None:
+        return None
+    return Decimal(item_size(value)) if isinstance(value, (int, Decimal)) else Decimal(len(value))
+
+
+def _resolve(item, path):
+    current = item
+    for part in path:
+        if isinstance(part, int):
+            if not isinstance(current, list) or part >= len(current):
+                return None
+            current = current[part]
+        else:
+            if not isinstance(current, dict) or part not in current:
+                return None
+            current = current[part]
+    return current
+
+
+def _assign(item, path, value):
+    current = item
+    for part in path[:-1]:
+        current = current[part]
+    current[path[-1]] = value
+
+
+def _remove(item, path):
+    parent = _resolve(item, path[:-1]) if len(path) > 1 else item
+    if isinstance(parent, dict):
+        parent.pop(path[-1], None)
+    elif isinstance(parent, list) and path[-1] < len(parent):
+        parent.pop(path[-1])
+
+
+def _compare(left, operator, right):
+    if left is None or right is None:
+        return operator == '<>' and left != right
+    try:
+        if operator == '=':
+            return left == right
+        if operator == '<>':
+            return left != right
+        if operator == '<':
+            return left < right
+        if operator == '<=':
+            return left <= right
+        if operator == '>':
+            return left > right
+        if operator == '>=':
+            return left >= right
+    except TypeError:
+        return False
+    raise LocalClientError('ValidationException', f'Unknown operator {operator}')
+
+
+def _condition(expression, names, values):
+    if expression is None:
+        return lambda item: True
+    parser = _Parser(expression, names, values)
+    predicate = parser.condition()
+    if not parser.done():
+        raise LocalClientError('ValidationException', f'Invalid expression: {expression}')
+    return predicate
+
+
+def _project(item: dict, expression: str or None, names: dict or None) -> dict:
+    if expression is None:
+        return item
+    projected = {}
+    for attribute in expression.split(','):
+        attribute = attribute.strip()
+        attribute = (names or {}).get(attribute, attribute)
+        if attribute in item:
+            projected[attribute] = item[attribute]
+    return projected
+
+
+def _sort_value(value):
+    return (0, value) if isinstance(value, Decimal) else (1, str(value))
+
+
+# ------------------------------------------------------------------ tables
+
+class _Meta:
+    def __init__(self, client):
+        self.client = client
+
+
+class _BatchWriter:
+    """Buffers writes like boto3's batch_writer, one batch_write_item call per 25 of them"""
+
+    def __init__(self, table):
+        self.table = table
+        self.requests = []
+
+    def put_item(self, Item):
+        self.requests.append(('put', _to_dynamo(copy.deepcopy(Item))))
+        if len(self.requests) == BATCH_WRITE_LIMIT:
+            self.flush()
+
+    def delete_item(self, Key):
+        self.requests.append(('delete', dict(Key)))
+        if len(self.requests) == BATCH_WRITE_LIMIT:
+            self.flush()
+
+    def flush(self):
+        requests, self.requests = self.requests, []
+        if not requests:
+            return
+        with self.table.resource.call(self.table.name, 'batch_write_item') as call:
+            for operation, item in requests:
+                key = self.table._key_of(item)
+                if operation == 'put':
+                    self.table.items[key] = item
+                else:
+                    self.table.items.pop(key, None)
+                call.write(item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
+
+
+class LocalTable:
+    def __init__(self, resource, name: str, key: tuple, indexes: dict):
+        self.resource = resource
+        self.name = name
+        self.table_name = name
+        self.key = key
+        self.indexes = indexes
+        self.items = {}
+        self.meta = _Meta(resource)
+
+    def _key_of(self, item: dict) -> tuple:
+        try:
+            return tuple(item[k] for k in self.key)
+        except KeyError:
+            raise LocalClientError('ValidationException',
+                                   'The provided key element does not match the schema')
+
+    def _check(self, expression, names, values, current):
+        if expression is not None and not _condition(expression, names, values)(current or {}):
+            raise LocalClientError('ConditionalCheckFailedException', 'The conditional request failed')
+
+    def _consumed(self, kwargs, units):
+        if kwargs.get('ReturnConsumedCapacity') in ('TOTAL', 'INDEXES'):
+            return {'ConsumedCapacity': {'TableName': self.name, 'CapacityUnits': units}}
+        return {}
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None,
+                 ConsistentRead=False, **kwargs):
+        with self.resource.call(self.name, 'get_item') as call:
+            item = self.items.get(self._key_of(Key))
+            response = self._consumed(kwargs, 0.5)
+            if item is not None:
+                item = copy.deepcopy(_project(item, ProjectionExpression, ExpressionAttributeNames))
+                call.read(item)
+                response['Item'] = item
+            return response
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        with self.resource.call(self.name, 'put_item') as call:
+            item = _to_dynamo(copy.deepcopy(Item))
+            key = self._key_of(item)
+            self._check(ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                        self.items.get(key))
+            self.items[key] = item
+            call.write(item)
+            return self._consumed(kwargs, 1)
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        with self.resource.call(self.name, 'delete_item') as call:
+            key = self._key_of(Key)
+            self._check(ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                        self.items.get(key))
+            call.write(Key)
+            self.items.pop(key, None)
+            return self._consumed(kwargs, 1)
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    ReturnValues='NONE', **kwargs):
+        with self.resource.call(self.name, 'update_item') as call:
+            key = self._key_of(Key)
+            old = self.items.get(key)
+            self._check(ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, old)
+
+            new = copy.deepcopy(old) if old is not None else copy.deepcopy(_to_dynamo(Key))
+            actions = _Parser(UpdateExpression, ExpressionAttributeNames,
+                              ExpressionAttributeValues).update()
+            updated = set()
+            for action, path, value in actions:
+                updated.add(path[0])
+                if action == 'SET':
+                    _assign(new, path, value(old or {}))
+                elif action == 'REMOVE':
+                    _remove(new, path)
+                elif action == 'ADD':
+                    current, delta = _resolve(new, path), value(old or {})
+                    if isinstance(delta, set):
+                        _assign(new, path, (current or set()) | delta)
+                    else:
+                        _assign(new, path, (current or Decimal(0)) + delta)
+                elif action == 'DELETE':
+                    current = _resolve(new, path)
+                    if current is not None:
+                        remaining = current - value(old or {})
+                        if remaining:
+                            _assign(new, path, remaining)
+                        else:
+                            _remove(new, path)
+            self.items[key] = new
+            call.write(new)
+
+            response = self._consumed(kwargs, 1)
+            if ReturnValues == 'ALL_NEW':
+                response['Attributes'] = copy.deepcopy(new)
+            elif ReturnValues == 'ALL_OLD' and old is not None:
+                response['Attributes'] = copy.deepcopy(old)
+            elif ReturnValues == 'UPDATED_NEW':
+                response['Attributes'] = {k: copy.deepcopy(new[k]) for k in updated if k in new}
+            elif ReturnValues == 'UPDATED_OLD' and old is not None:
+                response['Attributes'] = {k: copy.deepcopy(old[k]) for k in updated if k in old}
+            return response
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None,
+              ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+              ScanIndexForward=True, Limit=None, ExclusiveStartKey=None,
+              ProjectionExpression=None, Select=None, **kwargs):
+        with self.resource.call(self.name, 'query') as call:
+            key = self.indexes[IndexName] if IndexName else self.key
+            matches = _condition(KeyConditionExpression, ExpressionAttributeNames,
+                                 ExpressionAttributeValues)
+            # the partition key is compared for equality, so it is one of the bound values
+            bound = {v for v in (ExpressionAttributeValues or {}).values() if isinstance(v, (str, Decimal, int))}
+            candidates = [item for item in self.items.values()
+                          if item.get(key[0]) in bound and all(k in item for k in key) and matches(item)]
+            if len(key) > 1:
+                candidates.sort(key=lambda item: _sort_value(item[key[1]]),
+                                reverse=not ScanIndexForward)
+            return self._page(call, candidates, key, FilterExpression, ExpressionAttributeNames,
+                              ExpressionAttributeValues, Limit, ExclusiveStartKey,
+                              ProjectionExpression, Select, kwargs)
+
+    def scan(self, FilterExpression=None, ExpressionAttributeNames=None,
+             ExpressionAttributeValues=None, Limit=None, ExclusiveStartKey=None,
+             ProjectionExpression=None, Segment=None, TotalSegments=None, IndexName=None,
+             Select=None, **kwargs):
+        with self.resource.call(self.name, 'scan') as call:
+            key = self.indexes[IndexName] if IndexName else self.key
+            candidates = [item for item in self.items.values() if all(k in item for k in key)]
+            if TotalSegments:
+                candidates = [item for item in candidates
+                              if hash(str(item[key[0]])) % TotalSegments == Segment]
+            return self._page(call, candidates, key, FilterExpression, ExpressionAttributeNames,
+                              ExpressionAttributeValues, Limit, ExclusiveStartKey,
+                              ProjectionExpression, Select, kwargs)
+
+    def _page(self, call, candidates, key, filter_expression, names, values, limit,
+              start_key, projection, select, kwargs):
+        # index keys carry the table key as well so that pages can be resumed
+        cursor_keys = tuple(dict.fromkeys(key + self.key))
+        if start_key is not None:
+            start = tuple(start_key[k] for k in cursor_keys)
+            positions = [tuple(item[k] for k in cursor_keys) for item in candidates]
+            candidates = candidates[positions.index(start) + 1:] if start in positions else []
+
+        keep = _condition(filter_expression, names, values)
+        items, evaluated, size, last = [], 0, 0, None
+        for item in candidates:
+            if limit is not None and evaluated >= limit:
+                break
+            if size >= PAGE_SIZE_LIMIT:
+                break
+            evaluated += 1
+            size += item_size(item)
+            last = item
+            if keep(item):
+                items.append(copy.deepcopy(_project(item, projection, names)))
+
+        call.items_evaluated += evaluated
+        response = self._consumed(kwargs, max(0.5, size / 8192))
+        response.update({'Count': len(items), 'ScannedCount': evaluated})
+        if select != 'COUNT':
+            response['Items'] = items
+        if last is not None and evaluated < len(candidates):
+            response['LastEvaluatedKey'] = {k: last[k] for k in cursor_keys}
+        for item in items:
+            call.read(item)
+        return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+
+class _Call:
+    def __init__(self, resource, table, operation):
+        self.resource = resource
+        self.table = table
+        self.operation = operation
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.items_evaluated = 0
+
+    def read(self, item):
+        self.bytes_read += item_size(item)
+
+    def write(self, item):
+        self.bytes_written += item_size(item)
+
+    def __enter__(self):
+        self.resource.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.resource.lock.release()
+        self.resource.record(self)
+        return False
+
+
+class LocalDynamoResource:
+    def __init__(self, schemas: dict = None, latency=0.0, batch_get_limit: int = BATCH_GET_LIMIT):
+        if schemas is None:
+            from services import aws_service
+            schemas = aws_service.dynamo_schemas
+        self.schemas = schemas
+        self.latency = latency
+        self.batch_get_limit = batch_get_limit
+        self.tables = {}
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.stats = {}
+        self.reset_stats()
+
+    def Table(self, name: str) -> LocalTable:
+        with self.lock:
+            if name not in self.tables:
+                schema = self.schemas.get(name, {'key': ('key',), 'indexes': {}})
+                self.tables[name] = LocalTable(self, name, tuple(schema['key']),
+                                               {k: tuple(v) for k, v in schema['indexes'].items()})
+            return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        with self.call(','.join(RequestItems), 'batch_get_item') as call:
+            responses, unprocessed, budget = {}, {}, self.batch_get_limit
+            for name, request in RequestItems.items():
+                table = self.Table(name)
+                responses[name] = []
+                for index, key in enumerate(request['Keys']):
+                    if budget == 0:
+                        unprocessed[name] = dict(request, Keys=request['Keys'][index:])
+                        break
+                    budget -= 1
+                    item = table.items.get(table._key_of(key))
+                    if item is not None:
+                        item = copy.deepcopy(_project(item, request.get('ProjectionExpression'),
+                                                      request.get('ExpressionAttributeNames')))
+                        call.read(item)
+                        responses[name].append(item)
+            return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+    def call(self, table: str, operation: str) -> _Call:
+        if self.latency:
+            time.sleep(self.latency() if callable(self.latency) else self.latency)
+        return _Call(self, table, operation)
+
+    def record(self, call: _Call):
+        with self.lock:
+            key = (call.table, call.operation)
+            self.stats['calls'][key] = self.stats['calls'].get(key, 0) + 1
+            self.stats['round_trips'] += 1
+            self.stats['bytes_read'] += call.bytes_read
+            self.stats['bytes_written'] += call.bytes_written
+            self.stats['items_evaluated'] += call.items_evaluated
+        for listener in self.listeners:
+            listener(call.table, call.operation, call.bytes_read, call.bytes_written)
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'calls': {}, 'round_trips': 0, 'bytes_read': 0, 'bytes_written': 0,
+                          'items_evaluated': 0}
+
+
+class LocalSES:
+    """Stand-in for the SES client: emails are recorded in 'sent' instead of being sent.
+    The next 'failures' sends raise, to exercise the error handling."""
+
+    def __init__(self, latency: float = 0.0, failures: int = 0):
+        self.latency = latency
+        self.failures = failures
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_email(self, Source, Destination, Message, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise LocalClientError('Throttling', 'Maximum sending rate exceeded.')
+            self.sent.append({'Source': Source, 'Destination': Destination, 'Message': Message})
+            return {'MessageId': f'local-{len(self.sent)}'}
+
+
+class LocalS3:
+    """Stand-in for the S3 client: objects are kept in 'objects' by (bucket, key)"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects = {}
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+    def _object(self, Bucket, Key) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            stored = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise LocalClientError('404', 'Not Found')
+        return stored
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as file:
+            body = file.read()
+        with self.lock:
+            self.objects[(Bucket, Key)] = {'Body': body, 'ETag': f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        stored = self._object(Bucket, Key)
+        return {'ETag': stored['ETag'], 'ContentLength': len(stored['Body'])}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        stored = self._object(Bucket, Key)
+        with open(Filename, 'wb') as file:
+            file.write(stored['Body'])
+        with self.lock:
+            self.downloads += 1
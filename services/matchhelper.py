@@ -0,0 +1,282 @@
+import logging
+
+from services import aws_service, dataloader
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+MATCH_INDEX_DYNAMO_NAME = 'match_index'
+MATCH_DYNAMO_NAME = 'match'
+USER_DYNAMO_NAME = 'user'
+DELIMITER = '---'
+# lists the genders other than male and female held by indexed users
+GENDER_PARTITION = 'gender'
+LOCATION_SCORE = 3
+INTEREST_SCORE = 1
+MATCH_SIZE = 10
+MATCH_DEPTH = 30
+# the user attributes candidate_partitions depends on
+INDEXED_USER_FIELDS = ['email', 'status', 'gender', 'location', 'interest1', 'interest2', 'interest3']
+
+"""
+Candidate Index Architecture
+In the DynamoDB table 'match_index', every data entity has a 'partition' as partition key
+and an 'email' as sort key.
+
+Every ACTIVE user is stored as a member of the partitions it can be matched through:
+1. 'location---{gender}---{location}'
+    The user lives in {location}. 'weight' is always 1.
+2. 'interest---{gender}---{interest}'
+    The user has {interest} as one of interest1-3. 'weight' is the number of interest
+    fields holding this value.
+For example,
+    { 'partition': 'location---female---New York', 'email': '2@2.2', 'weight': 1 }
+    { 'partition': 'interest---female---hiking', 'email': '2@2.2', 'weight': 1 }
+Genders are free text. Every gender besides male and female that an indexed user holds is
+recorded once in the GENDER_PARTITION partition, with the gender as 'email':
+    { 'partition': 'gender', 'email': 'non-binary' }
+
+To find the candidates of a user, only the location partition and the (at most 3) interest
+partitions of the expected gender are read, so the cost does not depend on the table size.
+The weights are enough to compute the same score as a full comparison of the profiles.
+
+Note:
+0. Use def update_candidate_index(user_old, user_new) whenever a user profile is written.
+1. def rebuild_candidate_index() backfills the index from the user table. It is the
+    'candidate_index' migration, a required step of every deploy that creates the table
+    (see migrate.py).
+"""
+
+"""
+Incremental Match Maintenance
+A match record keeps the MATCH_DEPTH best candidates with their scores, 'today' being the
+first MATCH_SIZE of them (ties broken by email):
+    { 'email': '1@1.1', 'today': ['2@2.2', '3@3.3'], 'scores': {'2@2.2': 4, '3@3.3': 1},
+      'complete': True }
+'scores' is always the exact head of the ranking; 'complete' tells that it holds every
+candidate with a positive score.
+
+When the profile of X changes, def update_matches(user_old, user_new) finds the users
+that score X through the same index, read from the partitions of the seeking gender: a
+seeker in X's location partition gives X 3 points, a seeker in one of X's interest
+partitions gives X the number of X's interest fields holding that interest. The old and
+the new profile are both looked up, so the users X leaves are found as well. Then, for each
+of these users with a match record, X is taken out of 'scores' and put back with its new
+score if it ranks before the last kept candidate (or the record is complete). The head
+stays exact, it only gets shorter when X drops behind it. Should it get shorter than
+MATCH_SIZE, the record is reset to an empty 'today' and match.get_match recomputes it on
+the next read.
+
+Only the changed records are written, so the cost is O(affected users). The record of X
+itself is recomputed when its own location, interests or gender changed.
+Records without 'scores' (written before it existed) are reset whenever X affects them.
+"""
+
+
+def expected_gender(gender: str) -> str:
+    return 'female' if gender == 'male' else 'male'
+
+
+def interests(user: dict) -> list:
+    return [user.get('interest1'), user.get('interest2'), user.get('interest3')]
+
+
+def location_partition(gender: str, location: str) -> str:
+    return f'location{DELIMITER}{gender}{DELIMITER}{location}'
+
+
+def interest_partition(gender: str, interest: str) -> str:
+    return f'interest{DELIMITER}{gender}{DELIMITER}{interest}'
+
+
+def candidate_partitions(user: dict or None) -> dict:
+    """Map every partition the user is a member of to the weight of the membership"""
+    if user is None or user.get('status') != 'ACTIVE' or user.get('gender') is None:
+        return {}
+
+    partitions = {}
+    if user.get('location') is not None:
+        partitions[location_partition(user['gender'], user['location'])] = 1
+    for interest in interests(user):
+        if interest is None:
+            continue
+        partition = interest_partition(user['gender'], interest)
+        partitions[partition] = partitions.get(partition, 0) + 1
+    return partitions
+
+
+def indexed_genders() -> list:
+    """The genders besides male and female of the indexed users"""
+    return [member['email'] for member in get_partition_members(GENDER_PARTITION)]
+
+
+def seeker_genders(gender: str) -> list:
+    """The genders of the users that are matched with a user of this gender, every gender
+    whose expected_gender it is"""
+    if gender not in ('male', 'female'):
+        # expected_gender never returns anything else
+        return []
+    genders = {'male', 'female'}
+    if gender == expected_gender(None):
+        # users of every other gender are matched with this one as well
+        genders.update(indexed_genders())
+    return sorted(g for g in genders if expected_gender(g) == gender)
+
+
+def seeker_partitions(user: dict or None) -> dict:
+    """Map every partition whose members score the user to the points they give"""
+    if user is None or user.get('status') != 'ACTIVE':
+        return {}
+
+    partitions = {}
+    for gender in seeker_genders(user.get('gender')):
+        if user.get('location') is not None:
+            partitions[location_partition(gender, user['location'])] = LOCATION_SCORE
+        for interest in interests(user):
+            if interest is None:
+                continue
+            partition = interest_partition(gender, interest)
+            partitions[partition] = partitions.get(partition, 0) + INTEREST_SCORE
+    return partitions
+
+
+def seeker_scores(partitions: dict, email: str) -> dict:
+    """Score the user of these seeker partitions for every seeker"""
+    scores = {}
+    for partition, points in partitions.items():
+        for member in get_partition_members(partition):
+            scores[member['email']] = scores.get(member['email'], 0) + points
+    scores.pop(email, None)
+    return scores
+
+
+def rank_key(entry: tuple) -> tuple:
+    return -entry[1], entry[0]
+
+
+def match_record(email: str, scores: dict) -> dict:
+    """The match record of a user from the scores of all its candidates"""
+    ranked = sorted(scores.items(), key=rank_key)
+    return ranked_record(email, ranked[:MATCH_DEPTH], len(ranked) <= MATCH_DEPTH)
+
+
+def ranked_record(email: str, ranked: list, complete: bool) -> dict:
+    return {'email': email, 'today': [e for e, _ in ranked[:MATCH_SIZE]], 'scores': dict(ranked),
+            'complete': complete}
+
+
+def rescore(record: dict, email: str, score: int) -> dict or None:
+    """Apply the new score of email to a match record, None if nothing changed"""
+    today, scores = record.get('today') or [], record.get('scores')
+    if not today:
+        # recomputed on the next read anyway
+        return None
+    if scores is None:
+        stale = email in today or score > 0
+        return {'email': record['email'], 'today': []} if stale else None
+
+    complete = record.get('complete', False)
+    ranked = sorted(((e, s) for e, s in scores.items() if e != email), key=rank_key)
+    if score > 0 and (complete or (ranked and rank_key((email, score)) < rank_key(ranked[-1]))):
+        ranked.append((email, score))
+        ranked.sort(key=rank_key)
+    if len(ranked) > MATCH_DEPTH:
+        ranked, complete = ranked[:MATCH_DEPTH], False
+    if len(ranked) < MATCH_SIZE and not complete:
+        return {'email': record['email'], 'today': [], 'scores': {}}
+
+    if dict(ranked) == scores and complete == record.get('complete', False):
+        return None
+    return ranked_record(record['email'], ranked, complete)
+
+
+def update_matches(user_old: dict or None, user_new: dict) -> int:
+    """Bring the stored match lists in line with the profile change, returns the number of
+    records written"""
+    email = user_new['email']
+    writes = []
+
+    # the own list depends on the same gender, location and interests as the index entries
+    if candidate_partitions(user_old) != candidate_partitions(user_new):
+        own = dataloader.get(MATCH_DYNAMO_NAME, {'email': email})
+        if own is not None and own.get('today'):
+            writes.append(match_record(email, find_candidates(user_new)))
+
+    partitions_old, partitions_new = seeker_partitions(user_old), seeker_partitions(user_new)
+    if partitions_old != partitions_new:
+        scores_old = seeker_scores(partitions_old, email)
+        scores_new = seeker_scores(partitions_new, email)
+        seekers = sorted(set(scores_old) | set(scores_new))
+        records = dataloader.load_many(MATCH_DYNAMO_NAME, [{'email': seeker} for seeker in seekers])
+        for record in records:
+            if record is None:
+                continue
+            updated = rescore(record, email, scores_new.get(record['email'], 0))
+            if updated is not None:
+                writes.append(updated)
+
+    if writes:
+        match_db = aws_service.dynamo_client_factory(MATCH_DYNAMO_NAME)
+        with match_db.batch_writer() as batch:
+            for record in writes:
+                batch.put_item(Item=record)
+        for record in writes:
+            dataloader.forget(MATCH_DYNAMO_NAME, record)
+    logger.info('Profile change of %s rewrote %d match records', email, len(writes))
+    return len(writes)
+
+
+def update_candidate_index(user_old: dict or None, user_new: dict):
+    partitions_old = candidate_partitions(user_old)
+    partitions_new = candidate_partitions(user_new)
+    if partitions_old == partitions_new:
+        return
+
+    email = user_new['email']
+    index = aws_service.dynamo_client_factory(MATCH_INDEX_DYNAMO_NAME)
+    with index.batch_writer() as batch:
+        if partitions_new and user_new['gender'] not in ('male', 'female'):
+            batch.put_item(Item={'partition': GENDER_PARTITION, 'email': user_new['gender']})
+        for partition in partitions_old:
+            if partition not in partitions_new:
+                batch.delete_item(Key={'partition': partition, 'email': email})
+        for partition, weight in partitions_new.items():
+            if partitions_old.get(partition) != weight:
+                batch.put_item(Item={'partition': partition, 'email': email, 'weight': weight})
+
+
+def get_partition_members(partition: str) -> list:
+    return list(aws_service.query(
+        MATCH_INDEX_DYNAMO_NAME,
+        KeyConditionExpression='#partition = :partition',
+        ExpressionAttributeNames={'#partition': 'partition'},
+        ExpressionAttributeValues={':partition': partition}
+    ))
+
+
+def find_candidates(user: dict) -> dict:
+    """Score every candidate of the user: the same location gains 3 points, every interest
+    of the candidate found in the user's interests gains 1 point"""
+    gender = expected_gender(user['gender'])
+    scores = {}
+
+    for member in get_partition_members(location_partition(gender, user['location'])):
+        scores[member['email']] = scores.get(member['email'], 0) + LOCATION_SCORE
+
+    for interest in set(interests(user)):
+        if interest is None:
+            continue
+        for member in get_partition_members(interest_partition(gender, interest)):
+            scores[member['email']] = scores.get(member['email'], 0) + \
+                                      INTEREST_SCORE * int(member['weight'])
+
+    scores.pop(user['email'], None)
+    return scores
+
+
+def rebuild_candidate_index():
+    count = 0
+    for user in aws_service.scan(USER_DYNAMO_NAME, projection=INDEXED_USER_FIELDS):
+        update_candidate_index(None, user)
+        count += 1
+    logger.info('Candidate index rebuilt from %s users', count)
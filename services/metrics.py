@@ -0,0 +1,265 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from services import serializer
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+NAMESPACE = 'Mulberry'
+ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+EMIT_RECORDS = os.environ.get('METRICS_EMIT', '1') == '1'
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 0.01))
+LOG_PAYLOAD_LIMIT = int(os.environ.get('LOG_PAYLOAD_LIMIT', 2048))
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf')]
+
+# operations that can report the capacity they consumed
+CAPACITY_OPERATIONS = {'GetItem', 'PutItem', 'UpdateItem', 'DeleteItem', 'Query', 'Scan',
+                       'BatchGetItem', 'BatchWriteItem', 'TransactGetItems', 'TransactWriteItems'}
+
+"""
+Request Metrics
+request_dispatcher calls def start_request and def finish_request around every invocation.
+finish_request writes one compact JSON line per request in the CloudWatch Embedded Metric
+Format, so CloudWatch derives the metrics (and their percentiles) from the log without any
+API call:
+    { "_aws": {...}, "route": "GET /chat", "status": 200, "cold": false,
+      "latency_ms": 12.3, "request_bytes": 0, "response_bytes": 893,
+      "dynamo_calls": 1, "dynamo_capacity": 0.5, "item_bytes": 812,
+      "dynamo": {"mulberry-chat-summary": [1, 0.5, 812]} }
+
+1. DynamoDB calls are counted per table by botocore event hooks (def instrument_client),
+    which also ask DynamoDB for ReturnConsumedCapacity=TOTAL. The local stand-in reports
+    its calls through its listeners instead, with the capacity estimated from item sizes.
+    Calls made on the workers of services.fanout are added to the request that started them.
+    'item_bytes' is the size of the items read through services.repository, see
+    def record_item_bytes.
+2. 'cold' is true for the first request served by the container.
+3. Latencies are also kept in per-route histograms in memory, see def snapshot.
+
+Full request and response payloads are logged only for a LOG_SAMPLE_RATE share of the
+requests (and for failed ones, except the 429 of services.ratelimit), cut to
+LOG_PAYLOAD_LIMIT characters.
+"""
+
+_local = threading.local()
+_lock = threading.Lock()
+_cold_start = True
+_histograms = {}
+
+
+def _state():
+    if not hasattr(_local, 'dynamo'):
+        _local.start = None
+        _local.sampled = False
+        _local.dynamo = {}
+    return _local
+
+
+def start_request():
+    state = _state()
+    state.start = time.perf_counter()
+    state.sampled = random.random() < LOG_SAMPLE_RATE
+    state.dynamo = {}
+
+
+def record_dynamo_call(table: str, capacity: float = 0.0):
+    if not ENABLED:
+        return
+    state = _state()
+    calls = state.dynamo.get(table)
+    if calls is None:
+        state.dynamo[table] = [1, capacity, 0]
+    else:
+        calls[0] += 1
+        calls[1] += capacity
+
+
+def record_item_bytes(table: str, item_bytes: int):
+    """Add the size of items read from the table, counted next to its calls"""
+    if not ENABLED:
+        return
+    state = _state()
+    calls = state.dynamo.get(table)
+    if calls is None:
+        state.dynamo[table] = [0, 0.0, item_bytes]
+    else:
+        calls[2] += item_bytes
+
+
+def take_dynamo_calls() -> dict:
+    """Return the DynamoDB calls recorded on this thread and start over, see services.fanout"""
+    state = _state()
+    dynamo, state.dynamo = state.dynamo, {}
+    return dynamo
+
+
+def merge_dynamo_calls(dynamo: dict):
+    """Add DynamoDB calls recorded on another thread to the request of this thread"""
+    state = _state()
+    for table, calls in dynamo.items():
+        recorded = state.dynamo.get(table)
+        if recorded is None:
+            state.dynamo[table] = list(calls)
+        else:
+            for index, value in enumerate(calls):
+                recorded[index] += value
+
+
+def log_payload(label: str, payload, force: bool = False):
+    """Log the payload if this request is sampled (or force), cut to LOG_PAYLOAD_LIMIT"""
+    if not (force or _state().sampled):
+        return
+    text = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+    if len(text) > LOG_PAYLOAD_LIMIT:
+        text = f'{text[:LOG_PAYLOAD_LIMIT]}... ({len(text)} characters)'
+    logger.info('%s: %s', label, text)
+
+
+def body_bytes(message: dict or None) -> int:
+    """Size in bytes of the body of an API Gateway event or response"""
+    body = (message or {}).get('body')
+    if not body:
+        return 0
+    if isinstance(body, bytes):
+        return len(body)
+    if message.get('isBase64Encoded'):
+        # the size of the bytes it stands for
+        return len(body) * 3 // 4 - body.count('=', -2)
+    return len(body.encode())
+
+
+def finish_request(event: dict, response: dict or None) -> dict or None:
+    global _cold_start
+    state = _state()
+    if not ENABLED or state.start is None:
+        return None
+    latency = (time.perf_counter() - state.start) * 1000
+    state.start = None
+    cold, _cold_start = _cold_start, False
+
+    route = f'{event.get("httpMethod")} {event.get("resource")}'
+    status = response['statusCode'] if response else 500
+    dynamo = state.dynamo
+    record = {
+        'route': route,
+        'status': status,
+        'cold': cold,
+        'latency_ms': round(latency, 3),
+        'request_bytes': body_bytes(event),
+        'response_bytes': body_bytes(response),
+        'dynamo_calls': sum(calls[0] for calls in dynamo.values()),
+        'dynamo_capacity': round(sum(calls[1] for calls in dynamo.values()), 2),
+        'item_bytes': sum(calls[2] for calls in dynamo.values()),
+        'dynamo': dynamo
+    }
+    _observe(route, latency)
+    # rejected requests come in floods, their payloads are only sampled
+    if status not in (200, 429):
+        log_payload('Request', event, force=True)
+    if EMIT_RECORDS:
+        _emit(record)
+    return record
+
+
+def _emit(record: dict):
+    emf = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['route']],
+                'Metrics': [
+                    {'Name': 'latency_ms', 'Unit': 'Milliseconds'},
+                    {'Name': 'request_bytes', 'Unit': 'Bytes'},
+                    {'Name': 'response_bytes', 'Unit': 'Bytes'},
+                    {'Name': 'dynamo_calls', 'Unit': 'Count'},
+                    {'Name': 'dynamo_capacity', 'Unit': 'Count'},
+                    {'Name': 'item_bytes', 'Unit': 'Bytes'}
+                ]
+            }]
+        }
+    }
+    emf.update(record)
+    # EMF lines must reach the log unprefixed, so they bypass the logging handlers
+    sys.stdout.write(serializer.dumps(emf) + '\n')
+
+
+def _observe(route: str, latency: float):
+    with _lock:
+        histogram = _histograms.get(route)
+        if histogram is None:
+            histogram = _histograms[route] = {'count': 0, 'sum_ms': 0.0,
+                                              'buckets': [0] * len(LATENCY_BUCKETS_MS)}
+        histogram['count'] += 1
+        histogram['sum_ms'] += latency
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency <= bound:
+                histogram['buckets'][index] += 1
+                break
+
+
+def snapshot() -> dict:
+    """Per-route latency histograms since the container started (or the last reset)"""
+    with _lock:
+        return {route: {'count': histogram['count'],
+                        'sum_ms': round(histogram['sum_ms'], 3),
+                        'buckets': {str(bound): count for bound, count
+                                    in zip(LATENCY_BUCKETS_MS, histogram['buckets']) if count}}
+                for route, histogram in _histograms.items()}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def _request_capacity(params, model, **kwargs):
+    if model.name in CAPACITY_OPERATIONS:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+
+def _remember_tables(params, context, **kwargs):
+    if 'TableName' in params:
+        context['metrics_tables'] = [params['TableName']]
+    else:
+        context['metrics_tables'] = list(params.get('RequestItems') or
+                                         [item[kind]['TableName'] for item in params.get('TransactItems', [])
+                                          for kind in item])
+
+
+def _count_call(parsed, context, **kwargs):
+    consumed = parsed.get('ConsumedCapacity') if isinstance(parsed, dict) else None
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    capacity = {entry['TableName']: entry.get('CapacityUnits', 0.0) for entry in consumed or []}
+    for table in context.get('metrics_tables') or ['unknown']:
+        record_dynamo_call(table, capacity.get(table, 0.0))
+
+
+def instrument_client(client):
+    """Count the calls made by a botocore DynamoDB client, see aws_service.dynamo_resource"""
+    events = client.meta.events
+    events.register('before-parameter-build.dynamodb', _request_capacity, unique_id='metrics-capacity')
+    events.register('before-parameter-build.dynamodb', _remember_tables, unique_id='metrics-tables')
+    events.register('after-call.dynamodb', _count_call, unique_id='metrics-count')
+
+
+def instrument_local(resource):
+    """Count the calls made on a services.local_aws.LocalDynamoResource"""
+    if getattr(resource, 'metrics_listener', None) is not None:
+        return
+
+    def listener(table, operation, bytes_read, bytes_written):
+        # read units cover 4 KB, write units 1 KB
+        capacity = bytes_read / 4096 + bytes_written / 1024
+        for name in table.split(','):
+            record_dynamo_call(name, capacity)
+
+    resource.metrics_listener = listener
+    resource.listeners.append(listener)
@@ -0,0 +1,169 @@
+import logging
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from services import aws_service
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+OUTBOX_DYNAMO_NAME = 'outbox'
+OUTBOX_DUE_INDEX = 'state-next_attempt_at-index'
+STATE_PENDING = 'PENDING'
+STATE_SENT = 'SENT'
+STATE_DEAD = 'DEAD'
+
+BATCH_SIZE = 25
+SEND_CONCURRENCY = 8
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_MS = 30 * 1000
+BACKOFF_MAX_MS = 30 * 60 * 1000
+LEASE_MS = 60 * 1000
+SENT_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+"""
+Email Outbox Architecture
+Requests never talk to SES. They write an email job into the DynamoDB table 'outbox' and
+return; def drain sends the jobs later (see outbox_worker.drain_handler).
+
+A job has 'id' as partition key and looks like
+    { 'id': '...', 'state': 'PENDING', 'target': 'a@b.c', 'subject': '...', 'body': '...',
+      'attempts': 0, 'next_attempt_at': 1683000000000, 'created_at': 1683000000000 }
+next_attempt_at is epoch milliseconds. The global secondary index
+'state-next_attempt_at-index' finds the PENDING jobs that are due, oldest first.
+
+1. A drainer claims a job by moving next_attempt_at LEASE_MS into the future, on the
+    condition that nobody else did it first. If the drainer dies, the job is due again
+    once the lease runs out, so no job is lost. Delivery is therefore at least once.
+2. The claimed batch is sent concurrently with the shared SES client.
+3. A sent job becomes SENT and gets 'expires_at', the TTL attribute of the table.
+4. A failed job is retried with exponential backoff and jitter. After MAX_ATTEMPTS it
+    becomes DEAD and keeps 'last_error' for inspection; def requeue revives it.
+"""
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def enqueue_email(target: str, subject: str, body: str) -> str:
+    now = _now_ms()
+    job_id = uuid.uuid4().hex
+    aws_service.dynamo_client_factory(OUTBOX_DYNAMO_NAME).put_item(Item={
+        'id': job_id,
+        'state': STATE_PENDING,
+        'target': target,
+        'subject': subject,
+        'body': body,
+        'attempts': 0,
+        'next_attempt_at': now,
+        'created_at': now
+    })
+    logger.info('Email to %s queued as job %s', target, job_id)
+    return job_id
+
+
+def due_jobs(limit: int = BATCH_SIZE) -> list:
+    response = aws_service.dynamo_client_factory(OUTBOX_DYNAMO_NAME).query(
+        IndexName=OUTBOX_DUE_INDEX,
+        KeyConditionExpression='#state = :state AND #next_attempt_at <= :now',
+        ExpressionAttributeNames={'#state': 'state', '#next_attempt_at': 'next_attempt_at'},
+        ExpressionAttributeValues={':state': STATE_PENDING, ':now': _now_ms()},
+        Limit=limit
+    )
+    return response['Items']
+
+
+def claim(job: dict) -> bool:
+    try:
+        aws_service.dynamo_client_factory(OUTBOX_DYNAMO_NAME).update_item(
+            Key={'id': job['id']},
+            UpdateExpression='SET #next_attempt_at = :lease',
+            ConditionExpression='#state = :state AND #next_attempt_at = :seen',
+            ExpressionAttributeNames={'#state': 'state', '#next_attempt_at': 'next_attempt_at'},
+            ExpressionAttributeValues={':state': STATE_PENDING, ':seen': job['next_attempt_at'],
+                                       ':lease': _now_ms() + LEASE_MS}
+        )
+        return True
+    except Exception as e:
+        if aws_service.is_condition_failure(e):
+            # another drainer got it
+            return False
+        raise
+
+
+def backoff_ms(attempts: int) -> int:
+    delay = min(BACKOFF_MAX_MS, BACKOFF_BASE_MS * 2 ** (attempts - 1))
+    return int(delay / 2 + random.random() * delay / 2)
+
+
+def mark_sent(job: dict):
+    aws_service.dynamo_client_factory(OUTBOX_DYNAMO_NAME).update_item(
+        Key={'id': job['id']},
+        UpdateExpression='SET #state = :state, sent_at = :now, expires_at = :expires ADD attempts :one',
+        ExpressionAttributeNames={'#state': 'state'},
+        ExpressionAttributeValues={':state': STATE_SENT, ':now': _now_ms(), ':one': 1,
+                                   ':expires': int(time.time()) + SENT_RETENTION_SECONDS}
+    )
+
+
+def mark_failed(job: dict, error: str) -> str:
+    attempts = int(job['attempts']) + 1
+    state = STATE_DEAD if attempts >= MAX_ATTEMPTS else STATE_PENDING
+    aws_service.dynamo_client_factory(OUTBOX_DYNAMO_NAME).update_item(
+        Key={'id': job['id']},
+        UpdateExpression='SET #state = :state, attempts = :attempts, last_error = :error, '
+                         '#next_attempt_at = :next',
+        ExpressionAttributeNames={'#state': 'state', '#next_attempt_at': 'next_attempt_at'},
+        ExpressionAttributeValues={':state': state, ':attempts': attempts, ':error': error,
+                                   ':next': _now_ms() + backoff_ms(attempts)}
+    )
+    if state == STATE_DEAD:
+        logger.error('Email job %s to %s is dead after %d attempts: %s', job['id'], job['target'],
+                     attempts, error)
+    return state
+
+
+def send(job: dict) -> str:
+    if aws_service.ses_send_email(job['target'], job['subject'], job['body']):
+        mark_sent(job)
+        return STATE_SENT
+    return mark_failed(job, 'SES send_email failed')
+
+
+def drain(max_jobs: int = None, deadline: float = None) -> dict:
+    """Send due jobs batch by batch until none is left, max_jobs were handled or the
+    deadline (time.time() seconds) has passed"""
+    stats = {STATE_SENT: 0, 'RETRY': 0, STATE_DEAD: 0, 'skipped': 0}
+    handled = 0
+    with ThreadPoolExecutor(max_workers=SEND_CONCURRENCY) as pool:
+        while max_jobs is None or handled < max_jobs:
+            if deadline is not None and time.time() >= deadline:
+                break
+            limit = BATCH_SIZE if max_jobs is None else min(BATCH_SIZE, max_jobs - handled)
+            jobs = due_jobs(limit)
+            if not jobs:
+                break
+
+            claimed = [job for job in jobs if claim(job)]
+            stats['skipped'] += len(jobs) - len(claimed)
+            for state in pool.map(send, claimed):
+                stats['RETRY' if state == STATE_PENDING else state] += 1
+            handled += len(jobs)
+
+    logger.info('Outbox drained: %s', stats)
+    return stats
+
+
+def requeue(job_id: str):
+    """Give a DEAD job a fresh set of attempts"""
+    aws_service.dynamo_client_factory(OUTBOX_DYNAMO_NAME).update_item(
+        Key={'id': job_id},
+        UpdateExpression='SET #state = :pending, attempts = :zero, #next_attempt_at = :now',
+        ConditionExpression='#state = :dead',
+        ExpressionAttributeNames={'#state': 'state', '#next_attempt_at': 'next_attempt_at'},
+        ExpressionAttributeValues={':pending': STATE_PENDING, ':dead': STATE_DEAD, ':zero': 0,
+                                   ':now': _now_ms()}
+    )
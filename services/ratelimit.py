@@ -0,0 +1,138 @@
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+
+from services import aws_service
+from services.authentication_service import AUTHENTICATION_DISABLED_RESOURCES
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+SHARED_ENABLED = os.environ.get('RATE_LIMIT_SHARED', '0') == '1'
+RATELIMIT_DYNAMO_NAME = 'ratelimit'
+SHARED_WINDOW = 60
+MAX_BUCKETS = 100000
+# share of MAX_BUCKETS freed when no bucket is idle
+EVICTED_SHARE = 0.1
+
+# (burst, tokens per second, counted across containers) per client and route
+DEFAULT_BUDGET = (60, 10.0, False)
+ROUTE_BUDGETS = {
+    # may recompute the match list
+    ('/match', 'GET'): (10, 0.2, True),
+    ('/user/batch', 'POST'): (20, 2.0, False),
+    # polled by the clients
+    ('/chat', 'GET'): (30, 2.0, False),
+    ('/chat/message', 'GET'): (30, 2.0, True),
+    ('/chat/unread', 'GET'): (30, 2.0, False),
+    # send emails or check passwords, counted per source IP
+    ('/user/signup', 'POST'): (5, 0.05, True),
+    ('/user/login', 'POST'): (10, 0.5, True),
+    ('/user/verify/resend/{email}', 'POST'): (3, 1 / 60, True),
+    ('/user/verify/{token}', 'POST'): (10, 0.5, True)
+}
+
+"""
+Admission Control
+request_dispatcher asks def admit before calling a handler. Every client has a token bucket
+per route: it holds up to 'burst' tokens, refills at 'tokens per second' and every request
+takes one. A request finding the bucket empty is answered with 429 and a Retry-After header,
+without touching DynamoDB. Expensive and polled routes have their own, stricter budgets in
+ROUTE_BUDGETS, every other route gets DEFAULT_BUDGET.
+
+1. The client is the email of the token, or the source IP for the routes that need no token.
+2. The buckets live in the container, so a client spread over N containers gets up to N times
+    its budget. With RATE_LIMIT_SHARED=1 the routes whose budget is counted across containers
+    also take a slot in the 'ratelimit' table: a counter per client, route and SHARED_WINDOW
+    seconds, limited to burst + rate * SHARED_WINDOW with a conditional update_item, and
+    deleted by the TTL on 'expires_at'. When the table cannot be reached the request is let
+    through, admission control must not take the API down.
+3. Idle buckets are dropped once more than MAX_BUCKETS exist. When none is idle (many
+    clients, or one spoofing identities), the least recently updated EVICTED_SHARE of them
+    are dropped, those clients start again from a full bucket.
+"""
+
+_lock = threading.Lock()
+_buckets = {}
+
+
+def client_identity(event: dict) -> str:
+    if event.get('resource') in AUTHENTICATION_DISABLED_RESOURCES:
+        return 'ip:' + str(((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp'))
+    return event['email']
+
+
+def _take_token(key: tuple, burst: int, rate: float, now: float) -> float:
+    """Take a token from the bucket, return 0 or the seconds until one is available"""
+    with _lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            if len(_buckets) >= MAX_BUCKETS:
+                _prune(now)
+            bucket = _buckets[key] = [float(burst), now]
+        tokens = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+
+def _prune(now: float):
+    # a bucket idle long enough to be full again is the same as no bucket
+    for key, (tokens, updated) in list(_buckets.items()):
+        burst, rate, _ = ROUTE_BUDGETS.get(key[1], DEFAULT_BUDGET)
+        if tokens + (now - updated) * rate >= burst:
+            del _buckets[key]
+    if len(_buckets) >= MAX_BUCKETS:
+        evicted = len(_buckets) - int(MAX_BUCKETS * (1 - EVICTED_SHARE))
+        for key in heapq.nsmallest(evicted, _buckets, key=lambda k: _buckets[k][1]):
+            del _buckets[key]
+        logger.warning('%d rate limit buckets, none idle, evicted the %d least recently updated',
+                       MAX_BUCKETS, evicted)
+
+
+def _take_shared_slot(identity: str, route: tuple, burst: int, rate: float, now: float) -> float:
+    """Count the request in the shared table, return 0 or the seconds until the next window"""
+    window = int(now // SHARED_WINDOW)
+    try:
+        aws_service.dynamo_client_factory(RATELIMIT_DYNAMO_NAME).update_item(
+            Key={'key': f'{identity}|{route[1]} {route[0]}|{window}'},
+            UpdateExpression='ADD #count :one SET #expires_at = :expires_at',
+            ConditionExpression='attribute_not_exists(#count) OR #count < :limit',
+            ExpressionAttributeNames={'#count': 'count', '#expires_at': 'expires_at'},
+            ExpressionAttributeValues={':one': 1, ':limit': int(burst + rate * SHARED_WINDOW),
+                                       ':expires_at': (window + 2) * SHARED_WINDOW}
+        )
+        return 0.0
+    except Exception as e:
+        if aws_service.is_condition_failure(e):
+            return (window + 1) * SHARED_WINDOW - now
+        logger.error('Shared rate limit unavailable, request admitted - %r', e)
+        return 0.0
+
+
+def admit(identity: str, route: tuple) -> int or None:
+    """None if the request may proceed, otherwise the seconds to wait before retrying"""
+    if not ENABLED:
+        return None
+    burst, rate, shared = ROUTE_BUDGETS.get(route, DEFAULT_BUDGET)
+    now = time.time()
+    wait = _take_token((identity, route), burst, rate, now)
+    if wait == 0 and shared and SHARED_ENABLED:
+        wait = _take_shared_slot(identity, route, burst, rate, now)
+    if wait == 0:
+        return None
+    logger.debug('Rate limited %s on %s %s for %.1fs', identity, route[1], route[0], wait)
+    return max(1, math.ceil(wait))
+
+
+def reset():
+    """Forget every bucket of this container"""
+    with _lock:
+        _buckets.clear()
@@ -0,0 +1,173 @@
+import logging
+from decimal import Decimal
+from typing import List, TypedDict
+
+from services import aws_service, metrics
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# The attributes the handlers read, by purpose
+USER_MATCHING = ['email', 'gender', 'location', 'interest1', 'interest2', 'interest3']
+USER_NAME = ['email', 'name']
+
+"""
+Data Access Layer
+Typed reads of the 'user', 'message', 'message_item', 'chat_summary', 'activity' and 'match'
+tables. The TypedDicts below describe their items, any attribute may be missing.
+
+1. Every read takes the attributes its caller needs, which are sent as ProjectionExpression
+    (the key attributes are always included), attributes=None reads the whole item.
+    DynamoDB charges read units for the whole item whatever the projection, but only the
+    projected attributes cross the network and are deserialized into Lambda memory.
+2. The size of every item returned is computed with def item_size, as DynamoDB sizes items,
+    and added to the request's metrics (see metrics.record_item_bytes) next to the read
+    units DynamoDB reports for the call.
+
+    user = repository.get_user(email, ['photo'])
+"""
+
+
+class User(TypedDict, total=False):
+    email: str
+    status: str
+    password: str
+    created_ts: str
+    email_verified: bool
+    name: str
+    gender: str
+    location: str
+    interest1: str
+    interest2: str
+    interest3: str
+    photo: str
+
+
+class ConversationSummary(TypedDict, total=False):
+    email: str
+    partner_email: str
+    partner_name: str
+    last_message: str
+    last_timestamp: str
+    last_seq: str
+    read: bool
+
+
+class Message(TypedDict, total=False):
+    conversation: str
+    seq: str
+    sender_email: str
+    message: str
+    timestamp: str
+
+
+class Activity(TypedDict, total=False):
+    id: str
+    activity_name: str
+    advertiser_name: str
+    address: str
+    discount: str
+    user1_name: str
+    user2_name: str
+    user1_email: str
+    user2_email: str
+    user1_accept: bool
+    user2_accept: bool
+    origin_price: str
+    arrange_time: str
+
+
+class MatchRecord(TypedDict, total=False):
+    email: str
+    today: List[str]
+    scores: dict
+    complete: bool
+
+
+def item_size(value) -> int:
+    """Approximate DynamoDB item size in bytes"""
+    if isinstance(value, dict):
+        return 3 + sum(len(k.encode()) + item_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 3 + sum(1 + item_size(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return sum(item_size(v) for v in value)
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, Decimal)):
+        return len(str(value).lstrip('-').replace('.', '')) // 2 + 2
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    raise TypeError(f'Unsupported type "{type(value)}" for value "{value}"')
+
+
+def projection(table: str, attributes: list or None) -> dict:
+    """ProjectionExpression and its names for the attributes and the key of the table"""
+    return aws_service.projection_expression(table, attributes)
+
+
+def _record(table: str, items: list):
+    metrics.record_item_bytes(aws_service.dynamo_tables[table], sum(item_size(item) for item in items))
+
+
+def get_item(table: str, key: dict, attributes: list = None) -> dict or None:
+    item = aws_service.dynamo_client_factory(table).get_item(
+        Key=key, **projection(table, attributes)).get('Item')
+    if item is not None:
+        _record(table, [item])
+    return item
+
+
+def query(table: str, attributes: list = None, **request) -> dict:
+    """One query call, request holds its parameters besides the projection"""
+    if attributes is not None:
+        names = projection(table, attributes)
+        request['ProjectionExpression'] = names['ProjectionExpression']
+        request['ExpressionAttributeNames'] = dict(request.get('ExpressionAttributeNames') or {},
+                                                   **names['ExpressionAttributeNames'])
+    response = aws_service.dynamo_client_factory(table).query(**request)
+    _record(table, response['Items'])
+    return response
+
+
+def query_items(table: str, attributes: list = None, **request):
+    """Yield the items of every page of the query, see aws_service.query"""
+    return aws_service.query(table, projection=attributes, on_page=lambda page: _record(table, page['Items']),
+                             **request)
+
+
+def batch_get(table: str, keys: list, attributes: list = None) -> list:
+    """The items of the keys found in the table, in no particular order, see aws_service.batch_get"""
+    items = aws_service.batch_get(table, keys, projection=attributes)
+    _record(table, items)
+    return items
+
+
+def scan_users(attributes: list = None, segments: int = 1) -> list:
+    """Every user of the table, see aws_service.scan for the segments"""
+    return list(aws_service.scan('user', projection=attributes, segments=segments,
+                                 on_page=lambda page: _record('user', page['Items'])))
+
+
+def get_user(email: str, attributes: list = None) -> User or None:
+    return get_item('user', {'email': email}, attributes)
+
+
+def get_users(emails: list, attributes: list = None) -> list:
+    """The users of the emails in the same order, None for the missing ones"""
+    users = {user['email']: user for user in batch_get('user', [{'email': email} for email in emails], attributes)}
+    return [users.get(email) for email in emails]
+
+
+def get_summary(email: str, partner_email: str, attributes: list = None) -> ConversationSummary or None:
+    return get_item('chat_summary', {'email': email, 'partner_email': partner_email}, attributes)
+
+
+def get_activity(act_id: str, attributes: list = None) -> Activity or None:
+    return get_item('activity', {'id': act_id}, attributes)
+
+
+def get_match_record(email: str, attributes: list = None) -> MatchRecord or None:
+    return get_item('match', {'email': email}, attributes)
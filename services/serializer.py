@@ -0,0 +1,95 @@
+import base64
+import datetime
+import gzip
+import json
+import logging
+import os
+import zlib
+from decimal import Decimal
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# API Gateway needs '*/*' among the binary media types first, see below
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', '0') == '1'
+COMPRESSION_THRESHOLD = int(os.environ.get('COMPRESSION_THRESHOLD', 4096))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 1))
+
+"""
+Response Serialization
+def dumps turns handler output into the JSON body of the response.
+1. Items read from DynamoDB hold numbers as Decimal: integral values are written as
+    integers, the others as floats. Dates and datetimes are written in ISO 8601 and sets
+    (string sets of DynamoDB) as lists.
+2. orjson is used when it is installed, it is several times faster than the json module
+    and produces the same documents. Otherwise the json module is used, without the
+    whitespace it adds by default.
+
+With COMPRESSION_ENABLED, def encode_body compresses bodies of at least
+COMPRESSION_THRESHOLD bytes with gzip or deflate when the request's Accept-Encoding allows
+it. A compressed body is returned base64 encoded, with isBase64Encoded set, which API
+Gateway decodes back to binary only when the API has '*/*' among its binary media types,
+so it stays off until the API is configured that way. With that setting API Gateway
+base64 encodes every request body as well, def decode_body turns it back for the handlers.
+"""
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(value) -> str:
+    if orjson is not None:
+        return orjson.dumps(value, default=_default).decode()
+    return json.dumps(value, default=_default, separators=(',', ':'))
+
+
+def accepted_encoding(headers: dict or None) -> str or None:
+    """The compression to use for a client sending these request headers, if any"""
+    for name, value in (headers or {}).items():
+        if name.lower() == 'accept-encoding' and value:
+            accepted = {token.split(';')[0].strip().lower() for token in value.split(',')
+                        if not token.strip().endswith(';q=0')}
+            if 'gzip' in accepted:
+                return 'gzip'
+            if 'deflate' in accepted:
+                return 'deflate'
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=COMPRESSION_LEVEL, mtime=0)
+    return zlib.compress(body, COMPRESSION_LEVEL)
+
+
+def encode_body(body: str, headers: dict or None) -> tuple:
+    """Return (body, extra response headers, isBase64Encoded) for API Gateway"""
+    if not COMPRESSION_ENABLED or len(body) < COMPRESSION_THRESHOLD:
+        return body, {}, False
+    encoding = accepted_encoding(headers)
+    if encoding is None:
+        return body, {}, False
+    compressed = compress(body.encode(), encoding)
+    return (base64.b64encode(compressed).decode(),
+            {'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'}, True)
+
+
+def decode_body(body: str) -> str or bytes:
+    """The request body of an event with isBase64Encoded, as text unless it is not UTF-8"""
+    raw = base64.b64decode(body, validate=True)
+    try:
+        return raw.decode()
+    except UnicodeDecodeError:
+        return raw
@@ -0,0 +1,276 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from services import aws_service, matchhelper
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# needs SNAPSHOT_BUCKET, where match_batch publishes the snapshots
+ENABLED = os.environ.get('SNAPSHOT_ENABLED', '0') == '1'
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '/tmp')
+SNAPSHOT_BUCKET = os.environ.get('SNAPSHOT_BUCKET')
+SNAPSHOT_KEY = os.environ.get('SNAPSHOT_KEY', 'snapshots/users.bin')
+CHECK_INTERVAL = int(os.environ.get('SNAPSHOT_CHECK_INTERVAL', 300))
+FILE_NAME = 'mulberry-users.bin'
+MAGIC = b'MBSNAP01'
+ALIGNMENT = 64
+
+"""
+User Feature Snapshot
+match.make_new_match scores a user against every candidate of the expected gender. Instead
+of reading the candidate index partitions from DynamoDB, a warm container scores against a
+compact snapshot of the ACTIVE users, a file in SNAPSHOT_DIR that is memory mapped, so only
+the pages that are touched are read and the arrays are never copied into Python objects.
+
+File layout:
+    MAGIC | header length (uint32) | JSON header | arrays, each aligned to ALIGNMENT bytes
+The header holds the 'version', 'created_at', the 'vocabularies' of the dictionary encoded
+columns and the dtype, shape and offset of every array:
+1. 'location' (n) and 'interests' (n x 3) are codes into their vocabulary, -1 when missing,
+    in the smallest integer type that holds the vocabulary.
+2. The rows are ordered by gender, then email, 'genders' in the header maps every gender to
+    its [start, end) rows. Scoring only reads the rows of the expected gender.
+3. 'email_offsets' (n + 1, uint32) and 'email_bytes' (the UTF-8 emails back to back) form
+    the offset table of the emails, an email is decoded only when its row is selected.
+
+Refresh
+match_batch publishes the snapshot to SNAPSHOT_BUCKET after its daily run (see def publish),
+the only place the user table is scanned for it. With SNAPSHOT_ENABLED=1, def current checks
+the ETag (the version) of the object at most every CHECK_INTERVAL seconds, in a background
+thread so that no request waits for it, and downloads the snapshot only when it changed.
+When a refresh fails the snapshot in use is kept. Until a container has a snapshot, def current
+returns None and the caller falls back to the candidate index.
+
+numpy is imported by the functions that need it, so importing this module (and the match
+handler) stays cheap while the snapshot is disabled.
+
+Note:
+Profile changes after the snapshot was taken are missed by the records computed from it
+until the next refresh, matchhelper.update_matches applies the changes that follow the
+record write.
+"""
+
+_lock = threading.Lock()
+_current = None
+_checked_at = 0.0
+_refreshing = False
+
+
+def _dtype(size: int):
+    import numpy as np
+    for dtype in (np.int8, np.int16, np.int32):
+        if size <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _codes(values: list, vocabulary: dict, dtype):
+    import numpy as np
+    return np.array([vocabulary.get(v, -1) for v in values], dtype=dtype)
+
+
+def encode(users: list, version: str = None) -> bytes:
+    """The snapshot file of the users, only the ACTIVE users with a gender are kept"""
+    import numpy as np
+    users = sorted((u for u in users if u.get('status') == 'ACTIVE' and u.get('gender') is not None),
+                   key=lambda u: (u['gender'], u['email']))
+    vocabularies = {
+        'location': sorted({u['location'] for u in users if u.get('location') is not None}),
+        'interest': sorted({i for u in users for i in matchhelper.interests(u) if i is not None})
+    }
+    codes = {name: {value: code for code, value in enumerate(values)} for name, values in vocabularies.items()}
+
+    genders = {}
+    for row, user in enumerate(users):
+        genders.setdefault(user['gender'], [row, row])[1] = row + 1
+    emails = [u['email'].encode() for u in users]
+    offsets = np.zeros(len(emails) + 1, dtype=np.uint32)
+    np.cumsum([len(e) for e in emails], out=offsets[1:])
+    arrays = {
+        'location': _codes([u.get('location') for u in users], codes['location'],
+                           _dtype(len(codes['location']))),
+        'interests': np.stack([_codes([u.get(f'interest{i}') for u in users], codes['interest'],
+                                      _dtype(len(codes['interest']))) for i in (1, 2, 3)], axis=1)
+        if users else np.zeros((0, 3), dtype=np.int8),
+        'email_offsets': offsets,
+        'email_bytes': np.frombuffer(b''.join(emails), dtype=np.uint8)
+    }
+
+    created_at = time.time()
+    header = {'version': version or str(created_at), 'created_at': created_at, 'count': len(users),
+              'vocabularies': vocabularies, 'genders': genders, 'arrays': {}}
+    # the header size depends on the offsets written in it, reserve room for them first
+    reserved = len(json.dumps(dict(header, arrays={name: {'dtype': a.dtype.str, 'shape': list(a.shape),
+                                                          'offset': 2 ** 40}
+                                                   for name, a in arrays.items()})).encode())
+    offset = _align(len(MAGIC) + 4 + reserved)
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align(offset + array.nbytes)
+
+    encoded = json.dumps(header).encode().ljust(reserved)
+    buffer = bytearray(offset)
+    buffer[:len(MAGIC) + 4 + reserved] = MAGIC + struct.pack('<I', reserved) + encoded
+    for name, array in arrays.items():
+        start = header['arrays'][name]['offset']
+        buffer[start:start + array.nbytes] = np.ascontiguousarray(array).tobytes()
+    return bytes(buffer)
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+class Snapshot:
+    """A snapshot file mapped into memory, see the architecture above"""
+
+    def __init__(self, path: str, etag: str = None):
+        import numpy as np
+        with open(path, 'rb') as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a user snapshot')
+        length, = struct.unpack_from('<I', self.buffer, len(MAGIC))
+        self.header = json.loads(self.buffer[len(MAGIC) + 4:len(MAGIC) + 4 + length])
+        self.path = path
+        self.etag = etag
+        self.version = self.header['version']
+        self.created_at = self.header['created_at']
+        self.codes = {name: {value: code for code, value in enumerate(values)}
+                      for name, values in self.header['vocabularies'].items()}
+        for name, spec in self.header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            count = int(np.prod(spec['shape']))
+            array = np.frombuffer(self.buffer, dtype=dtype, count=count, offset=spec['offset'])
+            setattr(self, name, array.reshape(spec['shape']))
+
+    def __len__(self) -> int:
+        return self.header['count']
+
+    def email(self, row: int) -> str:
+        return bytes(self.email_bytes[self.email_offsets[row]:self.email_offsets[row + 1]]).decode()
+
+    def match_record(self, user: dict) -> dict:
+        """The same record as matchhelper.match_record of matchhelper.find_candidates, scored
+        against the snapshot"""
+        import numpy as np
+        email = user['email']
+        start, end = self.header['genders'].get(matchhelper.expected_gender(user['gender']), (0, 0))
+        scores = np.zeros(end - start, dtype=np.int32)
+        location = self.codes['location'].get(user.get('location'))
+        if location is not None:
+            scores += matchhelper.LOCATION_SCORE * (self.location[start:end] == location)
+        wanted = [self.codes['interest'][i] for i in set(matchhelper.interests(user)) if i in self.codes['interest']]
+        if wanted:
+            # one extra entry, the missing code -1 looks up the last one
+            points = np.zeros(len(self.codes['interest']) + 1, dtype=np.int32)
+            points[wanted] = matchhelper.INTEREST_SCORE
+            scores += points[self.interests[start:end]].sum(axis=1)
+
+        positive = np.flatnonzero(scores)
+        # one more than kept, the user itself may be among them
+        k = min(matchhelper.MATCH_DEPTH + 1, len(positive))
+        if k < len(positive):
+            # rows are email sorted, so the lower row wins a tie, as in matchhelper.rank_key
+            rank = scores[positive].astype(np.int64) * len(scores) - positive
+            positive = positive[np.argpartition(-rank, k - 1)[:k]]
+        ranked = sorted(((self.email(start + row), int(scores[row])) for row in positive),
+                        key=matchhelper.rank_key)
+        total = int(np.count_nonzero(scores))
+        if any(e == email for e, _ in ranked):
+            ranked = [(e, s) for e, s in ranked if e != email]
+            total -= 1
+        return matchhelper.ranked_record(email, ranked[:matchhelper.MATCH_DEPTH], total <= matchhelper.MATCH_DEPTH)
+
+
+def snapshot_path() -> str:
+    return os.path.join(SNAPSHOT_DIR, FILE_NAME)
+
+
+def write(users: list, path: str, version: str = None) -> str:
+    """Write the snapshot of the users to the path, atomically"""
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    with open(temporary, 'wb') as file:
+        file.write(encode(users, version))
+    # a snapshot mapped by this process keeps the replaced file until it is closed
+    os.replace(temporary, path)
+    return path
+
+
+def publish(users: list) -> str or None:
+    """Upload the snapshot of the users to SNAPSHOT_BUCKET, returns its ETag"""
+    if not SNAPSHOT_BUCKET:
+        return None
+    path = write(users, os.path.join(SNAPSHOT_DIR, f'{FILE_NAME}.publish'))
+    s3 = aws_service.client_factory('s3')
+    s3.upload_file(path, SNAPSHOT_BUCKET, SNAPSHOT_KEY)
+    os.remove(path)
+    etag = s3.head_object(Bucket=SNAPSHOT_BUCKET, Key=SNAPSHOT_KEY)['ETag']
+    logger.info('Published the user snapshot of %d users as %s', len(users), etag)
+    return etag
+
+
+def _download(previous: Snapshot or None) -> Snapshot:
+    s3 = aws_service.client_factory('s3')
+    etag = s3.head_object(Bucket=SNAPSHOT_BUCKET, Key=SNAPSHOT_KEY)['ETag']
+    if previous is not None and previous.etag == etag:
+        return previous
+    path = snapshot_path()
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    s3.download_file(SNAPSHOT_BUCKET, SNAPSHOT_KEY, temporary)
+    os.replace(temporary, path)
+    return Snapshot(path, etag)
+
+
+def refresh() -> Snapshot or None:
+    """Download the snapshot if it changed, returns the one in use"""
+    global _current, _checked_at
+    start = time.perf_counter()
+    try:
+        if not SNAPSHOT_BUCKET:
+            raise RuntimeError('SNAPSHOT_BUCKET is not set')
+        refreshed = _download(_current)
+        if refreshed is not _current:
+            logger.info('Loaded user snapshot %s of %d users in %.3fs', refreshed.version,
+                        len(refreshed), time.perf_counter() - start)
+        _current = refreshed
+    except Exception as e:
+        logger.warning('User snapshot refresh failed, keeping %s - %r',
+                       _current.version if _current is not None else 'none', e)
+    _checked_at = time.time()
+    return _current
+
+
+def _refresh_in_background():
+    global _refreshing
+    try:
+        refresh()
+    finally:
+        _refreshing = False
+
+
+def current() -> Snapshot or None:
+    """The snapshot of this container, None when there is none yet. A due refresh runs in
+    the background, the request is served from the snapshot in use (or the index) meanwhile."""
+    global _refreshing
+    if not ENABLED:
+        return None
+    if time.time() - _checked_at >= CHECK_INTERVAL:
+        with _lock:
+            if not _refreshing and time.time() - _checked_at >= CHECK_INTERVAL:
+                _refreshing = True
+                threading.Thread(target=_refresh_in_background, name='snapshot', daemon=True).start()
+    return _current
+
+
+def reset():
+    """Forget the snapshot of this container, the file is kept"""
+    global _current, _checked_at
+    with _lock:
+        _current, _checked_at = None, 0.0
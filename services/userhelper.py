@@ -1,20 +1,43 @@
 import logging
 import random
 import string
+import time
 
-from services import aws_service
+from services import aws_service, outbox, repository
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 FRONTEND_BASE_URL = 'https://d0ch1hik23.execute-api.us-east-1.amazonaws.com/v1'
 CACHE_DYNAMO_NAME = 'cache'
+CACHE_EMAIL_INDEX = 'email-purpose-index'
+VERIFICATION_PURPOSE = 'email_verification'
+VERIFICATION_CODE_LIFETIME = 30 * 60
+USER_DYNAMO_NAME = 'user'
+# the profile fields other users may see
+PUBLIC_USER_FIELDS = ['email', 'name', 'gender', 'location', 'interest1', 'interest2', 'interest3', 'photo']
+MAX_BATCH_PROFILES = 100
+
+"""
+Verification Codes
+A code is stored in the cache table under its own key, together with the email and purpose it
+was issued for and an 'expires_at' epoch second, the TTL attribute of the table. DynamoDB
+deletes expired codes by itself; since that can lag behind, the verifier checks the expiry too.
+
+The codes of an email are found through the email-purpose-index (KEYS_ONLY), so the cleanup
+after a successful verification touches only that user's codes, however large the table is.
+"""
 
 
 def verification_link_generator(email: str) -> str or None:
     cache = aws_service.dynamo_client_factory(CACHE_DYNAMO_NAME)
     verification_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
-    cache.put_item(Item={'key': verification_code, 'email': email, 'purpose': 'email_verification'})
+    cache.put_item(Item={
+        'key': verification_code,
+        'email': email,
+        'purpose': VERIFICATION_PURPOSE,
+        'expires_at': int(time.time()) + VERIFICATION_CODE_LIFETIME
+    })
 
     return FRONTEND_BASE_URL + '/user/verify/' + verification_code
 
@@ -22,37 +45,53 @@ def verification_link_generator(email: str) -> str or None:
 def verification_code_verifier(code: str) -> str or None:
     cache = aws_service.dynamo_client_factory(CACHE_DYNAMO_NAME)
     res = cache.get_item(Key={'key': code}).get('Item')
-    if res is not None:
-        res = res.get('email')
-        # delete all codes generated for this email
-        response = cache.scan(
-            FilterExpression='#email = :email AND #purpose = :purpose',
-            ExpressionAttributeNames={'#email': 'email', '#purpose': 'purpose'},
-            ExpressionAttributeValues={':email': res, ':purpose': 'email_verification'}
-        )
+    if res is None:
+        return None
+    # codes issued before expires_at existed have no expiry
+    if 'expires_at' in res and res['expires_at'] < time.time():
+        logger.info('Verification code %s expired', code)
+        return None
+
+    email = res.get('email')
+    # delete all codes generated for this email
+    with cache.batch_writer() as batch:
+        for key in verification_codes(email):
+            batch.delete_item(Key={'key': key})
 
-        # Loop through the matching items and delete them
-        with cache.batch_writer() as batch:
-            for item in response['Items']:
-                batch.delete_item(Key={'key': item['key']})
+    return email
 
-    return res
+
+def verification_codes(email: str) -> list:
+    codes = aws_service.query(
+        CACHE_DYNAMO_NAME,
+        IndexName=CACHE_EMAIL_INDEX,
+        KeyConditionExpression='#email = :email AND #purpose = :purpose',
+        ExpressionAttributeNames={'#email': 'email', '#purpose': 'purpose'},
+        ExpressionAttributeValues={':email': email, ':purpose': VERIFICATION_PURPOSE}
+    )
+    return [item['key'] for item in codes]
+
+
+def get_public_profiles(emails: list) -> list:
+    """Public fields of the users, in the order of emails; unknown emails are left out"""
+    users = repository.get_users(list(dict.fromkeys(emails)), PUBLIC_USER_FIELDS)
+    return [user for user in users if user is not None]
 
 
 def verification_email_sender(email: str) -> bool:
-    ses_success = False
-    verification_link = verification_link_generator(email)
-    if verification_link is not None:
-        ses_success = aws_service.ses_send_email(
-            target_email_address=email,
+    """Queue the verification email in the outbox, it is sent by outbox_worker.
+    False when the code or the email could not be stored, the caller reports it."""
+    try:
+        verification_link = verification_link_generator(email)
+        outbox.enqueue_email(
+            target=email,
             subject='Welcome to Mulberry! Please verify your email!',
             body='Hi<br><br>Welcome to Mulberry!<br><br>' +
                  'Please click this link to verify your email: ' +
                  '<a href="' + verification_link + '" target="_blank">' + verification_link + '</a><br>' +
                  'Your verification link will expire in 30 minutes.<br><br><br>Cheers,<br>Mulberry'
         )
-    if not ses_success:
-        logger.error('Email sent to %s failed!', email)
+    except Exception as e:
+        logger.error('Queueing the verification email to %s failed - %r', email, e)
         return False
-
     return True
@@ -2,7 +2,7 @@ import json
 import logging
 from datetime import datetime
 
-from services import userhelper, aws_service
+from services import userhelper, aws_service, dataloader, matchhelper, repository
 from services.authentication_service import generateJWTToken
 
 logger = logging.getLogger()
@@ -15,7 +15,7 @@ def signup(event) -> dict:
 
     # Create new user record in DynamoDB
     db = aws_service.dynamo_client_factory("user")
-    if db.get_item(Key={'email': data['email']}).get('Item') is not None:
+    if repository.get_user(data['email'], ['email']) is not None:
         logger.error("Signup failed: email already exists - %s", data['email'])
         return {'status': 'fail', 'message': 'email already exists'}
 
@@ -40,8 +40,7 @@ def login(event):
     logger.info("login")
     data = json.loads(event['body'])
 
-    db = aws_service.dynamo_client_factory('user')
-    user = db.get_item(Key={'email': data['email']}).get('Item')
+    user = repository.get_user(data['email'])
 
     if user is None:
         return {'status': 'fail', 'message': 'User doesn\'t exist'}
@@ -57,10 +56,14 @@ def change_password(event):
     logger.info("change_password")
     data = json.loads(event['body'])
 
-    db = aws_service.dynamo_client_factory('user')
-    user = db.get_item(Key={'email': event['email']}).get('Item')
-    user['password'] = data['password']
-    db.put_item(Item=user)
+    # only the password changes, there is nothing to read
+    aws_service.dynamo_client_factory('user').update_item(
+        Key={'email': event['email']},
+        UpdateExpression='SET #password = :password',
+        ConditionExpression='attribute_exists(#email)',
+        ExpressionAttributeNames={'#password': 'password', '#email': 'email'},
+        ExpressionAttributeValues={':password': data['password']}
+    )
 
     return {'status': 'success'}
 
@@ -70,8 +73,7 @@ def resend_verification(event):
     email = event['path'].split('/')[-1]
 
     # Check if user exists or has been verified
-    db = aws_service.dynamo_client_factory('user')
-    user = db.get_item(Key={'email': email}).get('Item')
+    user = repository.get_user(email, ['email_verified'])
     if user is None or user['email_verified'] is True:
         logger.info('User - %s email has been verified or user not exists')
         return {'status': 'fail', 'message': 'Email has been verified or user not exists!'}
@@ -95,10 +97,13 @@ def verify(event):
         return {'status': 'fail', 'message': 'Either verification is expired or already verified'}
 
     # Update the user info
-    db = aws_service.dynamo_client_factory('user')
-    user = db.get_item(Key={'email': result}).get('Item')
-    user['email_verified'] = True
-    db.put_item(Item=user)
+    aws_service.dynamo_client_factory('user').update_item(
+        Key={'email': result},
+        UpdateExpression='SET #email_verified = :true',
+        ConditionExpression='attribute_exists(#email)',
+        ExpressionAttributeNames={'#email_verified': 'email_verified', '#email': 'email'},
+        ExpressionAttributeValues={':true': True}
+    )
 
     return {'status': 'success'}
 
@@ -106,18 +111,29 @@ def verify(event):
 def get_user(event):
     logger.info("get_user")
     email = event['queryStringParameters']['email']
-    db = aws_service.dynamo_client_factory('user')
-    user = db.get_item(Key={'email': email}).get('Item')
+    user = repository.get_user(email)
     user['password'] = None
     return {'status': 'success', 'data': user}
 
 
+def get_users(event):
+    logger.info("get_users")
+    body = json.loads(event['body'] or '{}')
+    emails = body.get('emails') if isinstance(body, dict) else None
+    if not isinstance(emails, list) or not all(isinstance(email, str) for email in emails):
+        return {'status': 'fail', 'message': 'emails must be a list of emails'}
+    if len(emails) > userhelper.MAX_BATCH_PROFILES:
+        return {'status': 'fail',
+                'message': f'At most {userhelper.MAX_BATCH_PROFILES} users can be read at once'}
+
+    return {'status': 'success', 'data': userhelper.get_public_profiles(emails)}
+
+
 def update_user(event):
     logger.info("create_user")
     user_new = json.loads(event['body'])
 
-    db = aws_service.dynamo_client_factory('user')
-    user_old = db.get_item(Key={'email': event['email']})['Item']
+    user_old = dataloader.get('user', {'email': event['email']})
 
     user_new['password'] = user_old['password']
     user_new['created_ts'] = user_old['created_ts']
@@ -125,7 +141,11 @@ def update_user(event):
     user_new['status'] = 'ACTIVE'
     user_new.pop('Authorization', None)
 
-    db.put_item(Item=user_new)
+    dataloader.put('user', user_new)
+
+    # Keep the candidate index and the stored match lists in sync with the new profile
+    matchhelper.update_candidate_index(user_old, user_new)
+    matchhelper.update_matches(user_old, user_new)
 
     return {'status': 'success'}
 
@@ -133,9 +153,7 @@ def update_user(event):
 def get_photo_link(event):
     logger.info("get_profile_link")
     email = event['queryStringParameters']['email']
-    db = aws_service.dynamo_client_factory('user')
-    return {'status': 'success',
-            'data': {'link': db.get_item(Key={'email': email})['Item'].get('photo')}}
+    return {'status': 'success', 'data': {'link': repository.get_user(email, ['photo']).get('photo')}}
 
 
 function_register = {
@@ -145,11 +163,7 @@ function_register = {
     ('/user/verify/resend/{email}', 'POST'): resend_verification,
     ('/user/verify/{token}', 'POST'): verify,
     ('/user', 'GET'): get_user,
+    ('/user/batch', 'POST'): get_users,
     ('/user', 'PUT'): update_user,
     ('/user/photo', 'GET'): get_photo_link
 }
-
-
-def request_handler(_event):
-    function = function_register[(_event['resource'], _event['httpMethod'])]
-    return function(_event)